@@ -1,117 +1,741 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, g
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import Flask, Blueprint, current_app, render_template, request, redirect, url_for, session, flash, g, Response, jsonify, stream_with_context, make_response, send_from_directory
+from werkzeug.security import generate_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
+from jinja2 import FileSystemBytecodeCache
+import atexit
+import click
+import csv
+import hashlib
+import heapq
+import io
 import sqlite3
 import os
-from datetime import datetime, date
-
-app = Flask(__name__)
-app.secret_key = 'water-supply-secret-key-2024'
-
-DATABASE = 'water_supply.db'
+import json
+import logging
+import mimetypes
+import multiprocessing
+import signal
+import threading
+import time
+from datetime import date, timedelta
+from migrations import migrate, LATEST_VERSION
+from pool import ConnectionPool, PoolTimeout
+import backends
+from backends import PostgresPool
+from events import MemoryBroker, SQLiteBroker
+from cache import TTLCache
+import archive
+import assets
+import pagecache
+import dispatch
+import jobs
+from hashing import HashPool, HashPoolBusy, max_pending_for
+from ratelimit import RateLimiter, MemoryBackend, SQLiteBackend
+from metrics import Registry, QueryStats, InstrumentedConnection
+from pricing import PricingEngine, UnknownProduct, reprice_subscriptions
+import rollups
+import schedule
+import search
+import tracking
+
+# Routes, hooks and CLI commands; create_app() registers them on a new app
+bp = Blueprint('main', __name__, cli_group=None)
+
+def configure(app):
+    """Settings from the environment, with their defaults"""
+    app.secret_key = 'water-supply-secret-key-2024'
+    app.config.update(
+        DATABASE=os.environ.get('DATABASE', 'water_supply.db'),
+        # 'sqlite' (DATABASE is the file) or 'postgres' (DATABASE_URL is a libpq connection string)
+        DB_BACKEND=os.environ.get('DB_BACKEND', 'sqlite'),
+        DATABASE_URL=os.environ.get('DATABASE_URL'),
+        DB_POOL_SIZE=int(os.environ.get('DB_POOL_SIZE', 5)),
+        DB_BUSY_TIMEOUT_MS=int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000)),
+        DB_MMAP_SIZE=int(os.environ.get('DB_MMAP_SIZE', 64 * 1024 * 1024)),
+        DB_CACHE_SIZE_KB=int(os.environ.get('DB_CACHE_SIZE_KB', 16000)),
+        # 'memory' for a single worker, 'sqlite' when running several workers
+        EVENT_BROKER=os.environ.get('EVENT_BROKER', 'memory'),
+        # Streams end after this long and the browser reconnects with Last-Event-ID
+        STREAM_MAX_SECONDS=int(os.environ.get('STREAM_MAX_SECONDS', 300)),
+        SLOW_QUERY_MS=float(os.environ.get('SLOW_QUERY_MS', 100)),
+        # Log requests slower than this; 0 disables the slow request log
+        SLOW_REQUEST_MS=float(os.environ.get('SLOW_REQUEST_MS', 0)),
+        # Lets a Prometheus scraper read /metrics with "Authorization: Bearer <token>"
+        METRICS_TOKEN=os.environ.get('METRICS_TOKEN'),
+        # Van load limits used when grouping subscription orders into routes
+        VAN_CAPACITY_LITRES=float(os.environ.get('VAN_CAPACITY_LITRES', 1000)),
+        VAN_MAX_STOPS=int(os.environ.get('VAN_MAX_STOPS', 30)),
+        # Request threads per gunicorn worker (gunicorn.conf.py reads the same variable)
+        WEB_THREADS=int(os.environ.get('WEB_THREADS', 8)),
+        # Password hashing pool: threads per worker, how many jobs may wait for one (by default as many as
+        # keep hashing to half of WEB_THREADS) and how long a login waits for its hash before answering 503
+        HASH_WORKERS=int(os.environ.get('HASH_WORKERS', 2)),
+        HASH_MAX_PENDING=int(os.environ['HASH_MAX_PENDING']) if 'HASH_MAX_PENDING' in os.environ else None,
+        HASH_WAIT_SECONDS=float(os.environ.get('HASH_WAIT_SECONDS', 0.5)),
+        # 'memory' (per worker) or 'sqlite' (shared by all workers on the machine)
+        RATE_LIMIT_BACKEND=os.environ.get('RATE_LIMIT_BACKEND', 'memory'),
+        # Token buckets: sustained attempts per minute and burst size
+        AUTH_IP_PER_MINUTE=float(os.environ.get('AUTH_IP_PER_MINUTE', 30)),
+        AUTH_IP_BURST=int(os.environ.get('AUTH_IP_BURST', 30)),
+        AUTH_EMAIL_PER_MINUTE=float(os.environ.get('AUTH_EMAIL_PER_MINUTE', 5)),
+        AUTH_EMAIL_BURST=int(os.environ.get('AUTH_EMAIL_BURST', 10)),
+        # Number of reverse proxies in front of the app, trusted for the client IP: 1 on Render.
+        # Set 0 when clients connect directly, or they can pick their IP with X-Forwarded-For
+        PROXY_COUNT=int(os.environ.get('PROXY_COUNT', 1)),
+        # How often each worker checks the catalog version; bounds how long a price change takes to apply
+        PRICING_CHECK_SECONDS=float(os.environ.get('PRICING_CHECK_SECONDS', 2)),
+        # Bulk order API: most lines per request and how long an Idempotency-Key is remembered
+        BULK_ORDER_MAX_LINES=int(os.environ.get('BULK_ORDER_MAX_LINES', 1000)),
+        IDEMPOTENCY_TTL_SECONDS=int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 24 * 3600)),
+        # Delivered orders older than this many days are moved to orders_archive by `flask archive-orders`
+        ARCHIVE_AFTER_DAYS=int(os.environ.get('ARCHIVE_AFTER_DAYS', 90)),
+        ARCHIVE_BATCH_SIZE=int(os.environ.get('ARCHIVE_BATCH_SIZE', 500)),
+        # Rendered panels and dashboards kept per worker; entries are keyed by data version, the TTL only frees memory
+        PAGE_CACHE_MAX_ENTRIES=int(os.environ.get('PAGE_CACHE_MAX_ENTRIES', 2000)),
+        PAGE_CACHE_TTL_SECONDS=int(os.environ.get('PAGE_CACHE_TTL_SECONDS', 300)),
+        # Background jobs run by `flask run-jobs`: worker processes and how often an idle one polls
+        JOB_WORKERS=int(os.environ.get('JOB_WORKERS', 2)),
+        JOB_POLL_SECONDS=float(os.environ.get('JOB_POLL_SECONDS', 0.5)),
+        # Failed jobs retry after JOB_BACKOFF_SECONDS, doubling up to the max, and are dead-lettered after the last attempt
+        JOB_MAX_ATTEMPTS=int(os.environ.get('JOB_MAX_ATTEMPTS', 5)),
+        JOB_BACKOFF_SECONDS=float(os.environ.get('JOB_BACKOFF_SECONDS', 5)),
+        # Queued jobs due for longer than this are reported as stale by /readyz and /admin/job_stats
+        JOB_STALE_SECONDS=float(os.environ.get('JOB_STALE_SECONDS', 300)),
+        JOB_BACKOFF_MAX_SECONDS=float(os.environ.get('JOB_BACKOFF_MAX_SECONDS', 600)),
+        # A job running longer than this is assumed lost with its worker and requeued
+        JOB_TIMEOUT_SECONDS=float(os.environ.get('JOB_TIMEOUT_SECONDS', 300)),
+        JOB_RETENTION_SECONDS=float(os.environ.get('JOB_RETENTION_SECONDS', 7 * 24 * 3600)),
+        # After downtime, subscription orders are generated for the missed days up to this many days back
+        SUBSCRIPTION_BACKFILL_DAYS=int(os.environ.get('SUBSCRIPTION_BACKFILL_DAYS', 30)),
+        # Subscriptions generated per transaction, and the seconds between batches that let requests write
+        SUBSCRIPTION_BATCH_SIZE=int(os.environ.get('SUBSCRIPTION_BATCH_SIZE', 500)),
+        SUBSCRIPTION_BATCH_PAUSE=float(os.environ.get('SUBSCRIPTION_BATCH_PAUSE', 0.05)),
+        # Rider GPS pings: most per request, and the group commit of the trail (every so many seconds or pings)
+        TRACKING_MAX_BATCH=int(os.environ.get('TRACKING_MAX_BATCH', 500)),
+        TRACKING_FLUSH_SECONDS=float(os.environ.get('TRACKING_FLUSH_SECONDS', 1)),
+        TRACKING_FLUSH_PINGS=int(os.environ.get('TRACKING_FLUSH_PINGS', 5000)),
+        # Pings a worker holds while the database is slow; beyond it riders get 503 and resend later
+        TRACKING_MAX_BUFFERED=int(os.environ.get('TRACKING_MAX_BUFFERED', 100000)),
+        TRACKING_TRAIL_DAYS=float(os.environ.get('TRACKING_TRAIL_DAYS', 7)),
+        # ETA: average rider speed in town, road distance over straight-line distance, and the oldest usable position
+        TRACKING_SPEED_KMH=float(os.environ.get('TRACKING_SPEED_KMH', 20)),
+        TRACKING_DETOUR_FACTOR=float(os.environ.get('TRACKING_DETOUR_FACTOR', 1.4)),
+        TRACKING_STALE_SECONDS=int(os.environ.get('TRACKING_STALE_SECONDS', 300)),
+        # Browser cache lifetime of fingerprinted static files; a changed file gets a new URL
+        ASSET_MAX_AGE_SECONDS=int(os.environ.get('ASSET_MAX_AGE_SECONDS', 365 * 24 * 3600)),
+        # Compiled templates, written by `flask bootstrap` so that workers don't compile them on first use
+        TEMPLATE_CACHE_DIR=os.environ.get('TEMPLATE_CACHE_DIR', os.path.join(app.instance_path, 'templates')),
+    )
+
+# --- App factory ---
+
+class AppState:
+    """An app's per-process objects, built by create_app() and kept in app.extensions['aquaflow']"""
+
+    def __init__(self, config):
+        # Opened with the app's settings on first use
+        self.pool = self.broker = self.tracker = None
+        self.metrics = Registry()
+        self.page_cache = TTLCache('pages', config['PAGE_CACHE_MAX_ENTRIES'], config['PAGE_CACHE_TTL_SECONDS'])
+        self.pricing = PricingEngine(config['PRICING_CHECK_SECONDS'])
+
+        max_pending = config['HASH_MAX_PENDING']
+        if max_pending is None:
+            max_pending = max_pending_for(config['WEB_THREADS'], config['HASH_WORKERS'])
+        self.hash_pool = HashPool(config['HASH_WORKERS'], max_pending, config['HASH_WAIT_SECONDS'])
+        if config['RATE_LIMIT_BACKEND'] == 'sqlite':
+            rate_backend = SQLiteBackend(config['DATABASE'])
+        else:
+            rate_backend = MemoryBackend()
+        self.ip_limiter = RateLimiter(rate_backend, 'ip', config['AUTH_IP_PER_MINUTE'] / 60, config['AUTH_IP_BURST'])
+        self.email_limiter = RateLimiter(rate_backend, 'email', config['AUTH_EMAIL_PER_MINUTE'] / 60,
+                                         config['AUTH_EMAIL_BURST'])
+
+        # Set with the static manifest, see use_static_manifest()
+        self.static_manifest = {}
+        self.built_assets = {}
+        self.template_salt = ''
+        # Date (ISO string) this worker last handed the daily generation run to the job queue for
+        self.generation_queued_for = None
+
+    def close(self):
+        # Pings still buffered when the worker exits
+        if self.tracker is not None:
+            self.tracker.writer.close()
+
+def get_state():
+    """The current app's AppState"""
+    return current_app.extensions['aquaflow']
+
+def create_app(config=None):
+    """Builds the app for this process (wsgi.py builds it for gunicorn wsgi:app).
+
+    config overrides the settings read from the environment. Only in-memory
+    objects are built here: connections open on first use and nothing is
+    written, so a worker is ready as soon as it has created the app. The
+    one-time work of a deploy (schema, migrations, staff accounts, static
+    build, compiled templates) is `flask bootstrap`, run once before the
+    workers start.
+    """
+    app = Flask(__name__)
+    configure(app)
+    if config:
+        app.config.update(config)
+
+    if app.config['DB_BACKEND'] == 'postgres':
+        # These keep their state in the SQLite file, which isn't shared with a Postgres deployment
+        for key in ('EVENT_BROKER', 'RATE_LIMIT_BACKEND'):
+            if app.config[key] == 'sqlite':
+                raise RuntimeError(f'{key}=sqlite needs DB_BACKEND=sqlite')
+
+    if app.config['PROXY_COUNT']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_COUNT'])
+
+    state = app.extensions['aquaflow'] = AppState(app.config)
+    atexit.register(state.close)
+    app.register_blueprint(bp)
+    app.teardown_appcontext(close_connection)
+    app.view_functions['static'] = serve_static
+
+    # Without the folder (no bootstrap yet) each worker compiles templates in memory
+    cache_dir = app.config['TEMPLATE_CACHE_DIR']
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir) if cache_dir and os.path.isdir(cache_dir) else None
+
+    manifest = assets.load_manifest(app.static_folder)
+    if manifest is None:
+        app.logger.warning('static/dist has not been built (run `flask bootstrap`); serving the original static files')
+    use_static_manifest(app, manifest or {})
+    return app
 
 # Database helper functions
+def get_pool():
+    state = get_state()
+    config = current_app.config
+    if state.pool is None and config['DB_BACKEND'] == 'postgres':
+        state.pool = PostgresPool(
+            config['DATABASE_URL'],
+            size=config['DB_POOL_SIZE'],
+            timeout=config['DB_BUSY_TIMEOUT_MS'] / 1000,
+        )
+    elif state.pool is None:
+        state.pool = ConnectionPool(
+            config['DATABASE'],
+            size=config['DB_POOL_SIZE'],
+            busy_timeout_ms=config['DB_BUSY_TIMEOUT_MS'],
+            mmap_size=config['DB_MMAP_SIZE'],
+            cache_size_kb=config['DB_CACHE_SIZE_KB'],
+        )
+    return state.pool
+
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row
+        stats = g.get('_query_stats')
+        if stats is None:
+            stats = g._query_stats = QueryStats()
+        db = g._database = InstrumentedConnection(
+            get_pool().acquire(), stats, current_app.config['SLOW_QUERY_MS'] / 1000)
     return db
 
-@app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
+    db = g.pop('_database', None)
     if db is not None:
-        db.close()
-
-def init_db():
-    """Initialize database with schema and create admin/van users"""
-    with app.app_context():
-        db = get_db()
-        with app.open_resource('schema.sql', mode='r') as f:
-            db.cursor().executescript(f.read())
-
-        # Create admin user if not exists
-        cursor = db.execute('SELECT * FROM users WHERE email = ?', ('admin@water.com',))
-        if cursor.fetchone() is None:
-            hashed_password = generate_password_hash('admin123')
-            db.execute(
-                'INSERT INTO users (name, email, phone, password, role) VALUES (?, ?, ?, ?, ?)',
-                ('Admin', 'admin@water.com', '0000000000', hashed_password, 'admin')
-            )
-        
-        # Create delivery user if not exists
-        cursor = db.execute('SELECT * FROM users WHERE email = ?', ('delivery@water.com',))
-        if cursor.fetchone() is None:
-            hashed_password = generate_password_hash('delivery123')
+        get_pool().release(db.raw)
+
+# --- Request metrics ---
+# Each app's Registry lives in its AppState
+
+@bp.before_app_request
+def start_request_timer():
+    g._request_start = time.perf_counter()
+    g._query_stats = QueryStats()
+
+@bp.after_app_request
+def remember_status(response):
+    g._response_status = response.status_code
+    return response
+
+@bp.teardown_app_request
+def record_request_metrics(exception):
+    start = g.pop('_request_start', None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    stats = g.get('_query_stats') or QueryStats()
+    endpoint = request.endpoint or 'unknown'
+    get_state().metrics.record_request(endpoint, request.method, g.get('_response_status', 500), elapsed, stats)
+
+    slow_ms = current_app.config['SLOW_REQUEST_MS']
+    if slow_ms and elapsed * 1000 >= slow_ms:
+        current_app.logger.warning('Slow request %s %s: %.1f ms, %d queries, %.1f ms SQL',
+                                   request.method, request.path, elapsed * 1000, stats.count, stats.seconds * 1000)
+
+# --- Per-user reads ---
+# Each is one indexed lookup, no dearer than the version check a cache in
+# front of them would need, so they read the database every time.
+def get_user_locations(user_id):
+    """The user's saved locations as a list of dicts"""
+    return [dict(row) for row in get_db().execute('SELECT * FROM locations WHERE user_id = ?', (user_id,))]
+
+def get_user_location(user_id, location_id):
+    """One of the user's locations by id, or None if it isn't theirs"""
+    try:
+        location_id = int(location_id)
+    except (TypeError, ValueError):
+        return None
+    row = get_db().execute('SELECT * FROM locations WHERE id = ? AND user_id = ?', (location_id, user_id)).fetchone()
+    return dict(row) if row else None
+
+def get_user_subscription(user_id):
+    """The user's subscription as a dict, or None"""
+    row = get_db().execute('SELECT * FROM subscriptions WHERE user_id = ?', (user_id,)).fetchone()
+    return dict(row) if row else None
+
+# --- Pricing ---
+# The PricingEngine is in the AppState
+
+def get_products():
+    """Active products in display order"""
+    return list(get_state().pricing.catalog(get_db).products.values())
+
+# --- Auth throttling ---
+# The HashPool and RateLimiters are in the AppState
+
+def auth_throttled():
+    """True if this client has used up its auth attempts; every attempt counts"""
+    return not get_state().ip_limiter.allow(request.remote_addr)
+
+def login_throttled(email):
+    """True if this client or this email has used up its failed logins; charges nothing"""
+    state = get_state()
+    return not state.ip_limiter.check(request.remote_addr) or not state.email_limiter.check(email.lower())
+
+def login_failed(email):
+    """Charges a failed login to the client's and the email's buckets"""
+    state = get_state()
+    state.ip_limiter.allow(request.remote_addr)
+    state.email_limiter.allow(email.lower())
+
+# --- Live panel events ---
+def get_broker():
+    state = get_state()
+    if state.broker is None:
+        if current_app.config['EVENT_BROKER'] == 'sqlite':
+            state.broker = SQLiteBroker(current_app.config['DATABASE'])
+        else:
+            state.broker = MemoryBroker()
+    return state.broker
+
+# --- Rider tracking ---
+def get_tracker():
+    state = get_state()
+    if state.tracker is None:
+        config = current_app.config
+        state.tracker = tracking.Tracker(tracking.TrailWriter(
+            get_pool(),
+            flush_seconds=config['TRACKING_FLUSH_SECONDS'],
+            flush_pings=config['TRACKING_FLUSH_PINGS'],
+            max_buffered=config['TRACKING_MAX_BUFFERED'],
+            retention_seconds=config['TRACKING_TRAIL_DAYS'] * 24 * 3600,
+        ))
+    return state.tracker
+
+def delivery_etas(db, orders):
+    """{order id: minutes} for the orders out for delivery whose rider and address have known positions"""
+    now = time.time()
+    etas = {}
+    for order in orders:
+        if order['status'] != 'out_for_delivery' or not order['delivery_boy_id']:
+            continue
+        destination = db.execute('SELECT lat, lng FROM geocodes WHERE city = ? AND address = ?',
+                                 (order['city'], order['address'])).fetchone()
+        if destination is None:
+            continue
+        position = get_tracker().latest(db, order['delivery_boy_id'], now)
+        if position is None or now - position.recorded_at > current_app.config['TRACKING_STALE_SECONDS']:
+            continue
+        etas[order['id']] = tracking.eta_minutes(position, tuple(destination), current_app.config['TRACKING_SPEED_KMH'],
+                                                 current_app.config['TRACKING_DETOUR_FACTOR'])
+    return etas
+
+def publish_event(channel, kind, data):
+    """Publish a panel delta. Call after commit; a failure here never fails the write."""
+    try:
+        get_broker().publish(channel, kind, data)
+    except sqlite3.Error:
+        current_app.logger.exception('Could not publish %s event', kind)
+
+# --- Background jobs ---
+# Side effects of order changes run in `flask run-jobs` workers, off the
+# request path. Jobs are enqueued in the same transaction as the change.
+
+ORDER_STATUS_TEXT = {
+    'pending': 'has been placed',
+    'out_for_delivery': 'is out for delivery',
+    'delivered': 'has been delivered',
+}
+
+def enqueue_job(db, kind, payload):
+    """Queue a job in the current transaction; commit to hand it to the workers"""
+    jobs.enqueue(db, kind, payload, max_attempts=current_app.config['JOB_MAX_ATTEMPTS'])
+
+def notify_customer(row, message):
+    """Send a customer notification. No SMS/email provider is configured yet, so it is logged."""
+    current_app.logger.info('Notify %s <%s>: %s', row['phone'], row['email'], message)
+
+@jobs.handler('order_status')
+def notify_order_status(db, payload):
+    """Tells the customers of payload['order_ids'] that their order reached payload['status']"""
+    order_ids = payload['order_ids']
+    placeholders = ', '.join('?' * len(order_ids))
+    for row in db.execute(
+        f'SELECT orders.id, users.email, users.phone FROM orders JOIN users ON users.id = orders.user_id '
+        f'WHERE orders.id IN ({placeholders})',
+        order_ids
+    ):
+        notify_customer(row, f"Your order #{row['id']} {ORDER_STATUS_TEXT[payload['status']]}.")
+
+@jobs.handler('subscription_orders')
+def notify_subscription_orders(db, payload):
+    """Tells subscribers about the subscription orders created by one generation run"""
+    sql = ('SELECT orders.id, orders.quantity, orders.bottle_type, orders.delivery_date, users.email, users.phone '
+           'FROM orders JOIN users ON users.id = orders.user_id WHERE orders.subscription_id IS NOT NULL ')
+    if 'after_id' in payload:
+        # A backfilling run creates orders for past days as well
+        sql += 'AND orders.id > ? AND orders.delivery_date <= ?'
+        params = [payload['after_id'], payload['delivery_date']]
+        if 'upto_id' in payload:  # one batch of the run
+            sql += ' AND orders.id <= ?'
+            params.append(payload['upto_id'])
+    else:  # queued before backfilling
+        sql += 'AND orders.delivery_date = ?'
+        params = [payload['delivery_date']]
+    if payload.get('user_id') is not None:
+        sql += ' AND orders.user_id = ?'
+        params.append(payload['user_id'])
+    for row in db.execute(sql, params):
+        day = 'today' if row['delivery_date'] == payload['delivery_date'] else row['delivery_date']
+        notify_customer(row, f"Your subscription order #{row['id']} "
+                             f"({row['quantity']} x {row['bottle_type']}) is scheduled for {day}.")
+
+def apply_schema(db):
+    """Create the base tables from schema.sql on an empty database and apply pending migrations"""
+    if not db.table_exists('users'):
+        with current_app.open_resource('schema.sql', mode='r') as f:
+            db.executescript(f.read())
+    return migrate(db)
+
+# name, email, password, role of the accounts every install starts with
+STAFF_ACCOUNTS = (
+    ('Admin', 'admin@water.com', 'admin123', 'admin'),
+    ('Delivery Boy', 'delivery@water.com', 'delivery123', 'delivery'),
+    ('Delivery Van', 'van@water.com', 'van123', 'van'),
+)
+
+def bootstrap():
+    """One-time setup of a deploy: schema, migrations, staff accounts, static files and compiled templates.
+
+    Safe to repeat; on an up-to-date install it only reads. Passwords are
+    hashed only for staff accounts that don't exist yet. Runs in an app context.
+    """
+    app = current_app._get_current_object()
+    db = get_db()
+    for version in apply_schema(db):
+        print(f"Migrated database to version {version}")
+
+    emails = [email for _, email, _, _ in STAFF_ACCOUNTS]
+    existing = {row[0] for row in db.execute(
+        f"SELECT email FROM users WHERE email IN ({', '.join('?' * len(emails))})", emails)}
+    for name, email, password, role in STAFF_ACCOUNTS:
+        if email not in existing:
             db.execute(
                 'INSERT INTO users (name, email, phone, password, role) VALUES (?, ?, ?, ?, ?)',
-                ('Delivery Boy', 'delivery@water.com', '0000000000', hashed_password, 'delivery')
+                (name, email, '0000000000', generate_password_hash(password), role)
             )
+            print(f"Created the {role} account {email}")
+    db.commit()
 
-        # Create DELIVERY VAN user if not exists
-        cursor = db.execute('SELECT * FROM users WHERE email = ?', ('van@water.com',))
-        if cursor.fetchone() is None:
-            hashed_password = generate_password_hash('van123')
-            db.execute(
-                'INSERT INTO users (name, email, phone, password, role) VALUES (?, ?, ?, ?, ?)',
-                ('Delivery Van', 'van@water.com', '0000000000', hashed_password, 'van')
-            )
+    use_static_manifest(app, assets.build(app.static_folder))
+    if app.config['TEMPLATE_CACHE_DIR']:
+        os.makedirs(app.config['TEMPLATE_CACHE_DIR'], exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['TEMPLATE_CACHE_DIR'])
+        app.jinja_env.cache.clear()
+        for name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(name)
 
+# --- Daily Subscription Automation ---
+# Generation runs in a job (or `flask generate-subscriptions` from cron), never
+# on the request path. The first request of the day in each worker only
+# starts a thread that queues that job.
+
+def generate_subscription_orders(db, user_id=None):
+    """Generates the orders of every subscription (or just one user's) due since its last run, up to today.
+
+    Subscriptions are repriced from the catalog first, so the orders carry
+    today's prices. Set-based: schedule.generate() inserts every due
+    (subscription, day) of a batch of SUBSCRIPTION_BATCH_SIZE subscriptions
+    in one INSERT ... SELECT and advances their watermarks. Each batch is
+    its own transaction, with a SUBSCRIPTION_BATCH_PAUSE between them, so
+    requests can write while a large run is going. Days missed while
+    nothing ran are backfilled, at most SUBSCRIPTION_BACKFILL_DAYS back. The
+    unique (subscription_id, delivery_date) index makes a re-run a no-op, so
+    a crash or a concurrent run can never produce a second order for the
+    same day. Returns the number of orders created.
+    """
+    today = date.today()
+    since = (today - timedelta(days=current_app.config['SUBSCRIPTION_BACKFILL_DAYS'])).isoformat()
+    pause = current_app.config['SUBSCRIPTION_BATCH_PAUSE']
+
+    if user_id is None:
+        reprice_subscriptions(db)
         db.commit()
+    created = 0
+    for batch, id_range in enumerate(schedule.batches(db, current_app.config['SUBSCRIPTION_BATCH_SIZE'], user_id)):
+        if batch and pause:
+            time.sleep(pause)
+        # The new orders of this batch are the ones after after_id, up to upto_id
+        after_id = db.execute('SELECT COALESCE(MAX(id), 0) FROM orders').fetchone()[0]
+        batch_created = schedule.generate(db, today.isoformat(), since, user_id, id_range)
+        if batch_created > 0:
+            upto_id = db.execute('SELECT MAX(id) FROM orders').fetchone()[0]
+            enqueue_job(db, 'subscription_orders', {'delivery_date': today.isoformat(), 'after_id': after_id,
+                                                    'upto_id': upto_id, 'user_id': user_id})
+        db.commit()
+        created += batch_created
+
+    if created > 0:
+        publish_event('subscription', 'generated', {'count': created})
+    return created
+
+@jobs.handler('generate_subscriptions')
+def generate_subscriptions_job(db, payload):
+    """Generates the subscription orders due up to today (queued once a day by queue_daily_generation)"""
+    generate_subscription_orders(db)
+
+def claim_daily_run(db, run_date):
+    """Inserts the subscription_runs row of run_date; True if no one had claimed the day yet. Doesn't commit."""
+    return db.execute(
+        'INSERT INTO subscription_runs (run_date) VALUES (?) ON CONFLICT DO NOTHING', (run_date,)
+    ).rowcount == 1
+
+def queue_daily_generation(db):
+    """Claims today's generation run and queues it as a job. Returns True if this call claimed it.
+
+    The claim (a subscription_runs row keyed by date) commits together with
+    the job, so the day is queued exactly once no matter how many workers
+    race for it, and a claimed day always has its job.
+    """
+    if claim_daily_run(db, date.today().isoformat()):
+        enqueue_job(db, 'generate_subscriptions', {})
+        db.commit()
+        return True
+    db.rollback()
+    return False
 
-# --- Daily Subscription Automation ---
-def generate_subscription_orders():
-    """Checks and generates orders for subscriptions if not done today"""
+def _queue_daily_generation(app, run_date):
+    with app.app_context():
+        try:
+            queue_daily_generation(get_db())
+        except backends.DB_ERRORS:
+            # e.g. database busy; the worker's next request tries again
+            app.logger.exception('Could not queue the subscription run of %s', run_date)
+            state = get_state()
+            if state.generation_queued_for == run_date:
+                state.generation_queued_for = None
+
+# Load balancer probes; they must not write or wait on anything
+PROBE_ENDPOINTS = ('main.healthz', 'main.readyz')
+
+@bp.before_app_request
+def before_request():
+    """Hand today's subscription run to the job queue the first time this worker sees the date"""
+    if request.endpoint and 'static' not in request.endpoint and request.endpoint not in PROBE_ENDPOINTS:
+        # In-memory check; the queueing itself happens off the request, once per day per worker
+        state = get_state()
+        today = date.today().isoformat()
+        if state.generation_queued_for != today:
+            state.generation_queued_for = today
+            threading.Thread(target=_queue_daily_generation, args=(current_app._get_current_object(), today),
+                             name='queue-generation', daemon=True).start()
+
+@bp.cli.command('bootstrap')
+def bootstrap_command():
+    """Migrate the database, create staff accounts, build static files and compile templates (once per deploy)."""
+    started = time.perf_counter()
+    bootstrap()
+    print(f"Bootstrapped in {time.perf_counter() - started:.2f}s; the database is up to date.")
+
+# The command's name before bootstrap also built the static files
+bp.cli.add_command(bootstrap_command, 'init-db')
+
+@bp.cli.command('reconcile-rollups')
+@click.option('--dry-run', is_flag=True, help='Only report drift, do not rebuild.')
+def reconcile_rollups_command(dry_run):
+    """Check order_rollups against orders and rebuild it if it drifted."""
+    drift = rollups.reconcile(get_db(), repair=not dry_run)
+    for scope, key, stored, expected in drift:
+        print(f"{scope} {key!r}: stored {stored}, expected {expected}")
+    if not drift:
+        print("Rollups match orders.")
+    elif dry_run:
+        print(f"{len(drift)} rollup rows drifted (not repaired).")
+    else:
+        print(f"{len(drift)} rollup rows drifted; rebuilt from orders.")
+
+@bp.cli.command('archive-orders')
+@click.option('--days', type=int, help='Archive delivered orders older than this (default ARCHIVE_AFTER_DAYS).')
+@click.option('--batch-size', type=int, help='Orders moved per transaction (default ARCHIVE_BATCH_SIZE).')
+@click.option('--pause', default=0.05, show_default=True, help='Seconds to wait between batches.')
+def archive_orders_command(days, batch_size, pause):
+    """Move old delivered orders from orders to orders_archive (run daily from cron)."""
+    days = current_app.config['ARCHIVE_AFTER_DAYS'] if days is None else days
+    cutoff = (date.today() - timedelta(days=days)).isoformat()
+    started = time.perf_counter()
+    moved = archive.archive_orders(get_db(), cutoff, batch_size or current_app.config['ARCHIVE_BATCH_SIZE'], pause)
+    print(f"Archived {moved} orders delivered before {cutoff} in {time.perf_counter() - started:.1f}s.")
+
+@bp.cli.command('import-geocodes')
+@click.argument('csv_file', type=click.File('r', encoding='utf-8-sig'))
+def import_geocodes_command(csv_file):
+    """Load delivery coordinates from a CSV with city,address,lat,lng columns."""
     db = get_db()
-    today_str = date.today().isoformat()
-    
-    # Get all subscriptions
-    subscriptions = db.execute('SELECT * FROM subscriptions').fetchall()
-    
-    for sub in subscriptions:
-        # Check if already generated today
-        # We need a column last_generated_date in subscriptions. 
-        # Since I handle migration in __main__, I assume it exists or will handle error gracefully if I add migration logic there.
-        # But efficiently, let's just check if we have a subscription order for this user for today in orders table.
-        # This is safer if we don't strictly rely on a new column immediately, but the plan asked for a column.
-        # I will use the column approach as planned.
-        
-        last_gen = sub['last_generated_date'] if 'last_generated_date' in sub.keys() else None
-        
-        if last_gen != today_str:
-            # Get location details
-            loc = db.execute('SELECT * FROM locations WHERE id = ?', (sub['location_id'],)).fetchone()
-            address = loc['address'] if loc else "Unknown"
-            city = loc['city'] if loc else "Unknown"
+    rows = [(r['city'].strip(), r['address'].strip(), float(r['lat']), float(r['lng']))
+            for r in csv.DictReader(csv_file)]
+    db.executemany(
+        'INSERT INTO geocodes (city, address, lat, lng) VALUES (?, ?, ?, ?) '
+        'ON CONFLICT (city, address) DO UPDATE SET lat = excluded.lat, lng = excluded.lng',
+        rows
+    )
+    db.commit()
+    print(f"Imported {len(rows)} geocodes.")
 
-            # Generate Order
-            db.execute(
-                '''INSERT INTO orders 
-                   (user_id, bottle_type, quantity, total_price, order_type, status, order_date, address, city) 
-                   VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, ?, ?)''',
-                (sub['user_id'], sub['bottle_type'], sub['quantity'], sub['total_price'], 'subscription', 'pending', address, city)
-            )
-            
-            # Update last_generated_date
-            db.execute('UPDATE subscriptions SET last_generated_date = ? WHERE id = ?', (today_str, sub['id']))
-            
+@bp.cli.command('generate-subscriptions')
+def generate_subscriptions_command():
+    """Generate the subscription orders due up to today, backfilling missed days (run daily from cron)."""
+    started = time.perf_counter()
+    db = get_db()
+    # Claimed so that the web workers don't queue the day again. Generating a
+    # day that is already done creates nothing, so this is safe to repeat
+    claim_daily_run(db, date.today().isoformat())
+    created = generate_subscription_orders(db)
+    print(f"Generated {created} subscription orders up to today in {time.perf_counter() - started:.2f}s.")
+
+@bp.cli.command('set-price')
+@click.argument('bottle_type')
+@click.argument('unit_price', type=float)
+@click.option('--city', help='Price for deliveries to this city only.')
+def set_price_command(bottle_type, unit_price, city):
+    """Set a product's unit price, or its price in one city."""
+    db = get_db()
+    product = db.execute('SELECT id FROM products WHERE bottle_type = ?', (bottle_type,)).fetchone()
+    if product is None:
+        raise click.ClickException(f"Unknown bottle type {bottle_type!r}")
+    if city:
+        db.execute(
+            'INSERT INTO product_prices (product_id, city, unit_price) VALUES (?, ?, ?) '
+            'ON CONFLICT (product_id, city) DO UPDATE SET unit_price = excluded.unit_price',
+            (product['id'], city.strip(), unit_price)
+        )
+    else:
+        db.execute('UPDATE products SET unit_price = ? WHERE id = ?', (unit_price, product['id']))
+    repriced = reprice_subscriptions(db)
+    db.commit()
+    print(f"{bottle_type} now costs Rs {unit_price:g}" + (f" in {city}." if city else ".")
+          + f" {repriced} subscriptions repriced.")
+
+@bp.cli.command('set-discount')
+@click.argument('bottle_type')
+@click.argument('min_quantity', type=int)
+@click.argument('percent_off', type=float)
+def set_discount_command(bottle_type, min_quantity, percent_off):
+    """Give PERCENT_OFF on orders of at least MIN_QUANTITY bottles (0 removes the tier)."""
+    db = get_db()
+    product = db.execute('SELECT id FROM products WHERE bottle_type = ?', (bottle_type,)).fetchone()
+    if product is None:
+        raise click.ClickException(f"Unknown bottle type {bottle_type!r}")
+    if percent_off:
+        db.execute(
+            'INSERT INTO quantity_discounts (product_id, min_quantity, percent_off) VALUES (?, ?, ?) '
+            'ON CONFLICT (product_id, min_quantity) DO UPDATE SET percent_off = excluded.percent_off',
+            (product['id'], min_quantity, percent_off)
+        )
+    else:
+        db.execute('DELETE FROM quantity_discounts WHERE product_id = ? AND min_quantity = ?',
+                   (product['id'], min_quantity))
+    repriced = reprice_subscriptions(db)
     db.commit()
+    print(f"Discount for {bottle_type} from {min_quantity} bottles: {percent_off:g}%. "
+          f"{repriced} subscriptions repriced.")
+
+def _job_worker(app, stop):
+    # Ctrl-C reaches the whole process group; the parent handles it and sets stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Handlers log and read settings through current_app
+    with app.app_context():
+        jobs.work(get_pool(), stop,
+                  poll=app.config['JOB_POLL_SECONDS'],
+                  timeout=app.config['JOB_TIMEOUT_SECONDS'],
+                  retention=app.config['JOB_RETENTION_SECONDS'],
+                  backoff_base=app.config['JOB_BACKOFF_SECONDS'],
+                  backoff_cap=app.config['JOB_BACKOFF_MAX_SECONDS'])
+
+@bp.cli.command('run-jobs')
+@click.option('--workers', type=int, help='Worker processes (default JOB_WORKERS).')
+def run_jobs_command(workers):
+    """Run background jobs until interrupted (keep one running alongside the web server)."""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(processName)s %(levelname)s %(message)s')
+    current_app.logger.setLevel(logging.INFO)
+    apply_schema(get_db())
+    get_db().commit()
+
+    # fork: the workers inherit the loaded app and open their own connections
+    context = multiprocessing.get_context('fork')
+    stop = context.Event()
+    # SIGTERM (e.g. from a process manager) stops the workers like Ctrl-C does
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    app = current_app._get_current_object()
+    processes = [context.Process(target=_job_worker, args=(app, stop), name=f'job-worker-{n}')
+                 for n in range(workers or current_app.config['JOB_WORKERS'])]
+    for process in processes:
+        process.start()
+    print(f"Running jobs with {len(processes)} workers; Ctrl-C to stop.")
+    try:
+        while any(process.is_alive() for process in processes):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    stop.set()
+    for process in processes:
+        process.join()
+
+@bp.cli.command('rebuild-search')
+def rebuild_search_command():
+    """Rebuild the admin search indexes from the users, locations and orders tables."""
+    started = time.perf_counter()
+    search.rebuild(get_db())
+    get_db().commit()
+    print(f"Search indexes rebuilt in {time.perf_counter() - started:.1f}s.")
+
+@bp.cli.command('build-assets')
+def build_assets_command():
+    """Build static/dist (fingerprinted, minified, precompressed) and print the sizes."""
+    for source, (built, sizes) in assets.build(current_app.static_folder).items():
+        original = os.path.getsize(os.path.join(current_app.static_folder, source))
+        encoded = ', '.join(f'{encoding} {size}' for encoding, size in sizes.items() if encoding != 'identity')
+        print(f"{source} -> {built}: {original} -> {sizes['identity']} bytes ({encoded})")
+
+@bp.cli.command('job-stats')
+def job_stats_command():
+    """Print queue depth, job latency and the jobs no worker has taken."""
+    db = get_db()
+    print(json.dumps(dict(jobs.stats(db), stale=jobs.stale(db, current_app.config['JOB_STALE_SECONDS'])), indent=2))
 
-@app.before_request
-def before_request():
-    """Run daily checks before handling request"""
-    if request.endpoint and 'static' not in request.endpoint:
-        # simple throttling: only checking, logic inside is idempotent per day
-        # In production this might be heavy, but for this app it is fine.
-        if 'water_supply.db' in os.listdir('.'): # simple check to ensure db exists
-             # We need to ensure we are in an app context with DB
-             pass # Logic moved to explicit call to avoid circular dependency issues during startup
-             # actually, g.db is available here via get_db()
-             try:
-                 generate_subscription_orders()
-             except Exception:
-                 # Likely migration hasn't run yet or table issue, ignore to let init handle it
-                 pass
+@bp.cli.command('retry-jobs')
+@click.option('--kind', help='Only retry dead jobs of this kind.')
+def retry_jobs_command(kind):
+    """Requeue dead-lettered jobs with a fresh set of attempts."""
+    print(f"Requeued {jobs.retry_dead(get_db(), kind)} dead jobs.")
 
 
 # Helper function to check if user is logged in
@@ -121,7 +745,7 @@ def login_required(f):
     def decorated_function(*args, **kwargs):
         if 'user_id' not in session:
             flash('Please login first', 'error')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
         return f(*args, **kwargs)
     return decorated_function
 
@@ -132,10 +756,10 @@ def admin_required(f):
     def decorated_function(*args, **kwargs):
         if 'user_id' not in session:
             flash('Please login first', 'error')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
         if session.get('user_role') != 'admin':
             flash('Admin access required', 'error')
-            return redirect(url_for('dashboard'))
+            return redirect(url_for('main.dashboard'))
         return f(*args, **kwargs)
     return decorated_function
 
@@ -146,10 +770,10 @@ def delivery_required(f):
     def decorated_function(*args, **kwargs):
         if 'user_id' not in session:
             flash('Please login first', 'error')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
         if session.get('user_role') != 'delivery':
             flash('Delivery access required', 'error')
-            return redirect(url_for('dashboard'))
+            return redirect(url_for('main.dashboard'))
         return f(*args, **kwargs)
     return decorated_function
 
@@ -160,28 +784,109 @@ def van_required(f):
     def decorated_function(*args, **kwargs):
         if 'user_id' not in session:
             flash('Please login first', 'error')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
         if session.get('user_role') != 'van':
             flash('Delivery Van access required', 'error')
-            return redirect(url_for('dashboard'))
+            return redirect(url_for('main.dashboard'))
         return f(*args, **kwargs)
     return decorated_function
 
+# --- Static assets ---
+# `flask bootstrap` builds static/dist and each worker loads its manifest, so
+# url_for('static', ...) points at the hashed copy of the current file
+
+def use_static_manifest(app, manifest):
+    """Serve the built files of manifest (source name -> (built name, sizes))"""
+    state = app.extensions['aquaflow']
+    state.static_manifest = manifest
+    # built name -> {encoding: size}
+    state.built_assets = {built: sizes for built, sizes in manifest.values()}
+    # Pages embed hashed asset URLs, so a changed asset must change the ETags too
+    state.template_salt = pagecache.template_digest(os.path.join(app.root_path, app.template_folder)) + \
+        ''.join(sorted(built for built, _ in manifest.values()))
+
+@bp.app_url_defaults
+def fingerprint_static(endpoint, values):
+    if endpoint == 'static':
+        entry = get_state().static_manifest.get(values.get('filename'))
+        if entry is not None:
+            values['filename'] = entry[0]
+
+def serve_static(filename):
+    """Flask's static view, plus precompressed and immutable responses for built assets"""
+    sizes = get_state().built_assets.get(filename)
+    if sizes is None:
+        return current_app.send_static_file(filename)
+    encoding = next((e for e in ('br', 'gzip') if e in sizes and e in request.accept_encodings), None)
+    path = filename + {'br': '.br', 'gzip': '.gz', None: ''}[encoding]
+    response = send_from_directory(current_app.static_folder, path, mimetype=mimetypes.guess_type(filename)[0],
+                                   max_age=current_app.config['ASSET_MAX_AGE_SECONDS'])
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+# --- Page cache ---
+# A TTLCache in the AppState; ETags are salted with the templates and asset names
+
+def cached_page(*tables):
+    """Serves a GET page from the page cache while the given tables are unchanged.
+
+    The key is the URL, the session values the templates read, today's date
+    and the tables' data versions, so any write to those tables (in any
+    worker) makes the next view render afresh. The ETag is derived from the
+    key, so a browser holding the current page gets a 304 before anything is
+    looked up or rendered. Requests with pending flash messages bypass it.
+    A miss stores what the view renders under the current versions, so the
+    view must query the database itself rather than read a per-worker cache
+    that may not have seen another worker's write yet.
+    """
+    from functools import wraps
+    def decorator(view):
+        @wraps(view)
+        def decorated_function(*args, **kwargs):
+            if session.get('_flashes'):
+                return view(*args, **kwargs)
+            key = (request.full_path, session.get('user_id'), session.get('user_role'),
+                   session.get('user_name'), session.get('theme'), date.today().isoformat(),
+                   pagecache.versions(get_db(), tables))
+            state = get_state()
+            etag = pagecache.etag(state.template_salt, key)
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                body = state.page_cache.get(key)
+                if body is None:
+                    response = make_response(view(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    state.page_cache.put(key, response.get_data())
+                else:
+                    response = Response(body, mimetype='text/html')
+            response.set_etag(etag)
+            # Revalidate on every view; the 304 makes that cheap
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return decorated_function
+    return decorator
+
 # Routes
-@app.route('/')
+@bp.route('/')
 def index():
     if 'user_id' in session:
         role = session.get('user_role')
         if role == 'admin':
-            return redirect(url_for('admin_panel'))
+            return redirect(url_for('main.admin_panel'))
         elif role == 'delivery':
-            return redirect(url_for('delivery_panel'))
+            return redirect(url_for('main.delivery_panel'))
         elif role == 'van':
-            return redirect(url_for('van_panel'))
-        return redirect(url_for('dashboard'))
-    return redirect(url_for('login'))
+            return redirect(url_for('main.van_panel'))
+        return redirect(url_for('main.dashboard'))
+    return redirect(url_for('main.login'))
 
-@app.route('/register', methods=['GET', 'POST'])
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         name = request.form.get('name', '').strip()
@@ -193,11 +898,15 @@ def register():
         # Validation
         if not name or not email or not phone or not password:
             flash('All fields are required', 'error')
-            return redirect(url_for('register'))
+            return redirect(url_for('main.register'))
 
         if password != confirm_password:
             flash('Passwords do not match', 'error')
-            return redirect(url_for('register'))
+            return redirect(url_for('main.register'))
+
+        if auth_throttled():
+            flash('Too many attempts. Please wait a minute and try again.', 'error')
+            return render_template('register.html'), 429
 
         db = get_db()
 
@@ -205,10 +914,14 @@ def register():
         existing_user = db.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
         if existing_user:
             flash('Email already registered', 'error')
-            return redirect(url_for('register'))
+            return redirect(url_for('main.register'))
 
         # Create user
-        hashed_password = generate_password_hash(password)
+        try:
+            hashed_password = get_state().hash_pool.generate(password)
+        except HashPoolBusy:
+            flash('We are very busy right now. Please try again in a moment.', 'error')
+            return render_template('register.html'), 503
         db.execute(
             'INSERT INTO users (name, email, phone, password, role) VALUES (?, ?, ?, ?, ?)',
             (name, email, phone, hashed_password, 'user')
@@ -216,11 +929,11 @@ def register():
         db.commit()
 
         flash('Registration successful! Please login.', 'success')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
     return render_template('register.html')
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         email = request.form.get('email', '').strip()
@@ -228,37 +941,49 @@ def login():
 
         if not email or not password:
             flash('Email and password are required', 'error')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
+
+        if login_throttled(email):
+            flash('Too many login attempts. Please wait a minute and try again.', 'error')
+            return render_template('login.html'), 429
 
         db = get_db()
         user = db.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
 
-        if user and check_password_hash(user['password'], password):
+        try:
+            password_ok = user is not None and get_state().hash_pool.check(user['password'], password)
+        except HashPoolBusy:
+            flash('We are very busy right now. Please try again in a moment.', 'error')
+            return render_template('login.html'), 503
+
+        if password_ok:
             session['user_id'] = user['id']
             session['user_name'] = user['name']
             session['user_role'] = user['role']
 
             if user['role'] == 'admin':
-                return redirect(url_for('admin_panel'))
+                return redirect(url_for('main.admin_panel'))
             elif user['role'] == 'delivery':
-                return redirect(url_for('delivery_panel'))
+                return redirect(url_for('main.delivery_panel'))
             elif user['role'] == 'van':
-                return redirect(url_for('van_panel'))
-            return redirect(url_for('dashboard'))
+                return redirect(url_for('main.van_panel'))
+            return redirect(url_for('main.dashboard'))
         else:
+            login_failed(email)
             flash('Invalid email or password', 'error')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
 
     return render_template('login.html')
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     session.clear()
     flash('Logged out successfully', 'success')
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
-@app.route('/dashboard')
+@bp.route('/dashboard')
 @login_required
+@cached_page('orders', 'locations')
 def dashboard():
     db = get_db()
     user_id = session['user_id']
@@ -266,18 +991,16 @@ def dashboard():
     
     # Redirect based on role if they hit /dashboard manually
     if user_role == 'delivery':
-        return redirect(url_for('delivery_panel'))
+        return redirect(url_for('main.delivery_panel'))
     elif user_role == 'admin':
-        return redirect(url_for('admin_panel'))
+        return redirect(url_for('main.admin_panel'))
     elif user_role == 'van':
-        return redirect(url_for('van_panel'))
+        return redirect(url_for('main.van_panel'))
 
-    # Get statistics
-    orders = db.execute('SELECT * FROM orders WHERE user_id = ?', (user_id,)).fetchall()
-    total_orders = len(orders)
-    total_spent = sum(order['total_price'] for order in orders)
+    # Get statistics (kept up to date by triggers, see rollups.py)
+    total_orders, _, total_spent = rollups.get(db, 'user', user_id)
 
-    locations_count = db.execute('SELECT COUNT(*) as count FROM locations WHERE user_id = ?', (user_id,)).fetchone()['count']
+    locations_count = db.execute('SELECT COUNT(*) FROM locations WHERE user_id = ?', (user_id,)).fetchone()[0]
 
     # Get recent 5 orders
     recent_orders = db.execute(
@@ -291,7 +1014,7 @@ def dashboard():
                          locations_count=locations_count,
                          recent_orders=recent_orders)
 
-@app.route('/locations', methods=['GET', 'POST'])
+@bp.route('/locations', methods=['GET', 'POST'])
 @login_required
 def locations():
     db = get_db()
@@ -305,7 +1028,7 @@ def locations():
 
         if not label or not address or not city:
             flash('All fields are required', 'error')
-            return redirect(url_for('locations'))
+            return redirect(url_for('main.locations'))
 
         # If setting as default, unset other defaults
         if is_default:
@@ -318,21 +1041,20 @@ def locations():
         db.commit()
 
         flash('Location added successfully', 'success')
-        return redirect(url_for('locations'))
+        return redirect(url_for('main.locations'))
 
-    user_locations = db.execute('SELECT * FROM locations WHERE user_id = ?', (user_id,)).fetchall()
-    return render_template('locations.html', locations=user_locations)
+    return render_template('locations.html', locations=get_user_locations(user_id))
 
-@app.route('/location/<int:location_id>/edit', methods=['GET', 'POST'])
+@bp.route('/location/<int:location_id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_location(location_id):
     db = get_db()
     user_id = session['user_id']
 
-    location = db.execute('SELECT * FROM locations WHERE id = ? AND user_id = ?', (location_id, user_id)).fetchone()
+    location = get_user_location(user_id, location_id)
     if not location:
         flash('Location not found', 'error')
-        return redirect(url_for('locations'))
+        return redirect(url_for('main.locations'))
 
     if request.method == 'POST':
         label = request.form.get('label', '').strip()
@@ -342,7 +1064,7 @@ def edit_location(location_id):
 
         if not label or not address or not city:
             flash('All fields are required', 'error')
-            return redirect(url_for('edit_location', location_id=location_id))
+            return redirect(url_for('main.edit_location', location_id=location_id))
 
         # If setting as default, unset other defaults
         if is_default:
@@ -355,28 +1077,28 @@ def edit_location(location_id):
         db.commit()
 
         flash('Location updated successfully', 'success')
-        return redirect(url_for('locations'))
+        return redirect(url_for('main.locations'))
 
     return render_template('edit_location.html', location=location)
 
-@app.route('/location/<int:location_id>/delete', methods=['POST'])
+@bp.route('/location/<int:location_id>/delete', methods=['POST'])
 @login_required
 def delete_location(location_id):
     db = get_db()
     user_id = session['user_id']
 
-    location = db.execute('SELECT * FROM locations WHERE id = ? AND user_id = ?', (location_id, user_id)).fetchone()
+    location = get_user_location(user_id, location_id)
     if not location:
         flash('Location not found', 'error')
-        return redirect(url_for('locations'))
+        return redirect(url_for('main.locations'))
 
     db.execute('DELETE FROM locations WHERE id = ?', (location_id,))
     db.commit()
 
     flash('Location deleted successfully', 'success')
-    return redirect(url_for('locations'))
+    return redirect(url_for('main.locations'))
 
-@app.route('/order', methods=['GET', 'POST'])
+@bp.route('/order', methods=['GET', 'POST'])
 @login_required
 def order():
     db = get_db()
@@ -389,7 +1111,7 @@ def order():
 
         if not bottle_type or not quantity or not location_id:
             flash('Please fill all fields', 'error')
-            return redirect(url_for('order'))
+            return redirect(url_for('main.order'))
 
         try:
             quantity = int(quantity)
@@ -397,42 +1119,230 @@ def order():
                 raise ValueError
         except ValueError:
             flash('Invalid quantity', 'error')
-            return redirect(url_for('order'))
+            return redirect(url_for('main.order'))
 
-        price_per_unit = 50 if bottle_type == '2 Liter' else 200
-        total_price = price_per_unit * quantity
-        
         # Fetch location details to save with order
-        loc = db.execute('SELECT * FROM locations WHERE id = ?', (location_id,)).fetchone()
-        address = loc['address'] if loc else "Unknown"
-        city = loc['city'] if loc else "Unknown"
+        loc = get_user_location(user_id, location_id)
+        if loc is None:
+            flash('Location not found', 'error')
+            return _order_page(user_id), 400
+        address, city = loc['address'], loc['city']
 
-        db.execute(
+        try:
+            total_price = get_state().pricing.quote(get_db, bottle_type, quantity, city).total_price
+        except UnknownProduct:
+            flash('Invalid bottle type', 'error')
+            return redirect(url_for('main.order'))
+
+        order_id = db.insert(
             'INSERT INTO orders (user_id, bottle_type, quantity, total_price, order_type, status, address, city) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
             (user_id, bottle_type, quantity, total_price, 'single', 'pending', address, city)
         )
+        enqueue_job(db, 'order_status', {'order_ids': [order_id], 'status': 'pending'})
         db.commit()
+        publish_event('single', 'created', {'quantity': quantity, 'bottle_type': bottle_type, 'city': city})
 
         flash('Order placed successfully! Waiting for delivery acceptance.', 'success')
-        return redirect(url_for('order_history'))
+        return redirect(url_for('main.order_history'))
+
+    return _order_page(user_id)
+
+def _order_page(user_id):
+    return render_template('order.html', locations=get_user_locations(user_id), products=get_products())
+
+def _bulk_order_rows(user_id, lines):
+    """Validates bulk order lines. Returns (rows for the INSERT, errors)."""
+    catalog = get_state().pricing.catalog(get_db)
+    locations = {loc['id']: loc for loc in get_user_locations(user_id)}
+    rows, errors = [], []
+    for number, line in enumerate(lines):
+        if not isinstance(line, dict):
+            errors.append({'line': number, 'error': 'Each line must be an object'})
+            continue
+        quantity = line.get('quantity')
+        if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity <= 0:
+            errors.append({'line': number, 'error': 'Invalid quantity'})
+            continue
+        location_id = line.get('location_id')
+        loc = locations.get(location_id) if isinstance(location_id, int) else None
+        if loc is None:
+            errors.append({'line': number, 'error': 'Unknown location_id'})
+            continue
+        try:
+            quote = catalog.quote(line.get('bottle_type'), quantity, loc['city'])
+        except UnknownProduct:
+            errors.append({'line': number, 'error': 'Invalid bottle type'})
+            continue
+        rows.append((user_id, quote.product.bottle_type, quantity, quote.total_price,
+                     'single', 'pending', loc['address'], loc['city']))
+    return rows, errors
+
+def _idempotent_replay(db, user_id, key, request_hash, now):
+    """The stored response to an earlier request with this Idempotency-Key, or None if the key is new"""
+    stored = db.execute(
+        'SELECT request_hash, status_code, response FROM idempotency_keys '
+        'WHERE user_id = ? AND key = ? AND created_at >= ?',
+        (user_id, key, now - current_app.config['IDEMPOTENCY_TTL_SECONDS'])
+    ).fetchone()
+    if stored is None:
+        return None
+    if stored['request_hash'] != request_hash:
+        return jsonify({'error': 'Idempotency-Key was already used for a different request'}), 422
+    response = Response(stored['response'], status=stored['status_code'], mimetype='application/json')
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+@bp.route('/api/orders/bulk', methods=['POST'])
+def bulk_order():
+    """Places many orders from one JSON request.
+
+    Body: {"orders": [{"bottle_type": ..., "quantity": ..., "location_id": ...}, ...]}
+    Either every line is valid and all orders are inserted in one transaction,
+    or nothing is inserted and the errors are returned. With an Idempotency-Key
+    header a retry of the same request returns the first response instead of
+    ordering again.
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'Please login first'}), 401
+    user_id = session['user_id']
+
+    body = request.get_json(silent=True)
+    lines = body.get('orders') if isinstance(body, dict) else None
+    if not isinstance(lines, list) or not lines:
+        return jsonify({'error': 'Expected {"orders": [...]} with at least one line'}), 400
+    max_lines = current_app.config['BULK_ORDER_MAX_LINES']
+    if len(lines) > max_lines:
+        return jsonify({'error': f'At most {max_lines} lines per request'}), 413
 
-    user_locations = db.execute('SELECT * FROM locations WHERE user_id = ?', (user_id,)).fetchall()
-    return render_template('order.html', locations=user_locations)
+    key = request.headers.get('Idempotency-Key', '').strip()
+    if len(key) > 255:
+        return jsonify({'error': 'Idempotency-Key is too long'}), 400
+    request_hash = hashlib.sha256(json.dumps(lines, sort_keys=True).encode()).hexdigest()
 
-@app.route('/order_history')
+    db = get_db()
+    now = time.time()
+    # A retry gets the stored response even if its lines would no longer validate (location deleted, product changed)
+    if key:
+        replay = _idempotent_replay(db, user_id, key, request_hash, now)
+        if replay is not None:
+            db.rollback()
+            return replay
+
+    rows, errors = _bulk_order_rows(user_id, lines)
+    if errors:
+        return jsonify({'error': 'Invalid order lines', 'lines': errors}), 400
+
+    # Exclusive to writers so two retries of one key serialize: the second sees the first's stored response
+    db.begin_write('idempotency_keys')
+    try:
+        if key:
+            db.execute('DELETE FROM idempotency_keys WHERE user_id = ? AND created_at < ?',
+                       (user_id, now - current_app.config['IDEMPOTENCY_TTL_SECONDS']))
+            replay = _idempotent_replay(db, user_id, key, request_hash, now)
+            if replay is not None:
+                db.rollback()
+                return replay
+
+        order_ids = db.insert_many(
+            'INSERT INTO orders (user_id, bottle_type, quantity, total_price, order_type, status, address, city) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            rows
+        )
+        enqueue_job(db, 'order_status', {'order_ids': order_ids, 'status': 'pending'})
+        payload = json.dumps({
+            'created': len(rows),
+            'order_ids': order_ids,
+            'total_price': round(sum(row[3] for row in rows), 2),
+        })
+        if key:
+            db.execute(
+                'INSERT INTO idempotency_keys (user_id, key, request_hash, status_code, response, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (user_id, key, request_hash, 201, payload, now)
+            )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    publish_event('single', 'created', {'quantity': sum(row[2] for row in rows), 'orders': len(rows)})
+    return Response(payload, status=201, mimetype='application/json')
+
+@bp.route('/api/tracking/pings', methods=['POST'])
+def tracking_pings():
+    """Takes a batch of GPS pings from the logged-in delivery boy or van.
+
+    Body: {"pings": [{"lat": ..., "lng": ..., "at": epoch seconds, "speed": m/s, "accuracy": m}, ...]}
+    The pings are buffered and written within TRACKING_FLUSH_SECONDS, so the
+    answer is 202 with the number accepted and dropped as malformed. A 503
+    means the worker's buffer is full and the batch should be sent again
+    after Retry-After.
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'Please login first'}), 401
+    if session.get('user_role') not in ('delivery', 'van'):
+        return jsonify({'error': 'Only riders send pings'}), 403
+
+    body = request.get_json(silent=True)
+    pings = body.get('pings') if isinstance(body, dict) else None
+    if not isinstance(pings, list):
+        return jsonify({'error': 'Expected {"pings": [...]}'}), 400
+    max_batch = current_app.config['TRACKING_MAX_BATCH']
+    if len(pings) > max_batch:
+        return jsonify({'error': f'At most {max_batch} pings per request'}), 413
+
+    rows, rejected = tracking.parse_pings(session['user_id'], pings, time.time())
+    if not get_tracker().record(rows):
+        response = jsonify({'error': 'Too many pings waiting to be written; send them again shortly'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(max(1, round(current_app.config['TRACKING_FLUSH_SECONDS'])))
+        return response
+    return jsonify({'accepted': len(rows), 'rejected': rejected}), 202
+
+@bp.route('/order_history')
 @login_required
 def order_history():
     db = get_db()
     user_id = session['user_id']
 
+    # Live and archived orders; both sides are read through their (user_id, order_date) index
     orders = db.execute(
-        'SELECT * FROM orders WHERE user_id = ? ORDER BY order_date DESC',
-        (user_id,)
+        f'SELECT {archive.SELECT_COLUMNS} FROM orders WHERE user_id = ? '
+        f'UNION ALL SELECT {archive.SELECT_COLUMNS} FROM orders_archive WHERE user_id = ? '
+        'ORDER BY order_date DESC',
+        (user_id, user_id)
     ).fetchall()
 
-    return render_template('order_history.html', orders=orders)
+    return render_template('order_history.html', orders=orders, etas=delivery_etas(db, orders))
 
-@app.route('/subscription', methods=['GET', 'POST'])
+def _schedule_form(form, existing):
+    """The schedule columns posted with the subscription form. Raises ValueError with a message for the user."""
+    frequency = form.get('frequency', 'daily')
+    if frequency not in schedule.FREQUENCIES:
+        raise ValueError('Invalid delivery frequency')
+    try:
+        interval_days = int(form.get('interval_days') or 1)
+        weekdays = sum(1 << int(day) for day in set(form.getlist('weekdays')) if 0 <= int(day) < 7)
+        start_date = date.fromisoformat(form.get('start_date') or date.today().isoformat()).isoformat()
+        end_date = date.fromisoformat(form['end_date']).isoformat() if form.get('end_date') else None
+    except ValueError:
+        raise ValueError('Invalid schedule')
+    if frequency == 'every' and not 1 <= interval_days <= 365:
+        raise ValueError('Deliver every 1 to 365 days')
+    if frequency == 'weekdays' and not weekdays:
+        raise ValueError('Choose at least one delivery day')
+    # Orders are never generated for past days of a new start, only for missed ones
+    if start_date < date.today().isoformat() and not (existing and existing['start_date'] == start_date):
+        raise ValueError('The start date cannot be in the past')
+    if end_date and end_date < start_date:
+        raise ValueError('The end date is before the start date')
+    return {
+        'frequency': frequency,
+        'interval_days': interval_days if frequency == 'every' else 1,
+        'weekdays': weekdays if frequency == 'weekdays' else schedule.ALL_WEEKDAYS,
+        'start_date': start_date,
+        'end_date': end_date,
+    }
+
+@bp.route('/subscription', methods=['GET', 'POST'])
 @login_required
 def subscription():
     db = get_db()
@@ -445,7 +1355,7 @@ def subscription():
 
         if not bottle_type or not quantity or not location_id:
             flash('Please fill all fields', 'error')
-            return redirect(url_for('subscription'))
+            return redirect(url_for('main.subscription'))
 
         try:
             quantity = int(quantity)
@@ -454,74 +1364,321 @@ def subscription():
                 raise ValueError
         except ValueError:
             flash('Invalid input', 'error')
-            return redirect(url_for('subscription'))
+            return redirect(url_for('main.subscription'))
+
+        # Fetch new location details
+        new_loc = get_user_location(user_id, location_id)
+        if new_loc is None:
+            flash('Location not found', 'error')
+            return _subscription_page(db, user_id), 400
+        new_addr, new_city = new_loc['address'], new_loc['city']
+
+        try:
+            total_price = get_state().pricing.quote(get_db, bottle_type, quantity, new_city).total_price
+        except UnknownProduct:
+            flash('Invalid bottle type', 'error')
+            return redirect(url_for('main.subscription'))
 
-        price_per_unit = 50 if bottle_type == '2 Liter' else 200
-        total_price = price_per_unit * quantity
+        existing = db.execute('SELECT id, start_date FROM subscriptions WHERE user_id = ?', (user_id,)).fetchone()
 
-        existing = db.execute('SELECT * FROM subscriptions WHERE user_id = ?', (user_id,)).fetchone()
+        try:
+            plan = _schedule_form(request.form, existing)
+        except ValueError as e:
+            flash(str(e), 'error')
+            return redirect(url_for('main.subscription'))
 
         if existing:
             db.execute(
-                'UPDATE subscriptions SET bottle_type = ?, quantity = ?, total_price = ?, location_id = ? WHERE user_id = ?',
-                (bottle_type, quantity, total_price, location_id, user_id)
+                'UPDATE subscriptions SET bottle_type = ?, quantity = ?, total_price = ?, location_id = ?, '
+                'frequency = ?, interval_days = ?, weekdays = ?, start_date = ?, end_date = ? WHERE user_id = ?',
+                (bottle_type, quantity, total_price, location_id, *plan.values(), user_id)
             )
             flash('Subscription updated successfully!', 'success')
+            # SYNC: the subscription's pending orders for today and later take the new details
+            db.execute('''
+                UPDATE orders
+                SET bottle_type = ?, quantity = ?, total_price = ?, address = ?, city = ?
+                WHERE subscription_id = ?
+                AND status = 'pending'
+                AND delivery_date >= ?
+            ''', (bottle_type, quantity, total_price, new_addr, new_city, existing['id'], date.today().isoformat()))
         else:
             db.execute(
-                'INSERT INTO subscriptions (user_id, bottle_type, quantity, total_price, location_id) VALUES (?, ?, ?, ?, ?)',
-                (user_id, bottle_type, quantity, total_price, location_id)
+                'INSERT INTO subscriptions (user_id, bottle_type, quantity, total_price, location_id, '
+                'frequency, interval_days, weekdays, start_date, end_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (user_id, bottle_type, quantity, total_price, location_id, *plan.values())
             )
             flash('Subscription created successfully!', 'success')
+            # Today's run may already be done, so generate this subscription's order now
+            generate_subscription_orders(db, user_id)
 
-        # SYNC: Update today's pending order if it exists
-        # Fetch new location details
-        new_loc = db.execute('SELECT * FROM locations WHERE id = ?', (location_id,)).fetchone()
-        new_addr = new_loc['address'] if new_loc else "Unknown"
-        new_city = new_loc['city'] if new_loc else "Unknown"
-
-        db.execute('''
-            UPDATE orders 
-            SET bottle_type = ?, quantity = ?, total_price = ?, address = ?, city = ?
-            WHERE user_id = ? 
-            AND status = 'pending' 
-            AND order_type = 'subscription'
-            AND date(order_date) = date('now')
-        ''', (bottle_type, quantity, total_price, new_addr, new_city, user_id))
 
         db.commit()
-        return redirect(url_for('subscription'))
-
-    user_locations = db.execute('SELECT * FROM locations WHERE user_id = ?', (user_id,)).fetchall()
-    current_subscription = db.execute('SELECT * FROM subscriptions WHERE user_id = ?', (user_id,)).fetchone()
+        return redirect(url_for('main.subscription'))
+
+    return _subscription_page(db, user_id)
+
+def _subscription_page(db, user_id):
+    current = get_user_subscription(user_id)
+    pauses, deliveries, plan = [], [], None
+    if current:
+        pauses = db.execute('SELECT id, start_date, end_date FROM subscription_pauses '
+                            'WHERE subscription_id = ? AND end_date >= ? ORDER BY start_date',
+                            (current['id'], date.today().isoformat())).fetchall()
+        deliveries = schedule.upcoming(current, [(p['start_date'], p['end_date']) for p in pauses])
+        plan = schedule.describe(current)
+    return render_template('subscription.html', locations=get_user_locations(user_id),
+                           subscription=current, products=get_products(), plan=plan, pauses=pauses,
+                           deliveries=deliveries, weekday_names=schedule.WEEKDAY_NAMES,
+                           today=date.today().isoformat(), tomorrow=(date.today() + timedelta(days=1)).isoformat())
+
+@bp.route('/subscription/pause', methods=['POST'])
+@login_required
+def add_subscription_pause():
+    db = get_db()
+    current = get_user_subscription(session['user_id'])
+    if not current:
+        flash('Subscription not found', 'error')
+        return redirect(url_for('main.subscription'))
 
-    return render_template('subscription.html', locations=user_locations, subscription=current_subscription)
+    try:
+        start_date = date.fromisoformat(request.form.get('start_date', ''))
+        end_date = date.fromisoformat(request.form.get('end_date', ''))
+    except ValueError:
+        flash('Please enter both pause dates', 'error')
+        return redirect(url_for('main.subscription'))
+    # Today's order was generated already
+    if start_date <= date.today() or end_date < start_date:
+        flash('A pause must start tomorrow or later and end on or after its start', 'error')
+        return redirect(url_for('main.subscription'))
+
+    db.execute('INSERT INTO subscription_pauses (subscription_id, start_date, end_date) VALUES (?, ?, ?)',
+               (current['id'], start_date.isoformat(), end_date.isoformat()))
+    db.commit()
+    flash('Deliveries paused', 'success')
+    return redirect(url_for('main.subscription'))
 
-@app.route('/admin')
+@bp.route('/subscription/pause/<int:pause_id>/delete', methods=['POST'])
+@login_required
+def delete_subscription_pause(pause_id):
+    db = get_db()
+    current = get_user_subscription(session['user_id'])
+    deleted = current and db.execute('DELETE FROM subscription_pauses WHERE id = ? AND subscription_id = ?',
+                                     (pause_id, current['id'])).rowcount
+    db.commit()
+    if deleted:
+        flash('Pause removed', 'success')
+    else:
+        flash('Pause not found', 'error')
+    return redirect(url_for('main.subscription'))
+
+ADMIN_PAGE_SIZE = 50
+
+def _order_filters(args):
+    """Builds the WHERE clause shared by the admin order listings from query args.
+
+    Supports status, order_type, city and an inclusive date_from/date_to range
+    (YYYY-MM-DD). Invalid dates are ignored. Returns (conditions, params, filters).
+    """
+    conditions = []
+    params = []
+    filters = {}
+
+    for column in ('status', 'order_type', 'city'):
+        value = args.get(column, '').strip()
+        if value:
+            conditions.append(f'orders.{column} = ?')
+            params.append(value)
+            filters[column] = value
+
+    for name, condition in (('date_from', 'orders.order_date >= ?'),
+                            ('date_to', 'orders.order_date < ?')):
+        value = args.get(name, '').strip()
+        if value:
+            try:
+                day = date.fromisoformat(value)
+            except ValueError:
+                continue
+            conditions.append(condition)
+            # date_to is inclusive, so compare against the start of the next day
+            params.append((day + timedelta(days=1)).isoformat() if name == 'date_to' else value)
+            filters[name] = value
+
+    return conditions, params, filters
+
+def _parse_order_cursor(value):
+    """Cursor format is '<order_date>|<id>' of the last row on the previous page"""
+    order_date, sep, order_id = (value or '').rpartition('|')
+    if not sep or not order_id.isdigit():
+        return None
+    return order_date, int(order_id)
+
+def count_customers(db):
+    """Number of customer accounts, counted again only after a change to users.
+
+    Kept in the page cache under the users data version, so the new orders
+    that re-render the admin panel don't recount every account.
+    """
+    key = ('count_customers', pagecache.versions(db, ('users',)))
+    state = get_state()
+    count = state.page_cache.get(key)
+    if count is None:
+        count = db.execute("SELECT COUNT(*) FROM users WHERE role = 'user'").fetchone()[0]
+        state.page_cache.put(key, count)
+    return count
+
+@bp.route('/admin')
 @admin_required
+@cached_page('orders', 'users')
 def admin_panel():
     db = get_db()
 
-    users = db.execute('SELECT * FROM users WHERE role = "user"').fetchall()
-
+    # Keyset pagination: each page seeks straight to its position in the
+    # (order_date, id) / id indexes, so page cost doesn't grow with the table.
+    users_after = request.args.get('users_after', type=int)
+    users_sql = "SELECT * FROM users WHERE role = 'user'"
+    users_params = []
+    if users_after:
+        users_sql += ' AND id > ?'
+        users_params.append(users_after)
+    users = db.execute(users_sql + ' ORDER BY id LIMIT ?', users_params + [ADMIN_PAGE_SIZE + 1]).fetchall()
+    next_users_after = users[ADMIN_PAGE_SIZE - 1]['id'] if len(users) > ADMIN_PAGE_SIZE else None
+    users = users[:ADMIN_PAGE_SIZE]
+
+    conditions, params, filters = _order_filters(request.args)
+    cursor = _parse_order_cursor(request.args.get('before'))
+    if cursor:
+        conditions.append('(orders.order_date, orders.id) < (?, ?)')
+        params.extend(cursor)
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
     all_orders = db.execute(
-        'SELECT orders.*, users.name as user_name FROM orders JOIN users ON orders.user_id = users.id ORDER BY orders.order_date DESC'
+        'SELECT orders.*, users.name as user_name FROM orders JOIN users ON orders.user_id = users.id'
+        + where + ' ORDER BY orders.order_date DESC, orders.id DESC LIMIT ?',
+        params + [ADMIN_PAGE_SIZE + 1]
     ).fetchall()
+    next_before = None
+    if len(all_orders) > ADMIN_PAGE_SIZE:
+        last = all_orders[ADMIN_PAGE_SIZE - 1]
+        next_before = f"{last['order_date']}|{last['id']}"
+    all_orders = all_orders[:ADMIN_PAGE_SIZE]
+
+    total_users = count_customers(db)
+    total_orders, _, total_revenue = rollups.get(db, 'total')
+
+    return render_template('admin.html', users=users, orders=all_orders,
+                           total_users=total_users, total_orders=total_orders, total_revenue=total_revenue,
+                           filters=filters, before=request.args.get('before'), users_after=users_after,
+                           next_before=next_before, next_users_after=next_users_after)
+
+# --- Admin exports ---
+EXPORT_COLUMNS = ('id', 'order_date', 'user_id', 'user_name', 'user_email', 'bottle_type', 'quantity',
+                  'total_price', 'order_type', 'status', 'address', 'city', 'delivery_boy_id')
+# Rows per chunk written to the response
+EXPORT_CHUNK_ROWS = 500
+
+def _stream_rows(fmt, columns, rows):
+    """Yields rows as CSV (with header) or NDJSON in chunks, never holding more than one chunk"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(columns)
+    for count, row in enumerate(rows, 1):
+        if writer:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(columns, row))) + '\n')
+        if count % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def _export_response(fmt, filename, body):
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(body), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename={filename}.{fmt}',
+        'Cache-Control': 'no-store',
+    })
+
+SEARCH_PAGE_SIZE = 20
+
+@bp.route('/admin/search')
+@admin_required
+def admin_search():
+    """Prefix search over customers, locations or orders; ?format=json for the API"""
+    query = request.args.get('q', '').strip()
+    kind = request.args.get('kind', 'customers')
+    if kind not in search.RESULTS:
+        kind = 'customers'
+    page = max(request.args.get('page', 1, type=int), 1)
+
+    started = time.perf_counter()
+    results, has_more = search.search(get_db(), kind, query, page, SEARCH_PAGE_SIZE)
+    elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+
+    if request.args.get('format') == 'json':
+        return jsonify({'query': query, 'kind': kind, 'page': page, 'has_more': has_more,
+                        'elapsed_ms': elapsed_ms, 'results': [dict(row) for row in results]})
+    return render_template('admin_search.html', query=query, kind=kind, page=page, results=results,
+                           has_more=has_more, elapsed_ms=elapsed_ms)
+
+@bp.route('/admin/export/orders.<any(csv, ndjson):fmt>')
+@admin_required
+def export_orders(fmt):
+    """Streams live and archived orders joined with users; accepts the admin panel filters"""
+    conditions, params, _ = _order_filters(request.args)
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+    def generate():
+        # The cursors fetch their rows as they are iterated, and merging the
+        # two date-ordered streams keeps memory flat however many orders match
+        db = get_db()
+        cursors = [
+            db.stream(
+                '''SELECT orders.id, orders.order_date, orders.user_id, users.name, users.email, orders.bottle_type,
+                          orders.quantity, orders.total_price, orders.order_type, orders.status, orders.address,
+                          orders.city, orders.delivery_boy_id
+                   FROM ''' + table + ''' AS orders JOIN users ON orders.user_id = users.id'''
+                + where + ' ORDER BY orders.order_date, orders.id',
+                params
+            )
+            for table in ('orders', 'orders_archive')
+        ]
+        rows = heapq.merge(*cursors, key=lambda row: (row[1] or '', row[0]))
+        yield from _stream_rows(fmt, EXPORT_COLUMNS, rows)
 
-    total_revenue = db.execute('SELECT SUM(total_price) as total FROM orders').fetchone()['total'] or 0
+    return _export_response(fmt, 'orders', generate())
 
-    return render_template('admin.html', users=users, orders=all_orders, total_revenue=total_revenue)
+@bp.route('/admin/export/revenue.<any(csv, ndjson):fmt>')
+@admin_required
+def export_revenue(fmt):
+    """Streams revenue totals from the rollups, grouped by ?scope=day|city|bottle_type|user"""
+    scope = request.args.get('scope', 'day')
+    if scope not in rollups.SCOPES or scope == 'total':
+        return Response('scope must be one of day, city, bottle_type, user\n', status=400, mimetype='text/plain')
+
+    def generate():
+        rows = get_db().stream(
+            'SELECT scope_key, order_count, quantity, revenue FROM order_rollups '
+            'WHERE scope = ? AND order_count != 0 ORDER BY scope_key',
+            (scope,)
+        )
+        yield from _stream_rows(fmt, (scope, 'order_count', 'quantity', 'revenue'), rows)
+
+    return _export_response(fmt, f'revenue_by_{scope}', generate())
 
-@app.route('/admin/clear_db', methods=['POST'])
+@bp.route('/admin/clear_db', methods=['POST'])
 @admin_required
 def clear_db():
     db = get_db()
     
     try:
         db.execute('DELETE FROM orders')
+        db.execute('DELETE FROM orders_archive')
+        db.execute('DELETE FROM subscription_pauses')
         db.execute('DELETE FROM subscriptions')
         db.execute('DELETE FROM locations')
-        db.execute('DELETE FROM users WHERE role != "admin" AND role != "delivery" AND role != "van"')
+        db.execute("DELETE FROM users WHERE role != 'admin' AND role != 'delivery' AND role != 'van'")
         db.commit()
         flash('Database refreshed successfully!', 'success')
         
@@ -529,10 +1686,82 @@ def clear_db():
         db.rollback()
         flash(f'An error occurred: {str(e)}', 'error')
         
-    return redirect(url_for('admin_panel'))
+    return redirect(url_for('main.admin_panel'))
+
+@bp.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics for this worker; admin session or METRICS_TOKEN bearer required"""
+    token = current_app.config['METRICS_TOKEN']
+    bearer = request.headers.get('Authorization', '')
+    if not (session.get('user_role') == 'admin' or (token and bearer == f'Bearer {token}')):
+        return Response('Forbidden\n', status=403, mimetype='text/plain')
+
+    state = get_state()
+    extra = []
+    for name in ('hits', 'misses', 'evictions'):
+        extra.append(f'# TYPE aquaflow_cache_{name}_total counter')
+        extra.append(f'aquaflow_cache_{name}_total{{cache="{state.page_cache.name}"}} '
+                     f'{state.page_cache.stats()[name]}')
+
+    # The queue is shared, so every worker reports the same job numbers
+    job_stats = jobs.stats(get_db())
+    extra.append('# TYPE aquaflow_jobs gauge')
+    for status, count in job_stats['depth'].items():
+        extra.append(f'aquaflow_jobs{{status="{status}"}} {count}')
+    extra.append('# TYPE aquaflow_jobs_due gauge')
+    extra.append(f"aquaflow_jobs_due {job_stats['due']}")
+    extra.append('# TYPE aquaflow_jobs_stale gauge')
+    for kind, count in jobs.stale(get_db(), current_app.config['JOB_STALE_SECONDS']).items():
+        extra.append(f'aquaflow_jobs_stale{{kind="{kind}"}} {count}')
+    for name in ('latency', 'run'):
+        extra.append(f'# TYPE aquaflow_job_{name}_seconds summary')
+        for quantile, value in job_stats[f'{name}_seconds'].items():
+            if value is not None:
+                extra.append(f'aquaflow_job_{name}_seconds{{quantile="0.{quantile[1:]}"}} {value:.6f}')
+    return Response(state.metrics.render(extra), mimetype='text/plain; version=0.0.4')
+
+@bp.route('/healthz')
+def healthz():
+    """Liveness: the worker is serving requests. Touches nothing, so a busy database can't fail it."""
+    return jsonify({'status': 'ok'})
+
+@bp.route('/readyz')
+def readyz():
+    """Readiness: the database answers and `flask bootstrap` has brought its schema up to date.
+
+    Also reports the jobs no worker has taken (stale_jobs), e.g. the day's
+    subscription orders when `flask run-jobs` isn't running. Those don't make
+    the web worker unready, so the answer stays 200.
+    """
+    try:
+        db = get_db()
+        version = db.execute('SELECT MAX(version) FROM schema_version').fetchone()[0] \
+            if db.table_exists('schema_version') else None
+        stale = jobs.stale(db, current_app.config['JOB_STALE_SECONDS']) \
+            if version is not None and version >= LATEST_VERSION else {}
+        db.rollback()
+    except backends.DB_ERRORS + (PoolTimeout,) as e:
+        return jsonify({'status': 'unavailable', 'error': str(e)}), 503
+    if version is None or version < LATEST_VERSION:
+        return jsonify({'status': 'bootstrap needed', 'schema_version': version,
+                        'expected_version': LATEST_VERSION}), 503
+    return jsonify({'status': 'ready', 'schema_version': version, 'stale_jobs': stale})
+
+@bp.route('/admin/cache_stats')
+@admin_required
+def cache_stats():
+    state = get_state()
+    return jsonify({state.page_cache.name: state.page_cache.stats()})
+
+@bp.route('/admin/job_stats')
+@admin_required
+def job_stats():
+    db = get_db()
+    return jsonify(dict(jobs.stats(db), stale=jobs.stale(db, current_app.config['JOB_STALE_SECONDS'])))
 
-@app.route('/delivery')
+@bp.route('/delivery')
 @delivery_required
+@cached_page('orders', 'users', 'locations')
 def delivery_panel():
     """DELIVERY BOY: Only sees single (on-demand) orders"""
     db = get_db()
@@ -542,7 +1771,7 @@ def delivery_panel():
         '''SELECT orders.*, users.name as user_name, users.phone, users.email
            FROM orders 
            JOIN users ON orders.user_id = users.id 
-           WHERE orders.status = "pending" AND orders.order_type = "single"
+           WHERE orders.status = 'pending' AND orders.order_type = 'single'
            ORDER BY orders.order_date ASC'''
     ).fetchall()
     
@@ -550,7 +1779,7 @@ def delivery_panel():
         '''SELECT orders.*, users.name as user_name, users.phone, users.email
            FROM orders 
            JOIN users ON orders.user_id = users.id 
-           WHERE orders.status = "out_for_delivery" 
+           WHERE orders.status = 'out_for_delivery' 
            AND orders.delivery_boy_id = ?
            ORDER BY orders.order_date ASC''',
         (delivery_id,)
@@ -560,7 +1789,7 @@ def delivery_panel():
         '''SELECT orders.*, users.name as user_name 
            FROM orders 
            JOIN users ON orders.user_id = users.id 
-           WHERE orders.status = "delivered" AND orders.delivery_boy_id = ?
+           WHERE orders.status = 'delivered' AND orders.delivery_boy_id = ?
            ORDER BY orders.order_date DESC LIMIT 10''',
         (delivery_id,)
     ).fetchall()
@@ -570,8 +1799,34 @@ def delivery_panel():
                          my_deliveries=my_deliveries,
                          my_history=my_history)
 
-@app.route('/van')
+# Number of suggested routes and of pending orders rendered on the van panel
+VAN_ROUTES_SHOWN = 25
+VAN_ORDERS_SHOWN = 200
+
+def plan_van_routes(pending_orders):
+    """Suggested van routes for the pending subscription orders, planned again only after they change.
+
+    Every order placed moves the orders data version and so re-renders the
+    van panel, but the plan depends only on the pending subscription orders
+    and their geocodes. It is kept in the page cache under a digest of those
+    rows, shared by every van.
+    """
+    config = current_app.config
+    digest = hashlib.sha1(repr([(o['id'], o['city'], o['address'], o['bottle_type'], o['quantity'], o['lat'], o['lng'])
+                                for o in pending_orders]).encode()).hexdigest()
+    key = ('van_routes', digest, config['VAN_CAPACITY_LITRES'], config['VAN_MAX_STOPS'])
+    state = get_state()
+    routes = state.page_cache.get(key)
+    if routes is None:
+        geocodes = {(o['city'], o['address']): (o['lat'], o['lng']) for o in pending_orders if o['lat'] is not None}
+        routes = dispatch.plan_batches(dispatch.build_stops(pending_orders, geocodes),
+                                       config['VAN_CAPACITY_LITRES'], config['VAN_MAX_STOPS'])
+        state.page_cache.put(key, routes)
+    return routes
+
+@bp.route('/van')
 @van_required
+@cached_page('orders', 'users', 'locations', 'geocodes')
 def van_panel():
     """DELIVERY VAN: Only sees subscription orders"""
     db = get_db()
@@ -581,18 +1836,22 @@ def van_panel():
     # But before_request handled it.
     
     pending_orders = db.execute(
-        '''SELECT orders.*, users.name as user_name, users.phone, users.email
+        '''SELECT orders.*, users.name as user_name, users.phone, users.email, geocodes.lat, geocodes.lng
            FROM orders 
            JOIN users ON orders.user_id = users.id 
-           WHERE orders.status = "pending" AND orders.order_type = "subscription"
+           LEFT JOIN geocodes ON geocodes.city = orders.city AND geocodes.address = orders.address
+           WHERE orders.status = 'pending' AND orders.order_type = 'subscription'
            ORDER BY orders.order_date ASC'''
     ).fetchall()
+
+    # Suggested routes: van-sized batches of nearby stops, each claimable at once
+    routes = plan_van_routes(pending_orders)
     
     my_deliveries = db.execute(
         '''SELECT orders.*, users.name as user_name, users.phone, users.email
            FROM orders 
            JOIN users ON orders.user_id = users.id 
-           WHERE orders.status = "out_for_delivery" 
+           WHERE orders.status = 'out_for_delivery' 
            AND orders.delivery_boy_id = ?
            ORDER BY orders.order_date ASC''',
         (van_id,)
@@ -602,17 +1861,57 @@ def van_panel():
         '''SELECT orders.*, users.name as user_name 
            FROM orders 
            JOIN users ON orders.user_id = users.id 
-           WHERE orders.status = "delivered" AND orders.delivery_boy_id = ?
+           WHERE orders.status = 'delivered' AND orders.delivery_boy_id = ?
            ORDER BY orders.order_date DESC LIMIT 10''',
         (van_id,)
     ).fetchall()
     
     return render_template('delivery_van.html', 
-                         pending_orders=pending_orders, 
+                         pending_orders=pending_orders[:VAN_ORDERS_SHOWN], 
+                         total_pending=len(pending_orders),
+                         routes=routes[:VAN_ROUTES_SHOWN],
+                         total_routes=len(routes),
                          my_deliveries=my_deliveries,
                          my_history=my_history)
 
-@app.route('/delivery/accept/<int:order_id>', methods=['POST'])
+def _event_stream(channels):
+    """Server-Sent Events response relaying bus events on channels.
+
+    Each stream holds a worker thread, so run gunicorn with -k gthread (or
+    gevent) when riders keep the panels open.
+    """
+    broker = get_broker()
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    if last_id is None:
+        last_id = broker.latest_id()
+    max_seconds = current_app.config['STREAM_MAX_SECONDS']
+
+    def stream(after_id):
+        deadline = time.monotonic() + max_seconds
+        yield 'retry: 3000\n\n'
+        while time.monotonic() < deadline:
+            events = broker.read(channels, after_id, timeout=15)
+            if not events:
+                yield ': keep-alive\n\n'
+                continue
+            for event in events:
+                after_id = event.id
+                yield f'id: {event.id}\nevent: {event.kind}\ndata: {json.dumps(event.data)}\n\n'
+
+    return Response(stream(last_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@bp.route('/delivery/stream')
+@delivery_required
+def delivery_stream():
+    return _event_stream(('single', 'orders'))
+
+@bp.route('/van/stream')
+@van_required
+def van_stream():
+    return _event_stream(('subscription', 'orders'))
+
+@bp.route('/delivery/accept/<int:order_id>', methods=['POST'])
 @login_required
 def accept_order(order_id):
     # Works for both Delivery Boy and Van
@@ -622,24 +1921,82 @@ def accept_order(order_id):
 
     if role not in ['delivery', 'van']:
         flash('Permission denied', 'error')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('main.dashboard'))
     
-    order = db.execute('SELECT status FROM orders WHERE id = ?', (order_id,)).fetchone()
-    if order and order['status'] == 'pending':
-        db.execute(
-            'UPDATE orders SET status = "out_for_delivery", delivery_boy_id = ? WHERE id = ?',
-            (user_id, order_id)
-        )
-        db.commit()
+    # Compare-and-set: only one rider can move the order out of 'pending'
+    claimed = db.execute(
+        "UPDATE orders SET status = 'out_for_delivery', delivery_boy_id = ? WHERE id = ? AND status = 'pending'",
+        (user_id, order_id)
+    ).rowcount
+    if claimed:
+        enqueue_job(db, 'order_status', {'order_ids': [order_id], 'status': 'out_for_delivery'})
+    db.commit()
+    if claimed:
+        publish_event('orders', 'claimed', {'ids': [order_id], 'rider_id': user_id})
         flash('Order accepted! Please deliver it.', 'success')
     else:
         flash('Order is no longer available.', 'error')
         
     if role == 'van':
-        return redirect(url_for('van_panel'))
-    return redirect(url_for('delivery_panel'))
+        return redirect(url_for('main.van_panel'))
+    return redirect(url_for('main.delivery_panel'))
+
+# Upper bound on orders claimed by one batch request (a full van route fits)
+MAX_BATCH_ACCEPT = 500
 
-@app.route('/delivery/complete/<int:order_id>', methods=['POST'])
+@bp.route('/delivery/accept_batch', methods=['POST'])
+@login_required
+def accept_orders_batch():
+    """Claims several pending orders (e.g. a van's whole route) in one transaction"""
+    db = get_db()
+    user_id = session['user_id']
+    role = session['user_role']
+
+    if role not in ['delivery', 'van']:
+        flash('Permission denied', 'error')
+        return redirect(url_for('main.dashboard'))
+
+    panel = 'main.van_panel' if role == 'van' else 'main.delivery_panel'
+
+    try:
+        order_ids = sorted({int(order_id) for order_id in request.form.getlist('order_ids')})
+    except ValueError:
+        flash('Invalid order selection.', 'error')
+        return redirect(url_for(panel))
+
+    if not order_ids:
+        flash('Select at least one order.', 'error')
+        return redirect(url_for(panel))
+    if len(order_ids) > MAX_BATCH_ACCEPT:
+        flash(f'You can accept at most {MAX_BATCH_ACCEPT} orders at once.', 'error')
+        return redirect(url_for(panel))
+
+    # One conditional UPDATE: orders another rider already took are skipped.
+    # RETURNING gives exactly the rows it changed, not ones this rider held already.
+    placeholders = ', '.join('?' * len(order_ids))
+    claimed_ids = sorted(row[0] for row in db.execute(
+        f"UPDATE orders SET status = 'out_for_delivery', delivery_boy_id = ? "
+        f"WHERE status = 'pending' AND id IN ({placeholders}) RETURNING id",
+        [user_id] + order_ids
+    ).fetchall())
+    claimed = len(claimed_ids)
+    if claimed:
+        enqueue_job(db, 'order_status', {'order_ids': claimed_ids, 'status': 'out_for_delivery'})
+    db.commit()
+    if claimed:
+        # Other riders just drop these rows; ids that weren't claimed here are already gone for them too
+        publish_event('orders', 'claimed', {'ids': order_ids, 'rider_id': user_id})
+
+    if claimed == len(order_ids):
+        flash(f'{claimed} orders accepted! Please deliver them.', 'success')
+    elif claimed:
+        flash(f'{claimed} of {len(order_ids)} orders accepted; the rest were taken by someone else.', 'success')
+    else:
+        flash('None of the selected orders are available any more.', 'error')
+
+    return redirect(url_for(panel))
+
+@bp.route('/delivery/complete/<int:order_id>', methods=['POST'])
 @login_required
 def complete_order(order_id):
     # Works for both Delivery Boy and Van
@@ -649,68 +2006,39 @@ def complete_order(order_id):
     
     if role not in ['delivery', 'van']:
         flash('Permission denied', 'error')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('main.dashboard'))
     
-    order = db.execute('SELECT * FROM orders WHERE id = ?', (order_id,)).fetchone()
-    if order and order['delivery_boy_id'] == user_id and order['status'] == 'out_for_delivery':
-        db.execute(
-            'UPDATE orders SET status = "delivered" WHERE id = ?',
-            (order_id,)
-        )
-        db.commit()
+    # Only the rider holding the order can complete it, and only once
+    completed = db.execute(
+        "UPDATE orders SET status = 'delivered' WHERE id = ? AND delivery_boy_id = ? AND status = 'out_for_delivery'",
+        (order_id, user_id)
+    ).rowcount
+    if completed:
+        enqueue_job(db, 'order_status', {'order_ids': [order_id], 'status': 'delivered'})
+    db.commit()
+    if completed:
+        publish_event('orders', 'completed', {'ids': [order_id], 'rider_id': user_id})
         flash('Order marked as delivered! Good job.', 'success')
     else:
         flash('Invalid order operation.', 'error')
         
     if role == 'van':
-        return redirect(url_for('van_panel'))
-    return redirect(url_for('delivery_panel'))
+        return redirect(url_for('main.van_panel'))
+    return redirect(url_for('main.delivery_panel'))
 
-@app.route('/toggle_theme')
+@bp.route('/toggle_theme')
 def toggle_theme():
     current_theme = session.get('theme', 'dark')
     session['theme'] = 'light' if current_theme == 'dark' else 'dark'
     referer = request.referrer
     if referer:
         return redirect(referer)
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
 if __name__ == '__main__':
-    if not os.path.exists(DATABASE):
-        init_db()
-    
-    # MIGRATION logic (your existing code stays)
+    app = create_app()
     with app.app_context():
-        db = get_db()
-        try:
-            db.execute('SELECT delivery_boy_id FROM orders LIMIT 1')
-        except sqlite3.OperationalError:
-            print("Migrating: Adding delivery_boy_id to orders...")
-            try:
-                db.execute('ALTER TABLE orders ADD COLUMN delivery_boy_id INTEGER REFERENCES users(id)')
-                db.commit()
-            except Exception as e: print(f"Migrate Error: {e}")
-
-        try:
-            db.execute('SELECT address FROM orders LIMIT 1')
-        except sqlite3.OperationalError:
-            print("Migrating: Adding address and city to orders...")
-            try:
-                db.execute('ALTER TABLE orders ADD COLUMN address TEXT')
-                db.execute('ALTER TABLE orders ADD COLUMN city TEXT')
-                db.commit()
-            except Exception as e: print(f"Migrate Error: {e}")
-
-        try:
-            db.execute('SELECT last_generated_date FROM subscriptions LIMIT 1')
-        except sqlite3.OperationalError:
-            print("Migrating: Adding last_generated_date to subscriptions...")
-            try:
-                db.execute('ALTER TABLE subscriptions ADD COLUMN last_generated_date TEXT')
-                db.commit()
-            except Exception as e: print(f"Migrate Error: {e}")
-
-        init_db()
+        bootstrap()
 
     # Use Render's PORT environment variable
     port = int(os.environ.get('PORT', 5000))
@@ -0,0 +1,81 @@
+# Order archival: moves old delivered orders out of the live orders table.
+#
+# orders_archive has the same columns as orders and keeps the original ids.
+# Rows move in small batches, each in its own short transaction, so writers
+# are only blocked for one batch at a time. The rollups are all-time totals
+# and include archived orders (see rollups.install_archive).
+
+import time
+
+import rollups
+
+# Column list shared by both tables; SELECT * would depend on the order the
+# legacy ALTER TABLEs added columns in
+COLUMNS = ('id', 'user_id', 'bottle_type', 'quantity', 'total_price', 'order_type', 'status', 'order_date',
+           'delivery_boy_id', 'address', 'city', 'subscription_id', 'delivery_date')
+SELECT_COLUMNS = ', '.join(COLUMNS)
+
+def install(db):
+    """Creates orders_archive and switches the rollups to count it"""
+    db.execute(
+        '''CREATE TABLE IF NOT EXISTS orders_archive (
+               id INTEGER PRIMARY KEY,
+               user_id INTEGER NOT NULL,
+               bottle_type TEXT NOT NULL,
+               quantity INTEGER NOT NULL,
+               total_price REAL NOT NULL,
+               order_type TEXT,
+               status TEXT,
+               order_date TIMESTAMP,
+               delivery_boy_id INTEGER,
+               address TEXT,
+               city TEXT,
+               subscription_id INTEGER,
+               delivery_date TEXT,
+               archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+           )'''
+    )
+    # order_history and the exports read the archive per user and by date
+    db.execute('CREATE INDEX IF NOT EXISTS idx_orders_archive_user_date ON orders_archive (user_id, order_date)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_orders_archive_date ON orders_archive (order_date)')
+    rollups.install_archive(db)
+
+def archive_batch(db, cutoff, batch_size):
+    """Moves up to batch_size delivered orders dated before cutoff. Returns how many moved."""
+    db.commit()
+    db.begin_write('orders')
+    try:
+        ids = [row[0] for row in db.execute(
+            'SELECT id FROM orders WHERE status = ? AND order_date < ? ORDER BY order_date LIMIT ?',
+            ('delivered', cutoff, batch_size)
+        )]
+        if ids:
+            placeholders = ', '.join('?' * len(ids))
+            db.execute(
+                f'INSERT INTO orders_archive ({SELECT_COLUMNS}) '
+                f'SELECT {SELECT_COLUMNS} FROM orders WHERE id IN ({placeholders})',
+                ids
+            )
+            db.execute(f'DELETE FROM orders WHERE id IN ({placeholders})', ids)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return len(ids)
+
+def archive_orders(db, cutoff, batch_size=500, pause=0.05, max_rows=None):
+    """Archives delivered orders dated before cutoff (a 'YYYY-MM-DD' string).
+
+    Sleeps pause seconds between batches so request threads get the write lock.
+    Returns the total number of orders moved.
+    """
+    moved = 0
+    while max_rows is None or moved < max_rows:
+        size = batch_size if max_rows is None else min(batch_size, max_rows - moved)
+        count = archive_batch(db, cutoff, size)
+        moved += count
+        if count < size:
+            break
+        if pause:
+            time.sleep(pause)
+    return moved
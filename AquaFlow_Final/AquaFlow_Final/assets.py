@@ -0,0 +1,158 @@
+# Fingerprinted static assets.
+#
+# build() minifies every CSS, JS and SVG file under static/, writes it to
+# static/dist/ under a name containing a hash of its content (style.css ->
+# style.1a2b3c4d5e.css) and stores gzip and, when the brotli package is
+# installed, brotli copies next to it. A changed file gets a new name, so the
+# built files can be cached by browsers forever; url_for('static', ...) is
+# pointed at them by app.py.
+#
+# `flask bootstrap` (or `flask build-assets`) runs build() once per deploy and
+# it records the result in static/dist/manifest.json; each worker only reads
+# that file with load_manifest().
+#
+# The minifiers only drop comments and whitespace that can't matter. JS keeps
+# its line breaks, so automatic semicolon insertion works as before.
+
+import gzip
+import hashlib
+import json
+import os
+import re
+
+try:
+    import brotli
+except ImportError:  # optional: without it only gzip copies are built
+    brotli = None
+
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+
+_CSS_COMMENT = re.compile(r'/\*.*?\*/', re.S)
+_CSS_STRING = re.compile(r'''("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')''')
+_CSS_SPACE_AROUND = re.compile(r'\s*([{};,>])\s*')
+_CSS_SPACE_AFTER = re.compile(r':\s+')
+
+def minify_css(text):
+    parts = _CSS_STRING.split(_CSS_COMMENT.sub('', text))
+    for i in range(0, len(parts), 2):
+        code = ' '.join(parts[i].split())
+        code = _CSS_SPACE_AROUND.sub(r'\1', code)
+        # Only after a colon: a space before one separates a selector from a pseudo-class
+        code = _CSS_SPACE_AFTER.sub(':', code)
+        parts[i] = code.replace(';}', '}')
+    return ''.join(parts).strip()
+
+# After these characters a / starts a regex literal rather than a division
+_REGEX_PREFIX = set('(,=:[!&|?{};+-*%<>~^')
+
+def minify_js(text):
+    out = []
+    last = ';'  # last non-space character copied, to tell a regex from a division
+    i, n = 0, len(text)
+    while i < n:
+        if out and out[-1].strip():
+            last = out[-1].rstrip()[-1]
+        c = text[i]
+        if c in '\'"`':
+            end = i + 1
+            while end < n and text[end] != c:
+                end += 2 if text[end] == '\\' else 1
+            out.append(text[i:end + 1])
+            i = end + 1
+        elif text.startswith('//', i):
+            i = text.find('\n', i)
+            i = n if i < 0 else i
+        elif text.startswith('/*', i):
+            end = text.find('*/', i + 2)
+            i = n if end < 0 else end + 2
+        elif c == '/' and last in _REGEX_PREFIX:
+            end, in_class = i + 1, False
+            while end < n and (in_class or text[end] != '/') and text[end] != '\n':
+                if text[end] == '\\':
+                    end += 1
+                elif text[end] == '[':
+                    in_class = True
+                elif text[end] == ']':
+                    in_class = False
+                end += 1
+            out.append(text[i:end + 1])
+            i = end + 1
+        else:
+            end = i
+            while end < n and text[end] not in '\'"`/':
+                end += 1
+            if end == i:  # a lone / that is a division
+                end += 1
+            out.append(text[i:end])
+            i = end
+    # Strings were copied whole, so only indentation and blank lines go here;
+    # a template literal spanning lines would lose its indentation, none do
+    lines = (line.strip() for line in ''.join(out).split('\n'))
+    return '\n'.join(line for line in lines if line)
+
+_SVG_COMMENT = re.compile(r'<!--.*?-->', re.S)
+_SVG_BETWEEN_TAGS = re.compile(r'>\s+<')
+
+def minify_svg(text):
+    text = _SVG_COMMENT.sub('', text)
+    return _SVG_BETWEEN_TAGS.sub('><', ' '.join(text.split())).strip()
+
+MINIFIERS = {'.css': minify_css, '.js': minify_js, '.svg': minify_svg}
+
+def _write(path, data):
+    # Several workers may build at once; the content is identical, so the last rename wins harmlessly
+    if os.path.exists(path):
+        return
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def build(static_folder):
+    """Builds static/dist. Returns {source name: (built name, {encoding: size})}."""
+    dist = os.path.join(static_folder, DIST)
+    manifest = {}
+    for root, dirs, files in os.walk(static_folder):
+        if os.path.abspath(root) == os.path.abspath(dist):
+            dirs[:] = []
+            continue
+        dirs.sort()
+        for name in sorted(files):
+            stem, ext = os.path.splitext(name)
+            minify = MINIFIERS.get(ext)
+            if minify is None:
+                continue
+            source = os.path.relpath(os.path.join(root, name), static_folder).replace(os.sep, '/')
+            with open(os.path.join(root, name), encoding='utf-8') as f:
+                data = minify(f.read()).encode()
+            # images/logo.svg -> dist/images/logo.<hash>.svg
+            built = f'{DIST}/{os.path.dirname(source) + "/" if "/" in source else ""}' \
+                    f'{stem}.{hashlib.sha1(data).hexdigest()[:10]}{ext}'
+            path = os.path.join(static_folder, built)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            sizes = {'identity': len(data)}
+            _write(path, data)
+            encoded = {'gzip': gzip.compress(data, 9, mtime=0)}
+            if brotli is not None:
+                encoded['br'] = brotli.compress(data, quality=11)
+            for encoding, body in encoded.items():
+                if len(body) < len(data):
+                    _write(f'{path}.{"gz" if encoding == "gzip" else "br"}', body)
+                    sizes[encoding] = len(body)
+            manifest[source] = (built, sizes)
+    # Always rewritten: unlike the built files its content changes under the same name
+    os.makedirs(dist, exist_ok=True)
+    tmp = os.path.join(dist, f'{MANIFEST}.{os.getpid()}.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, os.path.join(dist, MANIFEST))
+    return manifest
+
+def load_manifest(static_folder):
+    """The manifest written by the last build(), or None if there hasn't been one"""
+    try:
+        with open(os.path.join(static_folder, DIST, MANIFEST)) as f:
+            return {source: tuple(entry) for source, entry in json.load(f).items()}
+    except FileNotFoundError:
+        return None
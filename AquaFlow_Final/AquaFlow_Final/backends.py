@@ -0,0 +1,248 @@
+# Database backends behind get_db(): SQLite (default) or PostgreSQL.
+#
+# The app's SQL is written for SQLite: ? placeholders, INTEGER PRIMARY KEY
+# AUTOINCREMENT, REAL, TIMESTAMP DEFAULT CURRENT_TIMESTAMP and WITHOUT ROWID.
+# PostgresConnection rewrites those on the way through (once per distinct
+# statement), so routes and migrations run unchanged. Timestamps stay
+# 'YYYY-MM-DD HH:MM:SS' text in UTC on both, which is what the templates and
+# keyset cursors expect.
+#
+# What can't be rewritten is a method on both connection types:
+#   dialect                  'sqlite' or 'postgres', for DDL that differs (triggers)
+#   begin_write(*tables)     start a transaction that excludes other writers
+#   insert(sql, params)      execute an INSERT and return the new id
+#   insert_many(sql, rows)   executemany that returns the new ids
+#   stream(sql, params)      a cursor that fetches its rows as they are iterated
+#   table_exists(name), column_names(table)
+#
+# psycopg is imported by the first PostgresPool: it takes longer to import
+# than the rest of the app together, and SQLite deployments never need it.
+# Catch backends.DB_ERRORS (looked up when the exception is raised), which
+# gains psycopg.Error at that point.
+
+import itertools
+import os
+import re
+import sqlite3
+import threading
+
+psycopg = None
+DB_ERRORS = (sqlite3.Error,)
+
+def _load_psycopg():
+    global psycopg, _PsycopgPool, _PsycopgPoolTimeout, DB_ERRORS
+    if psycopg is None:
+        try:
+            import psycopg as module
+            from psycopg_pool import ConnectionPool as _PsycopgPool, PoolTimeout as _PsycopgPoolTimeout
+        except ImportError:
+            raise RuntimeError('DB_BACKEND=postgres needs the psycopg and psycopg_pool packages')
+        psycopg = module
+        DB_ERRORS = (sqlite3.Error, psycopg.Error)
+
+class SQLiteConnection(sqlite3.Connection):
+    """sqlite3 connection with the backend-neutral helpers (pass as factory=)"""
+    dialect = 'sqlite'
+
+    def begin_write(self, *tables):
+        # SQLite has one writer per database; IMMEDIATE takes that lock up front
+        self.execute('BEGIN IMMEDIATE')
+
+    def insert(self, sql, params=()):
+        return self.execute(sql, params).lastrowid
+
+    def insert_many(self, sql, rows):
+        """Only correct inside begin_write(): AUTOINCREMENT ids are then consecutive"""
+        rows = list(rows)
+        self.executemany(sql, rows)
+        last_id = self.execute('SELECT last_insert_rowid()').fetchone()[0]
+        return list(range(last_id - len(rows) + 1, last_id + 1))
+
+    def stream(self, sql, params=()):
+        # A sqlite3 cursor steps through the result as it is iterated
+        return self.execute(sql, params)
+
+    def table_exists(self, name):
+        return self.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+        ).fetchone() is not None
+
+    def column_names(self, table):
+        return [row[1] for row in self.execute(f'PRAGMA table_info({table})')]
+
+# --- PostgreSQL ---
+
+_LITERAL = re.compile(r"('(?:[^']|'')*')")
+_NOW_TEXT = "to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS')"
+_REWRITES = (
+    (re.compile(r'\bINTEGER PRIMARY KEY AUTOINCREMENT\b', re.I), 'SERIAL PRIMARY KEY'),
+    (re.compile(r'\bREAL\b', re.I), 'DOUBLE PRECISION'),
+    (re.compile(r'\bTIMESTAMP\b', re.I), 'TEXT'),
+    (re.compile(r'\bCURRENT_TIMESTAMP\b', re.I), _NOW_TEXT),
+    (re.compile(r'\s*\bWITHOUT ROWID\b', re.I), ''),
+    (re.compile(r'\s*\bCOLLATE NOCASE\b', re.I), ''),
+)
+_translated = {}
+_cursor_names = itertools.count()
+# Rows a server-side cursor fetches per round trip
+STREAM_FETCH_ROWS = 2000
+
+def translate(sql, with_params=True):
+    """Rewrites one SQLite statement for PostgreSQL; string literals are left alone"""
+    key = (sql, with_params)
+    result = _translated.get(key)
+    if result is None:
+        parts = _LITERAL.split(sql)
+        for i in range(0, len(parts), 2):
+            code = parts[i]
+            for pattern, replacement in _REWRITES:
+                code = pattern.sub(replacement, code)
+            if with_params:
+                code = code.replace('%', '%%').replace('?', '%s')
+            parts[i] = code
+        if with_params:
+            # psycopg interpolates the whole string, literals included
+            for i in range(1, len(parts), 2):
+                parts[i] = parts[i].replace('%', '%%')
+        result = _translated[key] = ''.join(parts)
+    return result
+
+class Row(tuple):
+    """Like sqlite3.Row: indexable by position or column name, and dict(row) works"""
+
+    def __new__(cls, values, index):
+        row = tuple.__new__(cls, values)
+        row._index = index
+        return row
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return tuple.__getitem__(self, self._index[key])
+        return tuple.__getitem__(self, key)
+
+    def keys(self):
+        return list(self._index)
+
+def _row_factory(cursor):
+    if cursor.description is None:
+        return tuple
+    index = {column.name: i for i, column in enumerate(cursor.description)}
+    return lambda values: Row(values, index)
+
+class PostgresConnection:
+    dialect = 'postgres'
+
+    def __init__(self, conn):
+        self.raw = conn
+        conn.row_factory = _row_factory
+
+    def execute(self, sql, params=None):
+        if params is None:
+            return self.raw.execute(translate(sql, with_params=False))
+        return self.raw.execute(translate(sql), params)
+
+    def executemany(self, sql, seq_of_params):
+        cursor = self.raw.cursor()
+        cursor.executemany(translate(sql), seq_of_params)
+        return cursor
+
+    def executescript(self, script):
+        # Without parameters psycopg sends the whole script in one simple query
+        return self.raw.execute(translate(script, with_params=False))
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    @property
+    def in_transaction(self):
+        return self.raw.info.transaction_status != psycopg.pq.TransactionStatus.IDLE
+
+    def begin_write(self, *tables):
+        """Starts a transaction that blocks other writers of tables until it ends.
+
+        SHARE ROW EXCLUSIVE conflicts with itself and with row writes but not
+        with plain reads, which is what BEGIN IMMEDIATE gives on SQLite.
+        """
+        if self.in_transaction:
+            self.raw.commit()
+        for table in tables:
+            self.raw.execute(f'LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE')
+
+    def insert(self, sql, params=()):
+        return self.raw.execute(translate(sql) + ' RETURNING id', params).fetchone()[0]
+
+    def insert_many(self, sql, rows):
+        cursor = self.raw.cursor()
+        cursor.executemany(translate(sql) + ' RETURNING id', rows, returning=True)
+        ids = []
+        while True:
+            ids.append(cursor.fetchone()[0])
+            if not cursor.nextset():
+                break
+        return ids
+
+    def stream(self, sql, params=()):
+        """Runs sql in a server-side cursor; a plain one would receive the whole result first"""
+        cursor = self.raw.cursor(f'stream_{next(_cursor_names)}')
+        cursor.itersize = STREAM_FETCH_ROWS
+        cursor.execute(translate(sql), params)
+        return cursor
+
+    def table_exists(self, name):
+        return self.raw.execute('SELECT to_regclass(%s) IS NOT NULL', (name,)).fetchone()[0]
+
+    def column_names(self, table):
+        return [row[0] for row in self.raw.execute(
+            'SELECT column_name FROM information_schema.columns WHERE table_name = %s ORDER BY ordinal_position',
+            (table,)
+        )]
+
+    def close(self):
+        self.raw.close()
+
+class PostgresPool:
+    """Same interface as pool.ConnectionPool, backed by psycopg_pool"""
+
+    def __init__(self, conninfo, size=5, timeout=30):
+        _load_psycopg()
+        self.conninfo = conninfo
+        self.size = size
+        self.timeout = timeout
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        # The pool's worker threads don't survive a fork, so each gunicorn worker opens its own
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._psycopg_pool = _PsycopgPool(self.conninfo, min_size=1, max_size=self.size,
+                                                      timeout=self.timeout, open=True)
+                    self._pid = os.getpid()
+        return self._psycopg_pool
+
+    def acquire(self):
+        from pool import PoolTimeout
+        try:
+            return PostgresConnection(self._pool().getconn())
+        except _PsycopgPoolTimeout:
+            raise PoolTimeout(f'no database connection free after {self.timeout}s (pool size {self.size})')
+
+    def release(self, conn):
+        if self._pid != os.getpid():
+            return
+        try:
+            if conn.in_transaction:
+                # Reads open a transaction too; end it here rather than have the pool warn about it
+                conn.rollback()
+        except psycopg.Error:
+            pass  # putconn discards a broken connection
+        self._pool().putconn(conn.raw)
+
+    def close_all(self):
+        if self._pid == os.getpid():
+            self._psycopg_pool.close()
+            self._pid = None
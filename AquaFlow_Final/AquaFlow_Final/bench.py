@@ -0,0 +1,920 @@
+# Benchmark harness: synthetic data and a route driver.
+#
+#   python bench.py seed --db bench.db --users 2000 --days 90
+#   python bench.py run --db bench.db --duration 30 --out before.json
+#   python bench.py run --db bench.db --routes login_page --duration 10
+#   python bench.py run --url http://127.0.0.1:8000 --threads 16 --out before.json
+#   python bench.py run --db bench.db --url http://127.0.0.1:8000 --threads 32 --routes order,dashboard --duration 10
+#   python bench.py compare before.json after.json --max-regression 10
+#   python bench.py run --url http://127.0.0.1:8000 --threads 32 --rate 250 --routes order,dashboard --baseline before.json
+#   python bench.py backfill --db bench.db --days 30
+#   python bench.py dispatch --orders 50000 --cities 10 --missing 0.05
+#   python bench.py pings --db bench.db --riders 500 --duration 20
+#   python bench.py login-burst --db bench.db --url http://127.0.0.1:8000 --rate 500
+#
+# "run" drives the app in-process through the Flask test client by default.
+# With --url it drives a running server (e.g. gunicorn started with
+# DATABASE=bench.db) over HTTP instead. Only failed logins count against
+# the auth rate limits, so the virtual users can all log in from one address.
+# The order,dashboard run is the connection pool benchmark, against
+#   DATABASE=bench.db WEB_CONCURRENCY=4 WEB_THREADS=4 gunicorn wsgi:app
+# By default the driver is closed-loop: each virtual user sends its next
+# request when the last one is answered, so the mean latency is about
+# threads / req/s and a faster server queues more requests at once. That is
+# why that benchmark of the pool showed p50 36 -> 68 ms while going 292 -> 376 req/s
+# with p99 393 -> 237 ms: before it, a request that met a writer slept in
+# SQLite's busy handler while the others finished at once. Latencies of two
+# servers compare at the same load, so --rate starts that many requests per
+# second whatever the answers take. At --threads 32 --rate 250 the pool
+# took p50 6.6 -> 1.5 ms and p99 43.6 -> 5.8 ms.
+# --baseline and compare --max-regression fail when throughput, mean, p50 or
+# p99 is worse than the baseline's, which must have run the same load.
+# A route that answers 5xx (e.g. "database is locked") counts as an error.
+#
+# With DB_BACKEND=postgres and DATABASE_URL in the environment both commands
+# use that database instead and --db is ignored; seed expects it to be empty.
+#
+# The report is JSON: run metadata plus count, throughput and latency
+# percentiles per route, so two reports can be diffed or compared.
+
+import http.client
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from urllib.parse import urlencode, urlsplit
+
+import click
+
+import app as aquaflow
+import dispatch
+import schedule
+
+BENCH_PASSWORD = 'bench-pass'
+STAFF = {
+    'admin': ('admin@water.com', 'admin123'),
+    'delivery': ('delivery@water.com', 'delivery123'),
+    'van': ('van@water.com', 'van123'),
+}
+# City -> (lat, lng) centre; addresses are scattered a few km around it
+CITIES = {
+    'Karachi': (24.86, 67.01),
+    'Lahore': (31.52, 74.36),
+    'Islamabad': (33.68, 73.05),
+    'Faisalabad': (31.42, 73.08),
+    'Multan': (30.16, 71.52),
+}
+# Relative weight of each route in the request mix
+ROUTE_MIX = {
+    'login': 2,
+    'dashboard': 15,
+    'order': 10,
+    'order_history': 15,
+    'subscription': 5,
+    'delivery_panel': 10,
+    'van_panel': 5,
+    'accept_order': 10,
+    'admin_panel': 5,
+    # GET /login: the cheapest page, i.e. the fixed cost of every request; only driven when named in --routes
+    'login_page': 0,
+}
+
+def _postgres():
+    return os.environ.get('DB_BACKEND') == 'postgres'
+
+def _load_app(db_path, overrides=None):
+    # Settings already in the environment win over the harness's overrides
+    return aquaflow.create_app({'DATABASE': db_path,
+                                **{key: value for key, value in (overrides or {}).items() if key not in os.environ}})
+
+# --- Data generator ---
+
+def _random_schedule(rng, start):
+    """A subscription schedule: mostly daily, the rest every few days or on a few weekdays"""
+    plan = {'frequency': 'daily', 'interval_days': 1, 'weekdays': schedule.ALL_WEEKDAYS,
+            'start_date': start.isoformat(), 'end_date': None}
+    kind = rng.random()
+    if kind < 0.2:
+        plan.update(frequency='every', interval_days=rng.randint(2, 4))
+    elif kind < 0.4:
+        plan.update(frequency='weekdays', weekdays=sum(1 << day for day in rng.sample(range(7), rng.randint(2, 5))))
+    if rng.random() < 0.05:
+        plan['end_date'] = (start + timedelta(days=rng.randint(0, 120))).isoformat()
+    return plan
+
+def _chunks(rows, size=5000):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+@click.group()
+def cli():
+    """AquaFlow benchmark harness."""
+
+@cli.command()
+@click.option('--db', 'db_path', default='bench.db', show_default=True, help='Database file to create.')
+@click.option('--users', default=1000, show_default=True, help='Customer accounts.')
+@click.option('--days', default=90, show_default=True, help='Days of order history.')
+@click.option('--orders-per-day', default=0.2, show_default=True, help='Single orders per customer per day.')
+@click.option('--subscribers', default=0.3, show_default=True, help='Share of customers with a subscription.')
+@click.option('--pending', default=500, show_default=True, help="Pending single orders placed today.")
+@click.option('--seed', default=1, show_default=True, help='Random seed.')
+@click.option('--force', is_flag=True, help='Replace the database if it exists.')
+def seed(db_path, users, days, orders_per_day, subscribers, pending, seed, force):
+    """Create a database with synthetic customers, locations, subscriptions and orders."""
+    if not _postgres() and os.path.exists(db_path):
+        if not force:
+            raise click.ClickException(f"{db_path} exists; use --force to replace it")
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+
+    rng = random.Random(seed)
+    app = _load_app(db_path)
+    from werkzeug.security import generate_password_hash
+    started = time.perf_counter()
+    with app.app_context():
+        aquaflow.bootstrap()
+        db = aquaflow.get_db()
+        catalog = aquaflow.get_state().pricing.catalog(aquaflow.get_db)
+        bottle_types = list(catalog.products)
+        rider_id = db.execute("SELECT id FROM users WHERE role = 'delivery'").fetchone()[0]
+        van_id = db.execute("SELECT id FROM users WHERE role = 'van'").fetchone()[0]
+
+        # One hash for everyone: hashing per user would dominate seeding time
+        password = generate_password_hash(BENCH_PASSWORD)
+        first_user = db.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM users').fetchone()[0]
+        db.executemany(
+            'INSERT INTO users (id, name, email, phone, password, role) VALUES (?, ?, ?, ?, ?, ?)',
+            ((first_user + i, f'Customer {i}', f'user{i}@bench.test', f'0300{i:07d}', password, 'user')
+             for i in range(users))
+        )
+        user_ids = range(first_user, first_user + users)
+
+        locations = {}
+        geocodes = {}
+        location_rows = []
+        next_location = db.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM locations').fetchone()[0]
+        for user_id in user_ids:
+            for n in range(rng.choice((1, 1, 2, 3))):
+                city = rng.choice(list(CITIES))
+                address = f'House {rng.randint(1, 400)}, Street {rng.randint(1, 60)}'
+                location_rows.append((next_location, user_id, ('Home', 'Office', 'Shop')[n], address, city, int(n == 0)))
+                locations.setdefault(user_id, []).append((next_location, address, city))
+                lat, lng = CITIES[city]
+                geocodes[(city, address)] = (lat + rng.uniform(-0.05, 0.05), lng + rng.uniform(-0.05, 0.05))
+                next_location += 1
+        db.executemany('INSERT INTO locations (id, user_id, label, address, city, is_default) VALUES (?, ?, ?, ?, ?, ?)',
+                       location_rows)
+        db.executemany('INSERT INTO geocodes (city, address, lat, lng) VALUES (?, ?, ?, ?) ON CONFLICT DO NOTHING',
+                       ((city, address, lat, lng) for (city, address), (lat, lng) in geocodes.items()))
+        if db.dialect == 'postgres':
+            # Explicit ids don't advance the SERIAL sequences
+            for table in ('users', 'locations'):
+                db.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT MAX(id) FROM {table}))")
+
+        today = date.today()
+        subscriptions = []
+        for user_id in rng.sample(list(user_ids), int(users * subscribers)):
+            location_id, address, city = locations[user_id][0]
+            bottle_type = rng.choice(bottle_types)
+            quantity = rng.randint(1, 5)
+            total = catalog.quote(bottle_type, quantity, city).total_price
+            plan = _random_schedule(rng, today - timedelta(days=days))
+            pauses = []
+            if rng.random() < 0.05:
+                pause_start = today + timedelta(days=rng.randint(-days, 14))
+                pauses.append((pause_start.isoformat(), (pause_start + timedelta(days=rng.randint(2, 10))).isoformat()))
+            subscriptions.append((user_id, bottle_type, quantity, total, location_id, address, city, plan, pauses))
+        # History is generated below, so every watermark is yesterday
+        db.executemany(
+            'INSERT INTO subscriptions (user_id, bottle_type, quantity, total_price, location_id, frequency, '
+            'interval_days, weekdays, start_date, end_date, last_generated_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (s[:5] + tuple(s[7].values()) + ((today - timedelta(days=1)).isoformat(),) for s in subscriptions)
+        )
+        subscription_ids = dict(db.execute('SELECT user_id, id FROM subscriptions'))
+        db.executemany('INSERT INTO subscription_pauses (subscription_id, start_date, end_date) VALUES (?, ?, ?)',
+                       ((subscription_ids[s[0]], start, end) for s in subscriptions for start, end in s[8]))
+
+        def history():
+            for day in range(days, 0, -1):
+                day_date = today - timedelta(days=day)
+                for user_id in user_ids:
+                    if rng.random() < orders_per_day:
+                        location_id, address, city = rng.choice(locations[user_id])
+                        bottle_type = rng.choice(bottle_types)
+                        quantity = rng.randint(1, 6)
+                        stamp = datetime.combine(day_date, datetime.min.time()) + timedelta(seconds=rng.randint(25200, 75600))
+                        yield (user_id, bottle_type, quantity, catalog.quote(bottle_type, quantity, city).total_price,
+                               'single', 'delivered', stamp.strftime('%Y-%m-%d %H:%M:%S'), address, city,
+                               rider_id, None, None)
+                for user_id, bottle_type, quantity, total, _, address, city, plan, pauses in subscriptions:
+                    if not schedule.is_due(plan, day_date, pauses):
+                        continue
+                    yield (user_id, bottle_type, quantity, total, 'subscription', 'delivered',
+                           f'{day_date.isoformat()} 06:00:00', address, city, van_id,
+                           subscription_ids[user_id], day_date.isoformat())
+            for _ in range(pending):
+                user_id = rng.choice(user_ids)
+                location_id, address, city = rng.choice(locations[user_id])
+                bottle_type = rng.choice(bottle_types)
+                quantity = rng.randint(1, 6)
+                yield (user_id, bottle_type, quantity, catalog.quote(bottle_type, quantity, city).total_price,
+                       'single', 'pending', datetime.now().strftime('%Y-%m-%d %H:%M:%S'), address, city,
+                       None, None, None)
+
+        order_count = 0
+        for batch in _chunks(history()):
+            db.executemany(
+                '''INSERT INTO orders (user_id, bottle_type, quantity, total_price, order_type, status, order_date,
+                                      address, city, delivery_boy_id, subscription_id, delivery_date)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                batch
+            )
+            order_count += len(batch)
+        db.commit()
+        generated = aquaflow.generate_subscription_orders(db)
+        aquaflow.claim_daily_run(db, today.isoformat())
+        db.commit()
+        db.execute('ANALYZE')
+
+    print(f"Seeded {'DATABASE_URL' if _postgres() else db_path}: {users} customers, {len(location_rows)} locations, "
+          f"{len(subscriptions)} subscriptions, {order_count + generated} orders "
+          f"in {time.perf_counter() - started:.1f}s")
+
+# --- Driver ---
+
+class TestClientSession:
+    """One virtual user on the Flask test client"""
+
+    def __init__(self, app, headers=None):
+        self.client = app.test_client()
+        self.headers = headers or {}
+
+    def get(self, path):
+        return self.client.get(path, headers=self.headers).status_code
+
+    def post(self, path, data=None):
+        return self.client.post(path, data=data or {}, headers=self.headers).status_code
+
+    def post_json(self, path, payload):
+        return self.client.post(path, json=payload, headers=self.headers).status_code
+
+class HTTPSession:
+    """One virtual user talking to a running server, keeping its session cookie"""
+
+    def __init__(self, base_url, headers=None):
+        parts = urlsplit(base_url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.conn = None
+        self.cookies = {}
+        self.headers = headers or {}
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _request(self, method, path, body=None, content_type='application/x-www-form-urlencoded'):
+        headers = dict(self.headers)
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{k}={v}' for k, v in self.cookies.items())
+        if body is not None:
+            body = urlencode(body) if content_type == 'application/x-www-form-urlencoded' else body
+            headers['Content-Type'] = content_type
+        for attempt in (0, 1):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            try:
+                self.conn.request(method, path, body, headers)
+                response = self.conn.getresponse()
+                response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                # Keep-alive connection dropped by the server; reconnect once
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+        for header in response.headers.get_all('Set-Cookie') or ():
+            name, _, value = header.split(';', 1)[0].partition('=')
+            self.cookies[name.strip()] = value
+        return response.status
+
+    def get(self, path):
+        return self._request('GET', path)
+
+    def post(self, path, data=None):
+        return self._request('POST', path, data or {})
+
+    def post_json(self, path, payload):
+        return self._request('POST', path, json.dumps(payload), 'application/json')
+
+class Driver:
+    def __init__(self, make_session, pending_ids, mix=ROUTE_MIX):
+        self.make_session = make_session
+        self.pending_ids = deque(pending_ids)
+        self.mix = mix
+        self.measure_after = self.deadline = None
+        # Seconds between one worker's requests with --rate; None sends the next as soon as the last is answered
+        self.interval = None
+        self.lock = threading.Lock()
+        self.samples = {route: [] for route in mix}
+        self.errors = {route: 0 for route in mix}
+
+    def login(self, email, password):
+        session = self.make_session()
+        session.post('/login', {'email': email, 'password': password})
+        return session
+
+    def next_pending(self):
+        with self.lock:
+            return self.pending_ids.popleft() if self.pending_ids else None
+
+    def worker(self, customers, ready, seed):
+        rng = random.Random(seed)
+        routes, weights = zip(*self.mix.items())
+        # Log everyone in before the clock starts; the login route is measured separately
+        staff = {role: self.login(*STAFF[role]) for role in STAFF}
+        sessions = [(user, self.login(user['email'], BENCH_PASSWORD)) for user in customers]
+        ready.wait()
+        deadline, measure_after, interval = self.deadline, self.measure_after, self.interval
+        due = time.perf_counter() + rng.random() * (interval or 0)
+
+        while time.perf_counter() < deadline:
+            route = rng.choices(routes, weights)[0]
+            user, session = rng.choice(sessions)
+            if interval:
+                pause = due - time.perf_counter()
+                if pause > 0:
+                    time.sleep(pause)
+                # Timed from when the request was due, so falling behind counts as latency
+                started, due = due, due + interval
+            else:
+                started = time.perf_counter()
+            if route == 'login':
+                status = self.make_session().post('/login', {'email': user['email'], 'password': BENCH_PASSWORD})
+            elif route == 'login_page':
+                status = session.get('/login')
+            elif route == 'dashboard':
+                status = session.get('/dashboard')
+            elif route == 'order':
+                status = session.post('/order', {'bottle_type': rng.choice(user['bottle_types']),
+                                                 'quantity': rng.randint(1, 6),
+                                                 'location_id': rng.choice(user['location_ids'])})
+            elif route == 'order_history':
+                status = session.get('/order_history')
+            elif route == 'subscription':
+                status = session.post('/subscription', {'bottle_type': rng.choice(user['bottle_types']),
+                                                        'quantity': rng.randint(1, 5),
+                                                        'location_id': user['location_ids'][0]})
+            elif route == 'delivery_panel':
+                status = staff['delivery'].get('/delivery')
+            elif route == 'van_panel':
+                status = staff['van'].get('/van')
+            elif route == 'accept_order':
+                order_id = self.next_pending()
+                if order_id is None:
+                    continue
+                status = staff['delivery'].post(f'/delivery/accept/{order_id}')
+            else:
+                status = staff['admin'].get('/admin')
+            elapsed = time.perf_counter() - started
+            if started < measure_after:
+                continue
+            with self.lock:
+                self.samples[route].append(elapsed)
+                if status >= 400:
+                    self.errors[route] += 1
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def _summary(samples, errors, seconds):
+    values = sorted(samples)
+    ms = lambda v: None if v is None else round(v * 1000, 3)
+    return {
+        'count': len(values),
+        'errors': errors,
+        'rps': round(len(values) / seconds, 2) if seconds else None,
+        'mean_ms': ms(sum(values) / len(values)) if values else None,
+        'p50_ms': ms(_percentile(values, 50)),
+        'p90_ms': ms(_percentile(values, 90)),
+        'p99_ms': ms(_percentile(values, 99)),
+        'max_ms': ms(values[-1]) if values else None,
+    }
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+@cli.command()
+@click.option('--db', 'db_path', default='bench.db', show_default=True, help='Seeded database to read users from.')
+@click.option('--url', help='Drive a running server instead of the in-process test client.')
+@click.option('--duration', default=20.0, show_default=True, help='Measured seconds.')
+@click.option('--warmup', default=3.0, show_default=True, help='Seconds before measuring starts.')
+@click.option('--threads', default=1, show_default=True, help='Concurrent virtual users.')
+@click.option('--rate', type=float, help='Requests started per second, shared by the threads (open-loop).')
+@click.option('--customers', default=50, show_default=True, help='Distinct customers the driver logs in as.')
+@click.option('--routes', help='Comma-separated routes to drive instead of the whole mix, e.g. order,dashboard.')
+@click.option('--seed', default=1, show_default=True, help='Random seed.')
+@click.option('--out', type=click.Path(dir_okay=False), help='Write the JSON report here instead of stdout.')
+@click.option('--baseline', type=click.File('r'), help='Report of an earlier run to check this one against.')
+@click.option('--max-regression', default=10.0, show_default=True,
+              help='With --baseline: fail if throughput, mean, p50 or p99 is this many percent worse.')
+def run(db_path, url, duration, warmup, threads, rate, customers, routes, seed, out, baseline, max_regression):
+    """Drive every main route and report latency and throughput per route."""
+    if not _postgres() and not os.path.exists(db_path):
+        raise click.ClickException(f"{db_path} not found; create it with 'python bench.py seed'")
+    mix = {route: weight for route, weight in ROUTE_MIX.items() if weight}
+    if routes:
+        names = [name.strip() for name in routes.split(',') if name.strip()]
+        unknown = sorted(set(names) - set(ROUTE_MIX))
+        if unknown:
+            raise click.ClickException(f"Unknown routes {', '.join(unknown)}; choose from {', '.join(ROUTE_MIX)}")
+        # Named routes keep their relative weights; a route outside the default mix counts as 1
+        mix = {name: ROUTE_MIX[name] or 1 for name in names}
+    app = _load_app(db_path, {'AUTH_IP_PER_MINUTE': 1000000, 'AUTH_IP_BURST': 1000000,
+                              'AUTH_EMAIL_PER_MINUTE': 1000000, 'AUTH_EMAIL_BURST': 1000000})
+
+    with app.app_context():
+        db = aquaflow.get_db()
+        bottle_types = list(aquaflow.get_state().pricing.catalog(aquaflow.get_db).products)
+        location_ids = {}
+        for email, location_id in db.execute(
+            '''SELECT u.email, l.id FROM users u
+               JOIN locations l ON l.user_id = u.id
+               WHERE u.role = 'user' AND u.email LIKE '%@bench.test'
+                 AND u.id IN (SELECT id FROM users WHERE role = 'user' AND email LIKE '%@bench.test'
+                              ORDER BY id LIMIT ?)
+               ORDER BY u.id, l.id''', (customers,)
+        ):
+            location_ids.setdefault(email, []).append(location_id)
+        pending_ids = [r[0] for r in db.execute(
+            '''SELECT id FROM orders WHERE status = 'pending' AND order_type = 'single' ORDER BY id''')]
+        scale = {
+            'users': db.execute("SELECT COUNT(*) FROM users WHERE role = 'user'").fetchone()[0],
+            'orders': db.execute('SELECT COUNT(*) FROM orders').fetchone()[0],
+            'subscriptions': db.execute('SELECT COUNT(*) FROM subscriptions').fetchone()[0],
+        }
+    if not location_ids:
+        raise click.ClickException(f"{db_path} has no benchmark customers; seed it with 'python bench.py seed'")
+    users = [{'email': email, 'location_ids': ids, 'bottle_types': bottle_types}
+             for email, ids in location_ids.items()]
+
+    if url:
+        make_session = lambda: HTTPSession(url)
+    else:
+        make_session = lambda: TestClientSession(app)
+
+    rng = random.Random(seed)
+    rng.shuffle(pending_ids)
+    driver = Driver(make_session, pending_ids, mix)
+    if rate:
+        driver.interval = threads / rate
+
+    def start_clock():
+        driver.measure_after = time.perf_counter() + warmup
+        driver.deadline = driver.measure_after + duration
+
+    ready = threading.Barrier(threads, action=start_clock)
+    workers = [threading.Thread(target=driver.worker, args=(users[n::threads] or users, ready, seed + n))
+               for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    measured = time.perf_counter() - driver.measure_after
+
+    all_samples = [s for samples in driver.samples.values() for s in samples]
+    report = {
+        'meta': {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'revision': _git_revision(),
+            'target': url or 'test-client',
+            'backend': os.environ.get('DB_BACKEND', 'sqlite'),
+            'python': platform.python_version(),
+            'threads': threads,
+            'rate': rate,
+            'duration_s': round(measured, 2),
+            'warmup_s': warmup,
+            'seed': seed,
+            'routes': list(mix),
+            'scale': scale,
+        },
+        'total': _summary(all_samples, sum(driver.errors.values()), measured),
+        'routes': {route: _summary(driver.samples[route], driver.errors[route], measured) for route in mix},
+    }
+    text = json.dumps(report, indent=2)
+    if out:
+        with open(out, 'w') as f:
+            f.write(text + '\n')
+        print(f"Wrote {out}: {report['total']['count']} requests, {report['total']['rps']} req/s", file=sys.stderr)
+    else:
+        print(text)
+    if baseline:
+        _check_baseline(json.load(baseline), report, max_regression)
+
+@cli.command()
+@click.option('--db', 'db_path', default='bench.db', show_default=True, help='Seeded database file.')
+@click.option('--days', default=30, show_default=True, help='Days to backfill.')
+@click.option('--batch-size', type=int, help='Subscriptions per transaction (default SUBSCRIPTION_BATCH_SIZE).')
+def backfill(db_path, days, batch_size):
+    """Time catching up --days days of subscription orders at once, as after an outage.
+
+    Rewinds every subscription's watermark by --days and deletes the
+    subscription orders of those days first, so it rewrites the database.
+    Meanwhile a second connection takes the write lock every 10 ms, as a
+    request placing an order would, and the longest it waited is reported.
+    The regenerated orders are checked against schedule.is_due() day by day.
+    """
+    config = {'SUBSCRIPTION_BACKFILL_DAYS': days}
+    if batch_size:
+        config['SUBSCRIPTION_BATCH_SIZE'] = batch_size
+    app = _load_app(db_path, config)
+    today = date.today()
+    rewind = (today - timedelta(days=days)).isoformat()
+
+    with app.app_context():
+        db = aquaflow.get_db()
+        db.execute('DELETE FROM orders WHERE subscription_id IS NOT NULL AND delivery_date > ?', (rewind,))
+        db.execute('UPDATE subscriptions SET last_generated_date = ?', (rewind,))
+        db.commit()
+        count = db.execute('SELECT COUNT(*) FROM subscriptions').fetchone()[0]
+
+        stop = threading.Event()
+        waits = []
+
+        def writer():
+            conn = sqlite3.connect(db_path, timeout=600, isolation_level=None)
+            while not stop.wait(0.01):
+                asked = time.perf_counter()
+                conn.execute('BEGIN IMMEDIATE')
+                waits.append(time.perf_counter() - asked)
+                conn.execute('ROLLBACK')
+            conn.close()
+
+        probe = threading.Thread(target=writer)
+        probe.start()
+        started = time.perf_counter()
+        try:
+            created = aquaflow.generate_subscription_orders(db)
+        finally:
+            seconds = time.perf_counter() - started
+            stop.set()
+            probe.join()
+        print(f"Generated {created} orders for {count} subscriptions x {days} days in {seconds:.2f}s "
+              f"({created / seconds:,.0f} orders/s)")
+        print(f"A concurrent writer waited at most {max(waits, default=0) * 1000:.0f} ms for the write lock "
+              f"({len(waits)} writes)")
+
+        subscriptions = db.execute('SELECT * FROM subscriptions').fetchall()
+        pauses = {}
+        for row in db.execute('SELECT subscription_id, start_date, end_date FROM subscription_pauses'):
+            pauses.setdefault(row[0], []).append((row[1], row[2]))
+        mismatched = 0
+        for n in range(days):
+            day = today - timedelta(days=days - 1 - n)
+            expected = {s['id'] for s in subscriptions if schedule.is_due(s, day, pauses.get(s['id'], ()))}
+            actual = {row[0] for row in db.execute(
+                'SELECT subscription_id FROM orders WHERE subscription_id IS NOT NULL AND delivery_date = ?',
+                (day.isoformat(),))}
+            mismatched += len(expected ^ actual)
+        if mismatched:
+            raise click.ClickException(f'{mismatched} (subscription, day) pairs differ from the schedules')
+        print('Every generated order matches the schedules.')
+
+@cli.command()
+@click.option('--db', 'db_path', default='bench.db', show_default=True, help='Seeded database file.')
+@click.option('--url', help='Drive a running server instead of the in-process test client.')
+@click.option('--riders', default=500, show_default=True, help='Delivery accounts sending pings.')
+@click.option('--batch', default=10, show_default=True, help='Pings per request.')
+@click.option('--duration', default=20.0, show_default=True, help='Seconds of sending.')
+@click.option('--threads', default=4, show_default=True, help='Concurrent senders.')
+def pings(db_path, url, riders, batch, duration, threads):
+    """Load test of rider GPS ingest: pings/s accepted, request latency, and every ping reaching rider_pings.
+
+    Creates rider<n>@bench.test delivery accounts as needed. Each request is
+    one rider's batch of --batch pings, as a phone sends after buffering them.
+    """
+    app = _load_app(db_path, {'AUTH_IP_PER_MINUTE': 1000000, 'AUTH_IP_BURST': 1000000})
+    from werkzeug.security import generate_password_hash
+
+    with app.app_context():
+        db = aquaflow.get_db()
+        password = generate_password_hash(BENCH_PASSWORD)
+        db.executemany(
+            'INSERT INTO users (name, email, phone, password, role) VALUES (?, ?, ?, ?, ?) ON CONFLICT DO NOTHING',
+            [(f'Rider {n}', f'rider{n}@bench.test', f'0311{n:07d}', password, 'delivery') for n in range(riders)]
+        )
+        db.commit()
+        rider_ids = [r[0] for r in db.execute(
+            "SELECT id FROM users WHERE role = 'delivery' AND email LIKE 'rider%@bench.test' ORDER BY id LIMIT ?",
+            (riders,))]
+        count_sql = f"SELECT COUNT(*) FROM rider_pings WHERE rider_id IN ({', '.join('?' for _ in rider_ids)})"
+        before = db.execute(count_sql, rider_ids).fetchone()[0]
+
+    make_session = (lambda: HTTPSession(url)) if url else (lambda: TestClientSession(app))
+    lock = threading.Lock()
+    latencies, totals = [], {'accepted': 0, 'requests': 0, 'busy': 0, 'errors': 0}
+
+    def sender(numbers, ready, seed):
+        rng = random.Random(seed)
+        centre = list(CITIES.values())[seed % len(CITIES)]
+        riders = []
+        for n in numbers:
+            session = make_session()
+            session.post('/login', {'email': f'rider{n}@bench.test', 'password': BENCH_PASSWORD})
+            riders.append([session, centre[0] + rng.uniform(-0.05, 0.05), centre[1] + rng.uniform(-0.05, 0.05), 0.0])
+        ready.wait()
+        samples, accepted, busy, errors = [], 0, 0, 0
+        while time.perf_counter() < deadline:
+            rider = rng.choice(riders)
+            session, lat, lng, last = rider
+            batch_pings = []
+            for _ in range(batch):
+                # Strictly increasing per rider, so every ping is a new (rider, time) row
+                last = max(time.time(), last + 0.001)
+                lat += rng.uniform(-0.0002, 0.0002)
+                lng += rng.uniform(-0.0002, 0.0002)
+                batch_pings.append({'lat': lat, 'lng': lng, 'at': last, 'speed': rng.uniform(0, 12),
+                                    'accuracy': rng.uniform(3, 30)})
+            rider[1:] = lat, lng, last
+            started = time.perf_counter()
+            status = session.post_json('/api/tracking/pings', {'pings': batch_pings})
+            samples.append(time.perf_counter() - started)
+            if status == 202:
+                accepted += batch
+            elif status == 503:
+                busy += 1
+            else:
+                errors += 1
+        with lock:
+            latencies.extend(samples)
+            totals['accepted'] += accepted
+            totals['requests'] += len(samples)
+            totals['busy'] += busy
+            totals['errors'] += errors
+
+    def start_clock():
+        nonlocal deadline, started
+        started = time.perf_counter()
+        deadline = started + duration
+
+    deadline = started = None
+    ready = threading.Barrier(threads, action=start_clock)
+    numbers = list(range(len(rider_ids)))
+    workers = [threading.Thread(target=sender, args=(numbers[n::threads], ready, n)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    seconds = time.perf_counter() - started
+
+    summary = _summary(latencies, totals['errors'], seconds)
+    print(f"{totals['accepted']} pings accepted in {seconds:.1f}s ({totals['accepted'] / seconds:,.0f} pings/s) "
+          f"from {len(rider_ids)} riders, {batch} per request: {summary['rps']} req/s, "
+          f"p50 {summary['p50_ms']} ms, p99 {summary['p99_ms']} ms, "
+          f"{totals['busy']} busy (503), {totals['errors']} errors")
+
+    # Every accepted ping must be in the trail once the writers have flushed
+    if not url:
+        app.extensions['aquaflow'].close()
+    wait_until = time.monotonic() + 5 + 2 * app.config['TRACKING_FLUSH_SECONDS']
+    with app.app_context():
+        db = aquaflow.get_db()
+        while True:
+            written = db.execute(count_sql, rider_ids).fetchone()[0] - before
+            db.rollback()
+            if written >= totals['accepted'] or time.monotonic() > wait_until:
+                break
+            time.sleep(0.5)
+    if written != totals['accepted']:
+        raise click.ClickException(f"{written} pings in rider_pings, {totals['accepted']} accepted")
+    print(f'All {written} accepted pings are in rider_pings.')
+
+@cli.command('dispatch')
+@click.option('--orders', default=50000, show_default=True, help='Pending subscription orders to plan.')
+@click.option('--stops', default=15000, show_default=True, help='Distinct addresses the orders go to.')
+@click.option('--cities', default=10, show_default=True, help='Cities the addresses are spread over.')
+@click.option('--missing', default=0.05, show_default=True, help='Share of addresses without a geocode.')
+@click.option('--capacity', default=1000.0, show_default=True, help='Van capacity in litres (VAN_CAPACITY_LITRES).')
+@click.option('--max-stops', default=30, show_default=True, help='Stops per route (VAN_MAX_STOPS).')
+@click.option('--repeat', default=5, show_default=True, help='Timed runs; the median is reported.')
+@click.option('--seed', default=1, show_default=True, help='Random seed.')
+def dispatch_command(orders, stops, cities, missing, capacity, max_stops, repeat, seed):
+    """Time planning van routes for a day's pending subscription orders, as the van panel does."""
+    rng = random.Random(seed)
+    centres = {f'City {n}': (rng.uniform(24.5, 34.5), rng.uniform(67.0, 74.5)) for n in range(cities)}
+    addresses = []
+    geocodes = {}
+    for n in range(stops):
+        city = rng.choice(list(centres))
+        address = f'House {n}, Street {rng.randint(1, 60)}'
+        addresses.append((city, address))
+        if rng.random() >= missing:
+            lat, lng = centres[city]
+            geocodes[(city, address)] = (lat + rng.uniform(-0.1, 0.1), lng + rng.uniform(-0.1, 0.1))
+    bottle_types = ('2 Liter', '5 Liter', '12 Liter', '20 Liter')
+    pending = []
+    for order_id in range(1, orders + 1):
+        # Every address gets an order before any gets a second one
+        city, address = addresses[order_id - 1] if order_id <= stops else rng.choice(addresses)
+        pending.append({'id': order_id, 'city': city, 'address': address,
+                        'bottle_type': rng.choice(bottle_types), 'quantity': rng.randint(1, 5)})
+
+    grouping, planning = [], []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        planned_stops = dispatch.build_stops(pending, geocodes)
+        grouped = time.perf_counter()
+        batches = dispatch.plan_batches(planned_stops, capacity, max_stops)
+        grouping.append(grouped - started)
+        planning.append(time.perf_counter() - grouped)
+    grouping.sort()
+    planning.sort()
+
+    planned = sorted(order_id for batch in batches for stop in batch.stops for order_id in stop.order_ids)
+    if planned != list(range(1, orders + 1)):
+        raise click.ClickException('the routes do not cover every order exactly once')
+    located = sum(1 for stop in planned_stops if stop.x is not None)
+    unrouted = sum(1 for batch in batches if batch.distance_km is None)
+    print(f"{orders} orders at {len(planned_stops)} stops in {cities} cities ({located} stops geocoded) "
+          f"-> {len(batches)} routes, {unrouted} of them without coordinates")
+    print(f"Median of {repeat}: {grouping[repeat // 2]:.3f}s grouping + {planning[repeat // 2]:.3f}s planning "
+          f"= {grouping[repeat // 2] + planning[repeat // 2]:.3f}s")
+
+@cli.command('login-burst')
+@click.option('--db', 'db_path', default='bench.db', show_default=True, help='Seeded database to read users from.')
+@click.option('--url', help='Drive a running server instead of the in-process test client.')
+@click.option('--rate', default=500.0, show_default=True, help='Login attempts started per second.')
+@click.option('--duration', default=10.0, show_default=True, help='Seconds of logins.')
+@click.option('--ips', default=1000, show_default=True, help='Distinct client IPs, sent as X-Forwarded-For.')
+@click.option('--failed', default=0.0, show_default=True, help='Share of attempts with a wrong password.')
+@click.option('--order-clients', default=8, show_default=True, help='Customers placing orders meanwhile.')
+@click.option('--concurrency', default=64, show_default=True, help='Most logins in flight at once.')
+@click.option('--seed', default=1, show_default=True, help='Random seed.')
+def login_burst(db_path, url, rate, duration, ips, failed, order_clients, concurrency, seed):
+    """Open-loop login burst at --rate attempts/s while customers keep ordering.
+
+    Reports login latency and status counts (302 for a handled attempt,
+    whether or not the password was right), and order latency. Login
+    latency is measured from when the attempt was due, so time spent waiting
+    for a free client thread counts too. A server under test must trust one
+    proxy hop (PROXY_COUNT=1, the default) for the spread of IPs to apply.
+    """
+    app = _load_app(db_path)
+    with app.app_context():
+        db = aquaflow.get_db()
+        bottle_types = list(aquaflow.get_state().pricing.catalog(aquaflow.get_db).products)
+        customers = {}
+        for email, location_id in db.execute(
+            """SELECT u.email, l.id FROM users u JOIN locations l ON l.user_id = u.id
+               WHERE u.role = 'user' AND u.email LIKE '%@bench.test' ORDER BY u.id, l.id LIMIT 5000"""
+        ):
+            customers.setdefault(email, []).append(location_id)
+    if len(customers) <= order_clients:
+        raise click.ClickException(f"{db_path} has too few benchmark customers; seed it with 'python bench.py seed'")
+    emails = list(customers)
+    make_session = (lambda headers=None: HTTPSession(url, headers)) if url else \
+        (lambda headers=None: TestClientSession(app, headers))
+
+    rng = random.Random(seed)
+    addresses = [f'10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}' for n in range(1, ips + 1)]
+    lock = threading.Lock()
+    login_samples, statuses = [], {}
+    order_samples, order_errors = [], 0
+    stop = threading.Event()
+
+    def one_login(due, email, password, ip):
+        session = make_session({'X-Forwarded-For': ip})
+        try:
+            status = session.post('/login', {'email': email, 'password': password})
+        except (http.client.HTTPException, OSError):
+            status = 'connection error'
+        finally:
+            if url:
+                session.close()
+        elapsed = time.perf_counter() - due
+        with lock:
+            login_samples.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    def orderer(email, seed):
+        nonlocal order_errors
+        order_rng = random.Random(seed)
+        session = make_session()
+        session.post('/login', {'email': email, 'password': BENCH_PASSWORD})
+        ready.wait()
+        samples, errors = [], 0
+        while not stop.is_set():
+            started = time.perf_counter()
+            status = session.post('/order', {'bottle_type': order_rng.choice(bottle_types),
+                                             'quantity': order_rng.randint(1, 6),
+                                             'location_id': order_rng.choice(customers[email])})
+            samples.append(time.perf_counter() - started)
+            errors += status >= 400
+        with lock:
+            order_samples.extend(samples)
+            order_errors += errors
+
+    ready = threading.Barrier(order_clients + 1)
+    orderers = [threading.Thread(target=orderer, args=(emails[n], seed + n)) for n in range(order_clients)]
+    for thread in orderers:
+        thread.start()
+    ready.wait()
+
+    started = time.perf_counter()
+    attempts = int(rate * duration)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for n in range(attempts):
+            due = started + n / rate
+            pause = due - time.perf_counter()
+            if pause > 0:
+                time.sleep(pause)
+            password = 'wrong-pass' if rng.random() < failed else BENCH_PASSWORD
+            pool.submit(one_login, due, rng.choice(emails[order_clients:]), password, rng.choice(addresses))
+    seconds = time.perf_counter() - started
+    stop.set()
+    for thread in orderers:
+        thread.join()
+
+    logins = _summary(login_samples, sum(n for status, n in statuses.items() if status != 302), seconds)
+    orders = _summary(order_samples, order_errors, seconds)
+    print(f"{attempts} login attempts at {rate:g}/s over {seconds:.1f}s from up to {ips} IPs, {failed:.0%} failing: "
+          f"p50 {logins['p50_ms']} ms, p99 {logins['p99_ms']} ms; "
+          f"status {', '.join(f'{status}: {n}' for status, n in sorted(statuses.items(), key=str))}")
+    print(f"{orders['count']} orders from {order_clients} customers meanwhile ({orders['rps']} req/s): "
+          f"p50 {orders['p50_ms']} ms, p99 {orders['p99_ms']} ms, {order_errors} errors")
+
+# Fields checked against a baseline: 1 if higher is worse, -1 if lower is
+REGRESSION_FIELDS = {'rps': -1, 'mean_ms': 1, 'p50_ms': 1, 'p99_ms': 1}
+
+def _regressions(old, new, max_pct):
+    """A line for each route and field of new that is more than max_pct percent worse than in old"""
+    found = []
+    for route in ['total'] + sorted(set(old['routes']) & set(new['routes'])):
+        a = old['total'] if route == 'total' else old['routes'][route]
+        b = new['total'] if route == 'total' else new['routes'][route]
+        for field, worse in REGRESSION_FIELDS.items():
+            x, y = a.get(field), b.get(field)
+            if x and y is not None and (y - x) / x * 100 * worse > max_pct:
+                found.append(f'{route} {field}: {x} -> {y} ({(y - x) / x * 100:+.0f}%)')
+    return found
+
+def _check_baseline(old, new, max_pct):
+    load = lambda report: {key: report['meta'].get(key) for key in ('threads', 'rate', 'routes')}
+    if load(old) != load(new):
+        raise click.ClickException(f'The baseline ran another load ({load(old)}), not {load(new)}')
+    regressions = _regressions(old, new, max_pct)
+    if regressions:
+        raise click.ClickException(f'More than {max_pct:g}% worse than the baseline:\n  ' + '\n  '.join(regressions))
+    print(f'Within {max_pct:g}% of the baseline.', file=sys.stderr)
+
+@cli.command()
+@click.argument('before', type=click.File('r'))
+@click.argument('after', type=click.File('r'))
+@click.option('--max-regression', type=float,
+              help='Fail if AFTER is this many percent worse than BEFORE in throughput, mean, p50 or p99.')
+def compare(before, after, max_regression):
+    """Show per-route throughput and latency changes between two reports."""
+    old, new = json.load(before), json.load(after)
+
+    def change(a, b):
+        if a is None or b is None:
+            return ''
+        return f'{(b - a) / a * 100:+.0f}%' if a else ''
+
+    print(f"{'route':<16}{'rps':>26}{'p50 ms':>30}{'p99 ms':>30}")
+    for route in ['total'] + sorted(set(old['routes']) | set(new['routes'])):
+        a = old['total'] if route == 'total' else old['routes'].get(route, {})
+        b = new['total'] if route == 'total' else new['routes'].get(route, {})
+        cells = []
+        for field in ('rps', 'p50_ms', 'p99_ms'):
+            x, y = a.get(field), b.get(field)
+            cells.append(f"{x if x is not None else '-'} -> {y if y is not None else '-'} {change(x, y)}")
+        print(f"{route:<16}{cells[0]:>26}{cells[1]:>30}{cells[2]:>30}")
+    if max_regression is not None:
+        _check_baseline(old, new, max_regression)
+
+if __name__ == '__main__':
+    cli()
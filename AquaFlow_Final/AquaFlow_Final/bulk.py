@@ -0,0 +1,53 @@
+# Bulk inserts into orders on SQLite.
+#
+# Three per-row AFTER INSERT triggers keep the data derived from orders
+# current: the rollup totals, the orders_fts search index and the orders
+# data version. An INSERT ... SELECT of a hundred thousand orders fires
+# each of them a hundred thousand times. insert_orders() holds a row in
+# bulk_inserts while its statement runs, which the triggers' WHEN clause
+# checks, and then does their work once over the new rows: one grouped
+# upsert into order_rollups, one INSERT ... SELECT into the index and one
+# version bump. The row is deleted again in the same transaction, so no
+# other connection ever sees it.
+#
+# On PostgreSQL the rollup and version triggers already run once per
+# statement and the search index is maintained by the database, so there
+# it is a plain insert.
+
+import pagecache
+import rollups
+import search
+
+# Trigger condition: no bulk insert into orders is in progress
+NOT_BULK = "NOT EXISTS (SELECT 1 FROM bulk_inserts WHERE table_name = 'orders')"
+
+def install(db):
+    """Creates bulk_inserts and makes the insert triggers on orders skip the rows of a bulk insert"""
+    if db.dialect == 'postgres':
+        return
+    db.execute('CREATE TABLE IF NOT EXISTS bulk_inserts (table_name TEXT PRIMARY KEY) WITHOUT ROWID')
+    rollups.install_insert_trigger(db, NOT_BULK)
+    search.install_insert_trigger(db, 'orders', NOT_BULK)
+    pagecache.install_insert_trigger(db, 'orders', NOT_BULK)
+
+def insert_orders(db, sql, params=()):
+    """Runs sql, an INSERT INTO orders, and updates what the insert triggers maintain once for all its rows.
+
+    Returns the number of orders inserted. The caller commits.
+    """
+    if db.dialect == 'postgres':
+        return db.execute(sql, params).rowcount
+    # Writing the marker takes the write lock, so once it is in no one else can
+    # add an order and the new rows are the ones above the current maximum id
+    db.execute("INSERT INTO bulk_inserts (table_name) VALUES ('orders')")
+    try:
+        after_id = db.execute('SELECT COALESCE(MAX(id), 0) FROM orders').fetchone()[0]
+        created = db.execute(sql, params).rowcount
+    finally:
+        db.execute("DELETE FROM bulk_inserts WHERE table_name = 'orders'")
+    if created > 0:
+        upto_id = db.execute('SELECT MAX(id) FROM orders').fetchone()[0]
+        rollups.add(db, f'(SELECT * FROM orders WHERE id > {int(after_id)}) AS new_orders', 'new_orders')
+        search.index_rows(db, 'orders', after_id, upto_id)
+        pagecache.bump(db, 'orders')
+    return created
@@ -0,0 +1,150 @@
+# Van dispatch planning: turns pending subscription orders into routes.
+#
+#   1. Orders at the same (city, address) become one stop.
+#   2. Per city, stops are swept by angle around the city's centre and cut
+#      into batches that fit the van (litres and number of stops).
+#   3. Each batch is ordered with nearest-neighbour from the centre and then
+#      improved with 2-opt.
+# Coordinates come from a local geocode table; stops without one are put at
+# the end of their city's batches in address order.
+
+import math
+import re
+from collections import namedtuple
+
+Stop = namedtuple('Stop', 'city address order_ids litres x y')
+Batch = namedtuple('Batch', 'city stops litres distance_km')
+
+_LITRES = re.compile(r'(\d+(?:\.\d+)?)\s*l', re.IGNORECASE)
+KM_PER_DEGREE = 111.32
+
+def bottle_litres(bottle_type, default=20.0):
+    """'2 Liter' -> 2.0, '20 Liter' -> 20.0"""
+    match = _LITRES.search(bottle_type or '')
+    return float(match.group(1)) if match else default
+
+def build_stops(orders, geocodes):
+    """Groups orders by (city, address) into stops.
+
+    orders: iterable of mappings with id, city, address, bottle_type, quantity.
+    geocodes: {(city, address): (lat, lng)}. Positions are projected to km
+    on a flat plane, which is accurate enough within one city.
+    """
+    grouped = {}
+    litres_per_bottle = {}
+    for order in orders:
+        key = (order['city'] or '', order['address'] or '')
+        entry = grouped.get(key)
+        if entry is None:
+            entry = grouped[key] = [[], 0.0]
+        bottle_type = order['bottle_type']
+        litres = litres_per_bottle.get(bottle_type)
+        if litres is None:
+            litres = litres_per_bottle[bottle_type] = bottle_litres(bottle_type)
+        entry[0].append(order['id'])
+        entry[1] += litres * order['quantity']
+
+    stops = []
+    for (city, address), (order_ids, litres) in grouped.items():
+        position = geocodes.get((city, address))
+        if position:
+            lat, lng = position
+            x = lng * KM_PER_DEGREE * math.cos(math.radians(lat))
+            y = lat * KM_PER_DEGREE
+        else:
+            x = y = None
+        stops.append(Stop(city, address, order_ids, litres, x, y))
+    return stops
+
+def _tour_length(points, depot):
+    length = 0.0
+    prev = depot
+    for point in points:
+        length += math.hypot(point[0] - prev[0], point[1] - prev[1])
+        prev = point
+    return length
+
+def _nearest_neighbour(stops, depot):
+    remaining = list(stops)
+    xs = [s.x for s in remaining]
+    ys = [s.y for s in remaining]
+    route = []
+    cx, cy = depot
+    while remaining:
+        distances = [(x - cx) * (x - cx) + (y - cy) * (y - cy) for x, y in zip(xs, ys)]
+        best = distances.index(min(distances))
+        route.append(remaining.pop(best))
+        cx, cy = xs.pop(best), ys.pop(best)
+    return route
+
+def _two_opt(route, depot, max_passes, window):
+    """Reverses segments while that shortens the open path starting at depot.
+
+    Only segments of up to window stops are tried, which keeps a pass linear
+    in the batch size; nearest-neighbour has already fixed the long edges.
+    """
+    xs = [depot[0]] + [s.x for s in route]
+    ys = [depot[1]] + [s.y for s in route]
+    hypot = math.hypot
+    n = len(xs)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(1, n - 1):
+            ax, ay = xs[i - 1], ys[i - 1]
+            ab = hypot(xs[i] - ax, ys[i] - ay)
+            for j in range(i + 1, min(n, i + window)):
+                if j + 1 < n:
+                    cd = hypot(xs[j + 1] - xs[j], ys[j + 1] - ys[j])
+                    new = hypot(xs[j] - ax, ys[j] - ay) + hypot(xs[j + 1] - xs[i], ys[j + 1] - ys[i])
+                else:
+                    cd = 0.0
+                    new = hypot(xs[j] - ax, ys[j] - ay)
+                if new < ab + cd - 1e-9:
+                    xs[i:j + 1] = xs[j:i - 1:-1]
+                    ys[i:j + 1] = ys[j:i - 1:-1]
+                    route[i - 1:j] = route[j - 1:i - 2 if i > 1 else None:-1]
+                    ab = hypot(xs[i] - ax, ys[i] - ay)
+                    improved = True
+        if not improved:
+            break
+    return route
+
+def plan_batches(stops, capacity_litres, max_stops, two_opt_passes=1, two_opt_window=12):
+    """Splits stops into van batches and orders each batch. Returns a list of Batch.
+
+    A single stop larger than the van gets a batch of its own.
+    """
+    by_city = {}
+    for stop in stops:
+        by_city.setdefault(stop.city, []).append(stop)
+
+    batches = []
+    for city in sorted(by_city):
+        located = [s for s in by_city[city] if s.x is not None]
+        unlocated = sorted((s for s in by_city[city] if s.x is None), key=lambda s: s.address)
+
+        if located:
+            depot = (sum(s.x for s in located) / len(located), sum(s.y for s in located) / len(located))
+            located.sort(key=lambda s: math.atan2(s.y - depot[1], s.x - depot[0]))
+        else:
+            depot = None
+
+        for group, routed in ((located, True), (unlocated, False)):
+            current, load = [], 0.0
+            for stop in group:
+                if current and (load + stop.litres > capacity_litres or len(current) >= max_stops):
+                    batches.append(_finish(city, current, load, depot if routed else None, two_opt_passes, two_opt_window))
+                    current, load = [], 0.0
+                current.append(stop)
+                load += stop.litres
+            if current:
+                batches.append(_finish(city, current, load, depot if routed else None, two_opt_passes, two_opt_window))
+    return batches
+
+def _finish(city, stops, load, depot, two_opt_passes, two_opt_window):
+    if depot is None:
+        return Batch(city, stops, load, None)
+    route = _nearest_neighbour(stops, depot)
+    if len(route) > 3 and two_opt_passes:
+        route = _two_opt(route, depot, two_opt_passes, two_opt_window)
+    return Batch(city, route, load, _tour_length([(s.x, s.y) for s in route], depot))
@@ -0,0 +1,86 @@
+# Order event bus for the live delivery/van panels.
+#
+# Write paths publish small delta events ("order created", "orders claimed",
+# ...) after they commit; the Server-Sent Events streams read them. Two
+# brokers share the same interface:
+#   MemoryBroker  in-process ring buffer, for a single worker
+#   SQLiteBroker  order_events table polled by id, for several workers on one
+#                 machine (a local stand-in for a real message broker)
+
+import json
+import sqlite3
+import threading
+import time
+from collections import deque, namedtuple
+
+Event = namedtuple('Event', 'id channel kind data')
+
+class MemoryBroker:
+    def __init__(self, history=1000):
+        self._events = deque(maxlen=history)
+        self._cond = threading.Condition()
+        self._last_id = 0
+
+    def latest_id(self):
+        return self._last_id
+
+    def publish(self, channel, kind, data):
+        with self._cond:
+            self._last_id += 1
+            self._events.append(Event(self._last_id, channel, kind, data))
+            self._cond.notify_all()
+
+    def read(self, channels, after_id, timeout):
+        """Events on channels newer than after_id, waiting up to timeout seconds for one"""
+        if after_id > self._last_id:
+            # Client was talking to an earlier process; start from now
+            after_id = self._last_id
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                events = [e for e in self._events if e.id > after_id and e.channel in channels]
+                remaining = deadline - time.monotonic()
+                if events or remaining <= 0:
+                    return events
+                self._cond.wait(remaining)
+
+class SQLiteBroker:
+    def __init__(self, path, poll_interval=1.0, keep=10000):
+        self.path = path
+        self.poll_interval = poll_interval
+        # Number of most recent events kept in order_events
+        self.keep = keep
+        self._local = threading.local()
+
+    def _conn(self):
+        # Own connections, not the request pool: streams stay open for minutes
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=5)
+        return conn
+
+    def latest_id(self):
+        return self._conn().execute('SELECT COALESCE(MAX(id), 0) FROM order_events').fetchone()[0]
+
+    def publish(self, channel, kind, data):
+        conn = self._conn()
+        with conn:
+            event_id = conn.execute(
+                'INSERT INTO order_events (channel, kind, payload) VALUES (?, ?, ?)',
+                (channel, kind, json.dumps(data))
+            ).lastrowid
+            conn.execute('DELETE FROM order_events WHERE id <= ?', (event_id - self.keep,))
+
+    def read(self, channels, after_id, timeout):
+        conn = self._conn()
+        placeholders = ', '.join('?' * len(channels))
+        deadline = time.monotonic() + timeout
+        while True:
+            rows = conn.execute(
+                f'SELECT id, channel, kind, payload FROM order_events '
+                f'WHERE id > ? AND channel IN ({placeholders}) ORDER BY id LIMIT 100',
+                [after_id] + list(channels)
+            ).fetchall()
+            if rows or time.monotonic() >= deadline:
+                return [Event(r[0], r[1], r[2], json.loads(r[3])) for r in rows]
+            time.sleep(min(self.poll_interval, max(deadline - time.monotonic(), 0)))
@@ -0,0 +1,13 @@
+# gunicorn settings, read when gunicorn starts from this directory:
+#
+#   gunicorn wsgi:app
+#
+# The app sizes its password hashing pool from WEB_THREADS too, so set the
+# thread count here (or with WEB_THREADS) rather than with --threads.
+
+import os
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('WEB_THREADS', 8))
+worker_class = 'gthread'
@@ -0,0 +1,62 @@
+# Password hashing on a bounded thread pool.
+#
+# Werkzeug's hashes (scrypt/pbkdf2) are deliberately slow. hashlib releases
+# the GIL while it computes them, so running them on a small pool caps how
+# many CPU cores a login burst can take, while the worker's other threads keep
+# serving orders. The pool and its queue together hold fewer jobs than the
+# worker has request threads, so a burst can never take all of them: when
+# they are full new work is refused at once, and a job that isn't done
+# within a fraction of a second is given up on (the caller answers 503)
+# instead of holding its request thread behind the queue.
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+class HashPoolBusy(Exception):
+    """Raised when the pool is full or a hash job waits longer than the timeout"""
+
+def max_pending_for(threads, workers):
+    """How many jobs may queue so that hashing holds at most half of a worker's request threads"""
+    return max(0, threads // 2 - workers)
+
+class HashPool:
+    def __init__(self, workers=2, max_pending=0, timeout=0.5):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        # Threads don't survive a fork, so each gunicorn worker gets its own pool
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix='hash')
+                    self._slots = threading.BoundedSemaphore(self.workers + self.max_pending)
+                    self._pid = os.getpid()
+        return self._pool
+
+    def _run(self, fn, *args):
+        executor = self._executor()
+        if not self._slots.acquire(blocking=False):
+            raise HashPoolBusy()
+        try:
+            future = executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise HashPoolBusy()
+
+    def check(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def generate(self, password):
+        return self._run(generate_password_hash, password)
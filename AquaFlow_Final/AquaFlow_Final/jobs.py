@@ -0,0 +1,201 @@
+# Durable background jobs for the side effects of order changes.
+#
+# Write paths call enqueue() inside their own transaction, so a job exists
+# exactly when the change it describes was committed. `flask run-jobs` starts
+# worker processes that claim due jobs, run the handler registered for their
+# kind and record the outcome in jobs.status:
+#   queued   waiting until run_after
+#   running  claimed by a worker; requeued if that worker dies mid-job
+#   done     finished; deleted after the retention period
+#   dead     failed max_attempts times; kept for inspection and `flask retry-jobs`
+# A failed attempt is retried after an exponential backoff with jitter.
+# Times are epoch seconds.
+
+import json
+import logging
+import random
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+# kind -> function(db, payload)
+_HANDLERS = {}
+
+def install(db):
+    """Creates the jobs table"""
+    db.execute(
+        '''CREATE TABLE IF NOT EXISTS jobs (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               kind TEXT NOT NULL,
+               payload TEXT NOT NULL,
+               status TEXT NOT NULL DEFAULT 'queued',
+               attempts INTEGER NOT NULL DEFAULT 0,
+               max_attempts INTEGER NOT NULL,
+               run_after REAL NOT NULL,
+               created_at REAL NOT NULL,
+               started_at REAL,
+               finished_at REAL,
+               last_error TEXT
+           )'''
+    )
+    # Claiming reads the oldest due queued job; stats and pruning scan by status
+    db.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status_due ON jobs (status, run_after)')
+
+def handler(kind):
+    """Registers the decorated function(db, payload) as the handler for kind"""
+    def register(func):
+        _HANDLERS[kind] = func
+        return func
+    return register
+
+def enqueue(db, kind, payload, max_attempts=5, delay=0):
+    """Adds a job in the caller's transaction; it becomes visible to workers on commit"""
+    now = time.time()
+    db.execute(
+        'INSERT INTO jobs (kind, payload, max_attempts, run_after, created_at) VALUES (?, ?, ?, ?, ?)',
+        (kind, json.dumps(payload), max_attempts, now + delay, now)
+    )
+
+def backoff(attempts, base, cap):
+    """Seconds to wait before retry number attempts: doubling from base, at most cap, jittered"""
+    return min(cap, base * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+
+def claim(db):
+    """Marks the oldest due job as running and returns it, or None if nothing is due"""
+    now = time.time()
+    # SQLite runs one writer at a time; on Postgres concurrent workers skip
+    # each other's rows instead of queueing behind them
+    skip_locked = ' FOR UPDATE SKIP LOCKED' if db.dialect == 'postgres' else ''
+    job = db.execute(
+        f'''UPDATE jobs SET status = 'running', attempts = attempts + 1, started_at = ?
+            WHERE id = (SELECT id FROM jobs WHERE status = 'queued' AND run_after <= ?
+                        ORDER BY run_after, id LIMIT 1{skip_locked})
+            RETURNING id, kind, payload, attempts, max_attempts''',
+        (now, now)
+    ).fetchone()
+    db.commit()
+    return job
+
+def run_one(db, backoff_base=5, backoff_cap=600):
+    """Claims and runs one job. Returns False if none was due."""
+    job = claim(db)
+    if job is None:
+        return False
+    try:
+        func = _HANDLERS.get(job['kind'])
+        if func is None:
+            raise LookupError(f"no handler for job kind {job['kind']!r}")
+        func(db, json.loads(job['payload']))
+        db.execute("UPDATE jobs SET status = 'done', finished_at = ?, last_error = NULL WHERE id = ?",
+                   (time.time(), job['id']))
+        db.commit()
+    except Exception:
+        db.rollback()
+        error = traceback.format_exc(limit=5)
+        if job['attempts'] >= job['max_attempts']:
+            logger.error('Job %d (%s) failed %d times, moved to dead letters:\n%s',
+                         job['id'], job['kind'], job['attempts'], error)
+            db.execute("UPDATE jobs SET status = 'dead', finished_at = ?, last_error = ? WHERE id = ?",
+                       (time.time(), error, job['id']))
+        else:
+            delay = backoff(job['attempts'], backoff_base, backoff_cap)
+            logger.warning('Job %d (%s) failed, retrying in %.0fs:\n%s', job['id'], job['kind'], delay, error)
+            db.execute("UPDATE jobs SET status = 'queued', run_after = ?, last_error = ? WHERE id = ?",
+                       (time.time() + delay, error, job['id']))
+        db.commit()
+    return True
+
+def requeue_stale(db, timeout):
+    """Requeues jobs whose worker has held them longer than timeout seconds (it crashed or was killed)"""
+    count = db.execute(
+        '''UPDATE jobs SET status = CASE WHEN attempts >= max_attempts THEN 'dead' ELSE 'queued' END,
+                           run_after = ?, last_error = 'worker timed out'
+           WHERE status = 'running' AND started_at < ?''',
+        (time.time(), time.time() - timeout)
+    ).rowcount
+    db.commit()
+    return count
+
+def prune(db, retention):
+    """Deletes done jobs finished more than retention seconds ago"""
+    count = db.execute("DELETE FROM jobs WHERE status = 'done' AND finished_at < ?",
+                       (time.time() - retention,)).rowcount
+    db.commit()
+    return count
+
+def retry_dead(db, kind=None):
+    """Puts dead jobs back in the queue with a fresh set of attempts. Returns how many."""
+    sql = "UPDATE jobs SET status = 'queued', attempts = 0, run_after = ? WHERE status = 'dead'"
+    params = [time.time()]
+    if kind:
+        sql += ' AND kind = ?'
+        params.append(kind)
+    count = db.execute(sql, params).rowcount
+    db.commit()
+    return count
+
+def work(pool, stop, poll=0.5, timeout=300, retention=7 * 24 * 3600, backoff_base=5, backoff_cap=600):
+    """Runs jobs until the stop event is set. One of these runs in each worker process."""
+    db = pool.acquire()
+    housekeeping_at = 0.0
+    try:
+        while not stop.is_set():
+            try:
+                if time.monotonic() >= housekeeping_at:
+                    requeue_stale(db, timeout)
+                    prune(db, retention)
+                    housekeeping_at = time.monotonic() + 60
+                if not run_one(db, backoff_base, backoff_cap):
+                    stop.wait(poll)
+            except Exception:
+                # e.g. database busy; the claimed job (if any) is requeued once it goes stale
+                logger.exception('Job worker error')
+                db.rollback()
+                stop.wait(poll)
+    finally:
+        pool.release(db)
+
+def stale(db, older_than):
+    """Queued jobs that have been due for more than older_than seconds, as {kind: count}.
+
+    Any of them means no worker is taking jobs: `flask run-jobs` isn't
+    running, or can't keep up.
+    """
+    return dict(db.execute(
+        "SELECT kind, COUNT(*) FROM jobs WHERE status = 'queued' AND run_after < ? GROUP BY kind",
+        (time.time() - older_than,)
+    ).fetchall())
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def stats(db, window=3600):
+    """Queue depth by status and latency of the jobs finished in the last window seconds.
+
+    latency is enqueue to finish (including retries), run is the last attempt alone.
+    """
+    now = time.time()
+    depth = {status: 0 for status in ('queued', 'running', 'done', 'dead')}
+    depth.update(db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+    due, oldest = db.execute(
+        "SELECT COUNT(*), MIN(created_at) FROM jobs WHERE status = 'queued' AND run_after <= ?", (now,)
+    ).fetchone()
+    finished = db.execute(
+        "SELECT finished_at - created_at, finished_at - started_at FROM jobs "
+        "WHERE status = 'done' AND finished_at >= ? ORDER BY finished_at DESC LIMIT 10000",
+        (now - window,)
+    ).fetchall()
+    latency = sorted(row[0] for row in finished)
+    run = sorted(row[1] for row in finished)
+    return {
+        'depth': depth,
+        'due': due,
+        'oldest_due_age_seconds': round(now - oldest, 3) if oldest is not None else None,
+        'finished_last_window': len(finished),
+        'window_seconds': window,
+        'latency_seconds': {f'p{p}': _percentile(latency, p) for p in (50, 95, 99)},
+        'run_seconds': {f'p{p}': _percentile(run, p) for p in (50, 95, 99)},
+    }
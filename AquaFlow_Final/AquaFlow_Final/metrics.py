@@ -0,0 +1,151 @@
+# Request and SQL instrumentation, exported in Prometheus text format.
+#
+# Everything here is per process: with several gunicorn workers each worker
+# keeps its own numbers, like the in-process caches.
+
+import re
+import threading
+import time
+from collections import defaultdict
+
+# Latency buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+
+def normalize_sql(sql):
+    """Collapses whitespace and replaces literals so equal statements group together"""
+    sql = _STRING_LITERAL.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _WHITESPACE.sub(' ', sql).strip()
+    return _IN_LIST.sub('(?, ...)', sql)
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.total += 1
+        self.sum += value
+
+class QueryStats:
+    """SQL counters for one request"""
+    __slots__ = ('count', 'seconds', 'slow')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.slow = []
+
+class InstrumentedConnection:
+    """Wraps a database connection and times its statement methods.
+
+    Times the statement execution call; rows fetched later from the cursor
+    are not included. Everything else is delegated to the real connection.
+    """
+
+    def __init__(self, conn, stats, slow_seconds):
+        self.raw = conn
+        self.stats = stats
+        self.slow_seconds = slow_seconds
+
+    def _timed(self, method, sql, *args):
+        start = time.perf_counter()
+        try:
+            return method(sql, *args)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stats.count += 1
+            self.stats.seconds += elapsed
+            if elapsed >= self.slow_seconds:
+                self.stats.slow.append((sql, elapsed))
+
+    def execute(self, sql, *args):
+        return self._timed(self.raw.execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        return self._timed(self.raw.executemany, sql, *args)
+
+    def executescript(self, sql):
+        return self._timed(self.raw.executescript, sql)
+
+    def insert(self, sql, params=()):
+        return self._timed(self.raw.insert, sql, params)
+
+    def insert_many(self, sql, rows):
+        return self._timed(self.raw.insert_many, sql, rows)
+
+    def stream(self, sql, params=()):
+        return self._timed(self.raw.stream, sql, params)
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (endpoint, method, status) -> Histogram of request seconds
+        self.requests = defaultdict(Histogram)
+        # endpoint -> [query count, sql seconds]
+        self.queries = defaultdict(lambda: [0, 0.0])
+        # normalized sql -> [count, seconds]
+        self.slow_queries = defaultdict(lambda: [0, 0.0])
+
+    def record_request(self, endpoint, method, status, seconds, stats):
+        with self._lock:
+            self.requests[(endpoint, method, status)].observe(seconds)
+            queries = self.queries[endpoint]
+            queries[0] += stats.count
+            queries[1] += stats.seconds
+            for sql, elapsed in stats.slow:
+                slow = self.slow_queries[normalize_sql(sql)]
+                slow[0] += 1
+                slow[1] += elapsed
+
+    def render(self, extra_lines=()):
+        lines = []
+        with self._lock:
+            lines.append('# HELP aquaflow_request_duration_seconds Request latency by endpoint.')
+            lines.append('# TYPE aquaflow_request_duration_seconds histogram')
+            for (endpoint, method, status), hist in sorted(self.requests.items()):
+                labels = f'endpoint="{_escape(endpoint)}",method="{method}",status="{status}"'
+                cumulative = 0
+                for bound, count in zip(BUCKETS, hist.counts):
+                    cumulative += count
+                    lines.append(f'aquaflow_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'aquaflow_request_duration_seconds_bucket{{{labels},le="+Inf"}} {hist.total}')
+                lines.append(f'aquaflow_request_duration_seconds_sum{{{labels}}} {hist.sum:.6f}')
+                lines.append(f'aquaflow_request_duration_seconds_count{{{labels}}} {hist.total}')
+
+            lines.append('# HELP aquaflow_sql_queries_total SQL statements executed by endpoint.')
+            lines.append('# TYPE aquaflow_sql_queries_total counter')
+            for endpoint, (count, _) in sorted(self.queries.items()):
+                lines.append(f'aquaflow_sql_queries_total{{endpoint="{_escape(endpoint)}"}} {count}')
+            lines.append('# HELP aquaflow_sql_seconds_total Time spent executing SQL by endpoint.')
+            lines.append('# TYPE aquaflow_sql_seconds_total counter')
+            for endpoint, (_, seconds) in sorted(self.queries.items()):
+                lines.append(f'aquaflow_sql_seconds_total{{endpoint="{_escape(endpoint)}"}} {seconds:.6f}')
+
+            lines.append('# HELP aquaflow_slow_queries_total Statements slower than the slow query threshold.')
+            lines.append('# TYPE aquaflow_slow_queries_total counter')
+            for sql, (count, _) in sorted(self.slow_queries.items()):
+                lines.append(f'aquaflow_slow_queries_total{{sql="{_escape(sql)}"}} {count}')
+            lines.append('# HELP aquaflow_slow_query_seconds_total Time spent in slow statements.')
+            lines.append('# TYPE aquaflow_slow_query_seconds_total counter')
+            for sql, (_, seconds) in sorted(self.slow_queries.items()):
+                lines.append(f'aquaflow_slow_query_seconds_total{{sql="{_escape(sql)}"}} {seconds:.6f}')
+
+        lines.extend(extra_lines)
+        return '\n'.join(lines) + '\n'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,213 @@
+# Versioned schema migrations.
+#
+# schema.sql creates the base tables (version 0). Every later change to the
+# schema is a numbered step below; applied steps are recorded in the
+# schema_version table so each one runs exactly once per database.
+# Steps run on SQLite and PostgreSQL alike (backends.py rewrites the SQLite
+# DDL); where the two really differ, such as triggers, the step checks
+# db.dialect.
+
+def _add_column(db, table, column, definition):
+    """ALTER TABLE ... ADD COLUMN, skipped if the column already exists"""
+    if column not in db.column_names(table):
+        db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+def _legacy_columns(db):
+    # Columns the old try/except probes in app.py used to add
+    _add_column(db, 'orders', 'delivery_boy_id', 'INTEGER REFERENCES users(id)')
+    _add_column(db, 'orders', 'address', 'TEXT')
+    _add_column(db, 'orders', 'city', 'TEXT')
+    _add_column(db, 'subscriptions', 'last_generated_date', 'TEXT')
+
+def _subscription_day_key(db):
+    _add_column(db, 'orders', 'subscription_id', 'INTEGER REFERENCES subscriptions(id)')
+    _add_column(db, 'orders', 'delivery_date', 'TEXT')
+    db.execute(
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_subscription_day '
+        'ON orders (subscription_id, delivery_date) WHERE subscription_id IS NOT NULL'
+    )
+
+def _hot_query_indexes(db):
+    # dashboard and order_history: orders WHERE user_id ORDER BY order_date
+    db.execute('CREATE INDEX IF NOT EXISTS idx_orders_user_date ON orders (user_id, order_date)')
+    # delivery_panel / van_panel pending lists: only pending rows are indexed
+    db.execute(
+        'CREATE INDEX IF NOT EXISTS idx_orders_pending '
+        "ON orders (order_type, order_date) WHERE status = 'pending'"
+    )
+    # delivery_panel / van_panel: a rider's active route and history
+    db.execute('CREATE INDEX IF NOT EXISTS idx_orders_rider ON orders (delivery_boy_id, status, order_date)')
+    # admin_panel: all orders newest first
+    db.execute('CREATE INDEX IF NOT EXISTS idx_orders_date ON orders (order_date)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_users_role ON users (role)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_locations_user ON locations (user_id)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_user ON subscriptions (user_id)')
+
+def _admin_filter_indexes(db):
+    # admin_panel keyset pages filtered by status or city, newest first
+    db.execute('CREATE INDEX IF NOT EXISTS idx_orders_status_date ON orders (status, order_date)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_orders_city_date ON orders (city, order_date)')
+
+def _order_rollups(db):
+    import rollups
+    rollups.install(db)
+
+def _order_events(db):
+    # Backing table for events.SQLiteBroker
+    db.execute(
+        '''CREATE TABLE IF NOT EXISTS order_events (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               channel TEXT NOT NULL,
+               kind TEXT NOT NULL,
+               payload TEXT NOT NULL,
+               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+           )'''
+    )
+
+def _geocodes(db):
+    # Coordinates per delivery address, used by dispatch.py to order van routes
+    db.execute(
+        '''CREATE TABLE IF NOT EXISTS geocodes (
+               city TEXT NOT NULL,
+               address TEXT NOT NULL,
+               lat REAL NOT NULL,
+               lng REAL NOT NULL,
+               PRIMARY KEY (city, address)
+           )'''
+    )
+
+def _rate_limits(db):
+    # Token buckets for ratelimit.SQLiteBackend
+    db.execute(
+        '''CREATE TABLE IF NOT EXISTS rate_limits (
+               key TEXT PRIMARY KEY,
+               tokens REAL NOT NULL,
+               updated_at REAL NOT NULL
+           ) WITHOUT ROWID'''
+    )
+
+def _product_catalog(db):
+    import pricing
+    pricing.install(db)
+
+def _idempotency_keys(db):
+    # Stored responses of bulk order requests, replayed when a client retries with the same key
+    db.execute(
+        '''CREATE TABLE IF NOT EXISTS idempotency_keys (
+               user_id INTEGER NOT NULL,
+               key TEXT NOT NULL,
+               request_hash TEXT NOT NULL,
+               status_code INTEGER NOT NULL,
+               response TEXT NOT NULL,
+               created_at REAL NOT NULL,
+               PRIMARY KEY (user_id, key)
+           ) WITHOUT ROWID'''
+    )
+
+def _orders_archive(db):
+    import archive
+    archive.install(db)
+
+def _data_versions(db):
+    import pagecache
+    pagecache.install(db)
+
+def _jobs(db):
+    import jobs
+    jobs.install(db)
+
+def _search_indexes(db):
+    import search
+    search.install(db)
+
+def _subscription_schedules(db):
+    import schedule
+    schedule.install(db)
+
+def _rollup_statement_triggers(db):
+    import rollups
+    rollups.reinstall_triggers(db)
+
+def _rider_pings(db):
+    import tracking
+    tracking.install(db)
+
+def _bulk_inserts(db):
+    import bulk
+    bulk.install(db)
+
+def _subscription_runs(db):
+    # One row per day the subscription orders were generated (claims the day across workers)
+    db.execute(
+        '''CREATE TABLE IF NOT EXISTS subscription_runs (
+               run_date TEXT PRIMARY KEY,
+               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+           )'''
+    )
+
+def _search_words(db):
+    # PostgreSQL indexed an email address as one word; rebuild its indexes on the punctuation-split text
+    if db.dialect == 'postgres':
+        import search
+        for name in search.INDEXES:
+            db.execute(f'DROP INDEX IF EXISTS idx_{name}_search')
+        search.install(db)
+
+MIGRATIONS = [
+    (1, 'orders.delivery_boy_id/address/city, subscriptions.last_generated_date', _legacy_columns),
+    (2, 'orders.subscription_id/delivery_date with unique day key', _subscription_day_key),
+    (3, 'indexes for dashboard, history, panel and admin queries', _hot_query_indexes),
+    (4, 'indexes for filtered admin order pages', _admin_filter_indexes),
+    (5, 'order_rollups table maintained by triggers on orders', _order_rollups),
+    (6, 'order_events table for the multi-worker event broker', _order_events),
+    (7, 'geocodes table for van route planning', _geocodes),
+    (8, 'rate_limits table for the shared auth rate limiter', _rate_limits),
+    (9, 'products, city prices and quantity discounts with a catalog version', _product_catalog),
+    (10, 'idempotency_keys table for the bulk order API', _idempotency_keys),
+    (11, 'orders_archive table for delivered orders past the archive window', _orders_archive),
+    (12, 'data_versions counters for the page cache', _data_versions),
+    (13, 'jobs table for the background job queue', _jobs),
+    (14, 'full-text search indexes over users, locations and order addresses', _search_indexes),
+    (15, 'subscription schedules (frequency, start/end dates) and pause windows', _subscription_schedules),
+    (16, 'order rollups counted per insert and delete statement on PostgreSQL', _rollup_statement_triggers),
+    (17, 'rider_pings GPS trail for live delivery tracking', _rider_pings),
+    (18, 'orders insert triggers skip bulk inserts, which update rollups and search once per statement', _bulk_inserts),
+    (19, 'subscription_runs table claiming each day of subscription generation', _subscription_runs),
+    (20, 'PostgreSQL search indexes split words at punctuation as FTS5 does', _search_words),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def current_version(db):
+    db.execute(
+        '''CREATE TABLE IF NOT EXISTS schema_version (
+               version INTEGER PRIMARY KEY,
+               description TEXT NOT NULL,
+               applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+           )'''
+    )
+    return db.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+
+def migrate(db):
+    """Applies every pending migration. Returns the list of versions applied.
+
+    Runs under begin_write() so that when several workers start at once
+    only one of them migrates; the others wait and then find nothing to do.
+    """
+    current_version(db)  # creates schema_version, which begin_write() locks on Postgres
+    db.commit()
+    db.begin_write('schema_version')
+    try:
+        version = current_version(db)
+        applied = []
+        for number, description, step in MIGRATIONS:
+            if number <= version:
+                continue
+            step(db)
+            db.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)', (number, description))
+            applied.append(number)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return applied
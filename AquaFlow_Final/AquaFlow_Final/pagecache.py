@@ -0,0 +1,68 @@
+# Data versions for caching rendered pages.
+#
+# data_versions holds one counter per table, bumped by triggers on every
+# insert, update and delete. A page rendered from some tables stays valid as
+# long as their counters haven't moved, whichever worker did the write, so
+# the rendered HTML can be cached under a key that includes the counters and
+# its ETag can be computed before anything is rendered.
+
+import hashlib
+import os
+
+VERSIONED_TABLES = ('orders', 'orders_archive', 'users', 'locations', 'subscriptions', 'geocodes')
+
+def install(db):
+    """Creates data_versions and the triggers that bump it"""
+    db.execute(
+        '''CREATE TABLE IF NOT EXISTS data_versions (
+               name TEXT PRIMARY KEY,
+               version INTEGER NOT NULL
+           ) WITHOUT ROWID'''
+    )
+    if db.dialect == 'postgres':
+        db.execute('''CREATE OR REPLACE FUNCTION bump_data_version() RETURNS trigger AS $$
+                      BEGIN UPDATE data_versions SET version = version + 1 WHERE name = TG_TABLE_NAME; RETURN NULL; END
+                      $$ LANGUAGE plpgsql''')
+    for table in VERSIONED_TABLES:
+        db.execute('INSERT INTO data_versions (name, version) VALUES (?, 1) ON CONFLICT DO NOTHING', (table,))
+        if db.dialect == 'postgres':
+            # Statement-level: one bump per statement rather than per row
+            db.execute(
+                f'''CREATE OR REPLACE TRIGGER {table}_data_version AFTER INSERT OR UPDATE OR DELETE ON {table}
+                    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version()'''
+            )
+            continue
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            db.execute(
+                f'''CREATE TRIGGER IF NOT EXISTS {table}_data_version_{event.lower()} AFTER {event} ON {table}
+                    BEGIN UPDATE data_versions SET version = version + 1 WHERE name = '{table}'; END'''
+            )
+
+def install_insert_trigger(db, table, when):
+    """Recreates the SQLite insert trigger of table so that it only fires for rows where when holds"""
+    db.execute(f'DROP TRIGGER IF EXISTS {table}_data_version_insert')
+    db.execute(
+        f'''CREATE TRIGGER {table}_data_version_insert AFTER INSERT ON {table} WHEN {when}
+            BEGIN UPDATE data_versions SET version = version + 1 WHERE name = '{table}'; END'''
+    )
+
+def bump(db, table):
+    """Moves table's counter, as its triggers do"""
+    db.execute('UPDATE data_versions SET version = version + 1 WHERE name = ?', (table,))
+
+def versions(db, tables):
+    """Current counters of tables, as a tuple in the given order"""
+    current = dict(db.execute('SELECT name, version FROM data_versions').fetchall())
+    return tuple(current.get(table, 0) for table in tables)
+
+def template_digest(folder):
+    """Hash of every template, so ETags change when a deploy changes the markup"""
+    digest = hashlib.sha1()
+    for root, _, files in sorted(os.walk(folder)):
+        for name in sorted(files):
+            with open(os.path.join(root, name), 'rb') as f:
+                digest.update(name.encode() + b'\0' + f.read())
+    return digest.hexdigest()
+
+def etag(salt, key):
+    return hashlib.sha1((salt + repr(key)).encode()).hexdigest()
@@ -0,0 +1,88 @@
+# Per-process SQLite connection pool.
+#
+# Connections are opened and tuned once, then handed out to requests and
+# returned on teardown instead of being closed. The pool notices when it is
+# used from a forked child (gunicorn workers) and starts over there, since
+# SQLite connections must not cross a fork.
+
+import os
+import queue
+import sqlite3
+import threading
+
+from backends import SQLiteConnection
+
+class PoolTimeout(Exception):
+    """Raised when no connection became free within the pool timeout"""
+
+def connect(path, busy_timeout_ms=5000, mmap_size=64 * 1024 * 1024, cache_size_kb=16000):
+    """Opens a connection with the pragmas every pooled connection shares"""
+    conn = sqlite3.connect(path, timeout=busy_timeout_ms / 1000, check_same_thread=False,
+                           factory=SQLiteConnection)
+    conn.row_factory = sqlite3.Row
+    # WAL lets readers (the delivery panels) run while a writer commits
+    conn.execute('PRAGMA journal_mode = WAL')
+    # Safe with WAL: a power loss can drop the last commits but never corrupts
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA busy_timeout = {int(busy_timeout_ms)}')
+    conn.execute(f'PRAGMA mmap_size = {int(mmap_size)}')
+    # Negative value means KiB rather than pages
+    conn.execute(f'PRAGMA cache_size = -{int(cache_size_kb)}')
+    return conn
+
+class ConnectionPool:
+    def __init__(self, path, size=5, timeout=30, **pragmas):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = pragmas
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self._pid != os.getpid():
+            # Forked: the parent's connections belong to the parent
+            self._reset()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return connect(self.path, **self.pragmas)
+                except Exception:
+                    self._created -= 1
+                    raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PoolTimeout(f'no database connection free after {self.timeout}s (pool size {self.size})')
+
+    def release(self, conn):
+        if self._pid != os.getpid():
+            return
+        try:
+            if conn.in_transaction:
+                # Never hand the next request somebody else's half-finished transaction
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            with self._lock:
+                self._created -= 1
+            return
+        self._idle.put(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        self._created = 0
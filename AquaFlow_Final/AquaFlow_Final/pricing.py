@@ -0,0 +1,182 @@
+# Product catalog and pricing.
+#
+#   products            one row per bottle type: base unit price, volume, stock
+#   product_prices      per-city unit price overriding the base price
+#   quantity_discounts  percent off once an order reaches min_quantity bottles
+#   catalog_version     single counter bumped by triggers on the tables above
+#
+# Each worker keeps the whole catalog in memory and re-reads it only when the
+# counter has moved. The counter itself is checked at most every few seconds,
+# so pricing an order normally costs no query at all and a price change
+# reaches every worker within that interval.
+
+import threading
+import time
+from collections import namedtuple
+
+Product = namedtuple('Product', 'id bottle_type description unit_price volume_litres stock')
+Quote = namedtuple('Quote', 'product unit_price quantity discount_percent total_price')
+
+# (bottle_type, description, unit_price, volume_litres) of the original fixed prices
+DEFAULT_PRODUCTS = (
+    ('2 Liter', 'Perfect for personal use', 50, 2.0),
+    ('20 Liter', 'Great for families', 200, 20.0),
+)
+
+_CATALOG_TABLES = {
+    'products': 'UPDATE OF bottle_type, description, unit_price, volume_litres, active',
+    'product_prices': 'UPDATE',
+    'quantity_discounts': 'UPDATE',
+}
+
+class UnknownProduct(Exception):
+    """Raised for a bottle type that isn't an active product"""
+
+def install(db):
+    """Creates the catalog tables and version triggers and seeds the default products"""
+    db.execute(
+        '''CREATE TABLE IF NOT EXISTS products (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               bottle_type TEXT UNIQUE NOT NULL,
+               description TEXT NOT NULL DEFAULT '',
+               unit_price REAL NOT NULL,
+               volume_litres REAL NOT NULL,
+               stock INTEGER,
+               active INTEGER NOT NULL DEFAULT 1
+           )'''
+    )
+    db.execute(
+        '''CREATE TABLE IF NOT EXISTS product_prices (
+               product_id INTEGER NOT NULL REFERENCES products (id),
+               city TEXT NOT NULL COLLATE NOCASE,
+               unit_price REAL NOT NULL,
+               PRIMARY KEY (product_id, city)
+           )'''
+    )
+    db.execute(
+        '''CREATE TABLE IF NOT EXISTS quantity_discounts (
+               product_id INTEGER NOT NULL REFERENCES products (id),
+               min_quantity INTEGER NOT NULL,
+               percent_off REAL NOT NULL CHECK (percent_off >= 0 AND percent_off < 100),
+               PRIMARY KEY (product_id, min_quantity)
+           )'''
+    )
+    db.execute(
+        '''CREATE TABLE IF NOT EXISTS catalog_version (
+               id INTEGER PRIMARY KEY CHECK (id = 1),
+               version INTEGER NOT NULL
+           )'''
+    )
+    db.execute('INSERT INTO catalog_version (id, version) VALUES (1, 1) ON CONFLICT DO NOTHING')
+
+    # Stock changes don't touch prices, so they don't invalidate the cached catalog
+    if db.dialect == 'postgres':
+        db.execute('''CREATE OR REPLACE FUNCTION bump_catalog_version() RETURNS trigger AS $$
+                      BEGIN UPDATE catalog_version SET version = version + 1 WHERE id = 1; RETURN NULL; END
+                      $$ LANGUAGE plpgsql''')
+    for table, update in _CATALOG_TABLES.items():
+        if db.dialect == 'postgres':
+            db.execute(
+                f'''CREATE OR REPLACE TRIGGER {table}_version AFTER INSERT OR DELETE OR {update} ON {table}
+                    FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version()'''
+            )
+            continue
+        for event in ('INSERT', 'DELETE', update):
+            name = event.split()[0].lower()
+            db.execute(
+                f'''CREATE TRIGGER IF NOT EXISTS {table}_version_{name} AFTER {event} ON {table}
+                    BEGIN UPDATE catalog_version SET version = version + 1 WHERE id = 1; END'''
+            )
+
+    db.executemany(
+        'INSERT INTO products (bottle_type, description, unit_price, volume_litres) VALUES (?, ?, ?, ?) '
+        'ON CONFLICT DO NOTHING',
+        DEFAULT_PRODUCTS
+    )
+
+def current_version(db):
+    return db.execute('SELECT version FROM catalog_version WHERE id = 1').fetchone()[0]
+
+class Catalog:
+    def __init__(self, version, products, city_prices, discounts):
+        self.version = version
+        # bottle_type -> Product, in display order
+        self.products = products
+        # (product_id, city lowercased) -> unit price
+        self.city_prices = city_prices
+        # product_id -> [(min_quantity, percent_off)] sorted by min_quantity descending
+        self.discounts = discounts
+
+    @classmethod
+    def load(cls, db):
+        version = current_version(db)
+        products = {
+            row['bottle_type']: Product(row['id'], row['bottle_type'], row['description'],
+                                        row['unit_price'], row['volume_litres'], row['stock'])
+            for row in db.execute('SELECT * FROM products WHERE active = 1 ORDER BY volume_litres, id')
+        }
+        city_prices = {
+            (row['product_id'], row['city'].lower()): row['unit_price']
+            for row in db.execute('SELECT product_id, city, unit_price FROM product_prices')
+        }
+        discounts = {}
+        for row in db.execute('SELECT product_id, min_quantity, percent_off FROM quantity_discounts '
+                              'ORDER BY min_quantity DESC'):
+            discounts.setdefault(row['product_id'], []).append((row['min_quantity'], row['percent_off']))
+        return cls(version, products, city_prices, discounts)
+
+    def quote(self, bottle_type, quantity, city=None):
+        """Prices quantity bottles of bottle_type delivered to city. Returns a Quote."""
+        product = self.products.get(bottle_type)
+        if product is None:
+            raise UnknownProduct(bottle_type)
+        unit_price = product.unit_price
+        if city:
+            unit_price = self.city_prices.get((product.id, city.strip().lower()), unit_price)
+        percent_off = next((pct for min_qty, pct in self.discounts.get(product.id, ())
+                            if quantity >= min_qty), 0)
+        total = round(unit_price * quantity * (100 - percent_off) / 100, 2)
+        return Quote(product, unit_price, quantity, percent_off, total)
+
+def reprice_subscriptions(db, catalog=None):
+    """Re-quotes every subscription's total_price (per delivery) from the current catalog.
+
+    Generated orders copy that price, so this runs before each generation
+    and after a catalog change. Subscriptions to a product that is no longer
+    active keep their last price. Returns how many changed; the caller commits.
+    """
+    catalog = catalog or Catalog.load(db)
+    changes = []
+    for row in db.execute('SELECT s.id, s.bottle_type, s.quantity, s.total_price, l.city FROM subscriptions s '
+                          'LEFT JOIN locations l ON l.id = s.location_id'):
+        try:
+            total = catalog.quote(row['bottle_type'], row['quantity'], row['city']).total_price
+        except UnknownProduct:
+            continue
+        if total != row['total_price']:
+            changes.append((total, row['id']))
+    db.executemany('UPDATE subscriptions SET total_price = ? WHERE id = ?', changes)
+    return len(changes)
+
+class PricingEngine:
+    def __init__(self, check_interval=2.0):
+        self.check_interval = check_interval
+        self._catalog = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def catalog(self, get_db):
+        """The current Catalog. get_db is only called when the version is due a check."""
+        now = time.monotonic()
+        if self._catalog is not None and now - self._checked_at < self.check_interval:
+            return self._catalog
+        with self._lock:
+            if self._catalog is None or now - self._checked_at >= self.check_interval:
+                db = get_db()
+                if self._catalog is None or current_version(db) != self._catalog.version:
+                    self._catalog = Catalog.load(db)
+                self._checked_at = now
+        return self._catalog
+
+    def quote(self, get_db, bottle_type, quantity, city=None):
+        return self.catalog(get_db).quote(bottle_type, quantity, city)
@@ -0,0 +1,84 @@
+# Token-bucket rate limiting for the auth endpoints.
+#
+# Each key (an IP address, an email) has a bucket of `burst` tokens that
+# refills at `rate` tokens per second; a request takes one token or is
+# refused. A caller that only counts failures checks the bucket first and
+# takes a token once the attempt has failed. Buckets live in a backend:
+#   MemoryBackend  per process, the default
+#   SQLiteBackend  rate_limits table, shared by all workers on the machine
+
+import sqlite3
+import threading
+import time
+
+class MemoryBackend:
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, now):
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            if key not in self._buckets and len(self._buckets) >= self.max_keys:
+                self._prune(now, rate, burst)
+            self._buckets[key] = (tokens, now)
+            return allowed
+
+    def peek(self, key, rate, burst, now):
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+        return min(burst, tokens + (now - updated) * rate) >= 1
+
+    def _prune(self, now, rate, burst):
+        # Drop buckets that have refilled completely; they hold no state worth keeping
+        full_after = burst / rate if rate else float('inf')
+        for key in [k for k, (_, updated) in self._buckets.items() if now - updated >= full_after]:
+            del self._buckets[key]
+
+class SQLiteBackend:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        return conn
+
+    def take(self, key, rate, burst, now):
+        # Refill and take in one UPSERT; the WHERE leaves the row alone when the bucket is empty
+        return self._conn().execute(
+            '''INSERT INTO rate_limits (key, tokens, updated_at) VALUES (?, ?, ?)
+               ON CONFLICT (key) DO UPDATE SET
+                   tokens = MIN(?, tokens + (excluded.updated_at - updated_at) * ?) - 1,
+                   updated_at = excluded.updated_at
+               WHERE MIN(?, tokens + (excluded.updated_at - updated_at) * ?) >= 1''',
+            (key, burst - 1, now, burst, rate, burst, rate)
+        ).rowcount == 1
+
+    def peek(self, key, rate, burst, now):
+        row = self._conn().execute(
+            'SELECT MIN(?, tokens + (? - updated_at) * ?) FROM rate_limits WHERE key = ?',
+            (burst, now, rate, key)
+        ).fetchone()
+        return row is None or row[0] >= 1
+
+class RateLimiter:
+    def __init__(self, backend, name, rate, burst):
+        self.backend = backend
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+
+    def allow(self, key):
+        return self.backend.take(f'{self.name}:{key}', self.rate, self.burst, time.time())
+
+    def check(self, key):
+        """Like allow(), but leaves the token in the bucket"""
+        return self.backend.peek(f'{self.name}:{key}', self.rate, self.burst, time.time())
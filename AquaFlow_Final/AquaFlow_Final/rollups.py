@@ -0,0 +1,227 @@
+# Order rollups: running totals of orders, bottles and revenue.
+#
+# order_rollups holds one row per (scope, scope_key):
+#   total        ''            whole orders table
+#   user         user id       per customer
+#   day          YYYY-MM-DD    per order date
+#   city         city name     per delivery city
+#   bottle_type  bottle type   per product
+# Triggers on orders keep it current on every insert, delete and update, so
+# the dashboards read a single row instead of aggregating orders. On
+# PostgreSQL inserts and deletes are counted once per statement, so a bulk
+# write updates each rollup row once rather than once per order; on SQLite
+# bulk.insert_orders() skips the insert trigger and calls add() instead. Once
+# orders_archive exists the totals cover it too: moving an order into the
+# archive leaves them unchanged.
+
+SCOPES = {
+    'total': "''",
+    'user': 'CAST({row}.user_id AS TEXT)',
+    'day': 'date({row}.order_date)',
+    'city': "COALESCE({row}.city, '')",
+    'bottle_type': '{row}.bottle_type',
+}
+
+def _key(scope, row, dialect):
+    key = SCOPES[scope].format(row=row)
+    # Postgres won't UNION a date with text
+    return f'CAST({key} AS TEXT)' if dialect == 'postgres' else key
+
+_ACCUMULATE = '''ON CONFLICT (scope, scope_key) DO UPDATE SET
+    order_count = order_rollups.order_count + excluded.order_count,
+    quantity = order_rollups.quantity + excluded.quantity,
+    revenue = order_rollups.revenue + excluded.revenue;'''
+
+def _upsert(row, sign, dialect='sqlite'):
+    values = ',\n'.join(
+        f"('{scope}', {_key(scope, row, dialect)}, {sign}1, {sign}{row}.quantity, {sign}{row}.total_price)"
+        for scope in SCOPES
+    )
+    return f'''INSERT INTO order_rollups (scope, scope_key, order_count, quantity, revenue)
+VALUES {values}
+{_ACCUMULATE}'''
+
+_ROLLUP_COLUMNS = 'user_id, order_date, city, bottle_type, quantity, total_price'
+
+def _totals_sql(source, alias, dialect, sign=''):
+    """The rollup rows of the orders in source, which is referred to as alias; sign '-' negates them"""
+    selects = []
+    for scope in SCOPES:
+        key = _key(scope, alias, dialect)
+        selects.append(
+            f"SELECT '{scope}' AS scope, {key} AS scope_key, {sign}COUNT(*) AS order_count, "
+            f"{sign}COALESCE(SUM(quantity), 0) AS quantity, {sign}COALESCE(SUM(total_price), 0) AS revenue "
+            f"FROM {source} GROUP BY {key}"
+        )
+    return '\nUNION ALL\n'.join(selects)
+
+def _expected_sql(db):
+    source = 'orders'
+    if db.table_exists('orders_archive'):
+        source = (f'(SELECT {_ROLLUP_COLUMNS} FROM orders UNION ALL '
+                  f'SELECT {_ROLLUP_COLUMNS} FROM orders_archive) AS orders')
+    return _totals_sql(source, 'orders', db.dialect)
+
+def install(db):
+    """Creates the rollup table and its triggers, then fills it from orders"""
+    db.execute(
+        '''CREATE TABLE IF NOT EXISTS order_rollups (
+               scope TEXT NOT NULL,
+               scope_key TEXT NOT NULL,
+               order_count INTEGER NOT NULL DEFAULT 0,
+               quantity INTEGER NOT NULL DEFAULT 0,
+               revenue REAL NOT NULL DEFAULT 0,
+               PRIMARY KEY (scope, scope_key)
+           ) WITHOUT ROWID'''
+    )
+    if db.dialect == 'postgres':
+        _install_postgres_triggers(db, archive=False)
+        rebuild(db)
+        return
+    db.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_orders_rollup_insert AFTER INSERT ON orders
+BEGIN
+{_upsert('NEW', '')}
+END''')
+    db.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_orders_rollup_delete AFTER DELETE ON orders
+BEGIN
+{_upsert('OLD', '-')}
+END''')
+    db.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_orders_rollup_update
+AFTER UPDATE OF user_id, order_date, city, bottle_type, quantity, total_price ON orders
+BEGIN
+{_upsert('OLD', '-')}
+{_upsert('NEW', '')}
+END''')
+    rebuild(db)
+
+def install_insert_trigger(db, when):
+    """Recreates the SQLite insert trigger so that it only fires for rows where when holds"""
+    db.execute('DROP TRIGGER IF EXISTS trg_orders_rollup_insert')
+    db.execute(f'''CREATE TRIGGER trg_orders_rollup_insert AFTER INSERT ON orders
+WHEN {when}
+BEGIN
+{_upsert('NEW', '')}
+END''')
+
+def add(db, source, alias):
+    """Adds the orders in source, referred to as alias, to the totals in one statement"""
+    # WHERE true: without it SQLite would read ON CONFLICT as a join constraint
+    db.execute(f'''INSERT INTO order_rollups (scope, scope_key, order_count, quantity, revenue)
+SELECT * FROM ({_totals_sql(source, alias, db.dialect)}) AS totals WHERE true
+{_ACCUMULATE}''')
+
+def install_archive(db):
+    """Makes the triggers treat orders_archive as part of the totals.
+
+    archive.py inserts a row into orders_archive before deleting it from
+    orders, so the delete trigger skips rows that already have an archive
+    copy. Deleting from the archive itself still subtracts.
+    """
+    if db.dialect == 'postgres':
+        _install_postgres_triggers(db, archive=True)
+        return
+    db.execute('DROP TRIGGER IF EXISTS trg_orders_rollup_delete')
+    db.execute(f'''CREATE TRIGGER trg_orders_rollup_delete AFTER DELETE ON orders
+WHEN NOT EXISTS (SELECT 1 FROM orders_archive WHERE id = OLD.id)
+BEGIN
+{_upsert('OLD', '-')}
+END''')
+    db.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_orders_archive_rollup_delete AFTER DELETE ON orders_archive
+BEGIN
+{_upsert('OLD', '-')}
+END''')
+
+def _accumulate_totals(source, alias, sign):
+    return f'''INSERT INTO order_rollups (scope, scope_key, order_count, quantity, revenue)
+{_totals_sql(source, alias, 'postgres', sign)}
+{_ACCUMULATE}'''
+
+def _install_postgres_triggers(db, archive):
+    # Inserts and deletes are counted per statement from its transition
+    # table. A trigger with one can have only one event and no column list,
+    # so updates keep a row-level trigger limited to the rollup columns.
+    db.execute(f'''CREATE OR REPLACE FUNCTION orders_rollup() RETURNS trigger AS $$
+BEGIN
+    {_upsert('OLD', '-', 'postgres')}
+    {_upsert('NEW', '', 'postgres')}
+    RETURN NULL;
+END $$ LANGUAGE plpgsql''')
+    db.execute('''CREATE OR REPLACE TRIGGER trg_orders_rollup
+AFTER UPDATE OF user_id, order_date, city, bottle_type, quantity, total_price ON orders
+FOR EACH ROW EXECUTE FUNCTION orders_rollup()''')
+    db.execute(f'''CREATE OR REPLACE FUNCTION orders_rollup_insert() RETURNS trigger AS $$
+BEGIN
+    {_accumulate_totals('new_orders', 'new_orders', '')}
+    RETURN NULL;
+END $$ LANGUAGE plpgsql''')
+    db.execute('''CREATE OR REPLACE TRIGGER trg_orders_rollup_insert AFTER INSERT ON orders
+REFERENCING NEW TABLE AS new_orders FOR EACH STATEMENT EXECUTE FUNCTION orders_rollup_insert()''')
+    deleted = 'old_orders'
+    if archive:
+        deleted = ('(SELECT * FROM old_orders WHERE NOT EXISTS '
+                   '(SELECT 1 FROM orders_archive WHERE orders_archive.id = old_orders.id)) AS old_orders')
+    db.execute(f'''CREATE OR REPLACE FUNCTION orders_rollup_delete() RETURNS trigger AS $$
+BEGIN
+    {_accumulate_totals(deleted, 'old_orders', '-')}
+    RETURN NULL;
+END $$ LANGUAGE plpgsql''')
+    db.execute('''CREATE OR REPLACE TRIGGER trg_orders_rollup_delete AFTER DELETE ON orders
+REFERENCING OLD TABLE AS old_orders FOR EACH STATEMENT EXECUTE FUNCTION orders_rollup_delete()''')
+    if archive:
+        db.execute(f'''CREATE OR REPLACE FUNCTION orders_archive_rollup() RETURNS trigger AS $$
+BEGIN
+    {_accumulate_totals('old_orders', 'old_orders', '-')}
+    RETURN NULL;
+END $$ LANGUAGE plpgsql''')
+        db.execute('''CREATE OR REPLACE TRIGGER trg_orders_archive_rollup_delete AFTER DELETE ON orders_archive
+REFERENCING OLD TABLE AS old_orders FOR EACH STATEMENT EXECUTE FUNCTION orders_archive_rollup()''')
+
+def reinstall_triggers(db):
+    """Recreates the PostgreSQL triggers in their current form; SQLite's haven't changed"""
+    if db.dialect == 'postgres':
+        _install_postgres_triggers(db, archive=db.table_exists('orders_archive'))
+
+def rebuild(db):
+    db.execute('DELETE FROM order_rollups')
+    db.execute(
+        'INSERT INTO order_rollups (scope, scope_key, order_count, quantity, revenue) ' + _expected_sql(db)
+    )
+
+def get(db, scope, key=''):
+    """Returns (order_count, quantity, revenue) for one rollup row, zeros if absent"""
+    row = db.execute(
+        'SELECT order_count, quantity, revenue FROM order_rollups WHERE scope = ? AND scope_key = ?',
+        (scope, str(key))
+    ).fetchone()
+    return tuple(row) if row else (0, 0, 0.0)
+
+def reconcile(db, repair=True):
+    """Compares order_rollups with totals recomputed from orders (and the archive).
+
+    Returns a list of (scope, scope_key, stored, expected) for every row that
+    drifted, where stored/expected are (order_count, quantity, revenue). With
+    repair=True the table is rebuilt when drift is found. Runs under
+    begin_write() so no order can be written between the check and rebuild.
+    """
+    db.commit()
+    db.begin_write('orders')
+    try:
+        stored = {(r[0], r[1]): tuple(r[2:]) for r in db.execute(
+            'SELECT scope, scope_key, order_count, quantity, revenue FROM order_rollups')}
+        expected = {(r[0], r[1]): tuple(r[2:]) for r in db.execute(_expected_sql(db))}
+
+        drift = []
+        for key in sorted(stored.keys() | expected.keys()):
+            have = stored.get(key, (0, 0, 0.0))
+            want = expected.get(key, (0, 0, 0.0))
+            # Revenue is REAL, so allow float noise from many +/- updates
+            if have[:2] != want[:2] or abs(have[2] - want[2]) > 0.005:
+                drift.append((key[0], key[1], have, want))
+
+        if drift and repair:
+            rebuild(db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return drift
@@ -0,0 +1,163 @@
+# Subscription delivery schedules.
+#
+# A subscription delivers on the days its frequency picks, from start_date
+# through end_date (open-ended when NULL), except inside its pause windows:
+#   daily      every day
+#   every      every interval_days days, counted from start_date
+#   weekdays   the days in the weekdays bitmask (Monday 1, Tuesday 2, ... Sunday 64)
+# subscription_pauses holds the pause windows, both ends inclusive.
+#
+# last_generated_date is each subscription's watermark: orders exist for its
+# due days up to that date. generate() creates the orders for every due day
+# after the watermark in one INSERT ... SELECT over subscriptions and the
+# days to cover, so a day with no requests, or an outage, is caught up by
+# the next run instead of being skipped. Large runs go through batches():
+# each range of subscription ids is generated and committed on its own, so
+# the write lock is held for one batch at a time. Dates are ISO 'YYYY-MM-DD'
+# text, which compares in date order on both backends.
+
+from datetime import date, timedelta
+
+import bulk
+
+FREQUENCIES = ('daily', 'every', 'weekdays')
+WEEKDAY_NAMES = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+ALL_WEEKDAYS = 127
+
+# Day number (days since 1970-01-01) of a date column, for the every-N rule
+_DAY_NUMBER = {
+    'sqlite': "CAST(julianday({}) - 2440587.5 AS INTEGER)",
+    'postgres': "(CAST({} AS DATE) - DATE '1970-01-01')",
+}
+
+def install(db):
+    """Adds the schedule columns and the pauses table; existing subscriptions stay daily"""
+    columns = db.column_names('subscriptions')
+    for column, definition in (
+        ('frequency', "TEXT NOT NULL DEFAULT 'daily'"),
+        ('interval_days', 'INTEGER NOT NULL DEFAULT 1'),
+        ('weekdays', f'INTEGER NOT NULL DEFAULT {ALL_WEEKDAYS}'),
+        ('start_date', 'TEXT'),
+        ('end_date', 'TEXT'),
+    ):
+        if column not in columns:
+            db.execute(f'ALTER TABLE subscriptions ADD COLUMN {column} {definition}')
+    # Their orders up to last_generated_date exist already
+    db.execute('UPDATE subscriptions SET start_date = COALESCE(last_generated_date, ?) WHERE start_date IS NULL',
+               (date.today().isoformat(),))
+    db.execute(
+        '''CREATE TABLE IF NOT EXISTS subscription_pauses (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               subscription_id INTEGER NOT NULL REFERENCES subscriptions(id),
+               start_date TEXT NOT NULL,
+               end_date TEXT NOT NULL
+           )'''
+    )
+    db.execute('CREATE INDEX IF NOT EXISTS idx_subscription_pauses_subscription '
+               'ON subscription_pauses (subscription_id, start_date)')
+
+def is_due(subscription, day, pauses=()):
+    """Whether subscription (a row or dict) delivers on day (a date). pauses are (start, end) ISO pairs."""
+    iso = day.isoformat()
+    if iso < subscription['start_date'] or (subscription['end_date'] and iso > subscription['end_date']):
+        return False
+    if any(start <= iso <= end for start, end in pauses):
+        return False
+    if subscription['frequency'] == 'every':
+        elapsed = (day - date.fromisoformat(subscription['start_date'])).days
+        return elapsed % subscription['interval_days'] == 0
+    if subscription['frequency'] == 'weekdays':
+        return bool(subscription['weekdays'] & (1 << day.weekday()))
+    return True
+
+def upcoming(subscription, pauses=(), start=None, count=5, horizon=366):
+    """The next count delivery dates from start (default today), looking at most horizon days ahead"""
+    day = start or date.today()
+    dates = []
+    for _ in range(horizon):
+        if len(dates) == count:
+            break
+        if is_due(subscription, day, pauses):
+            dates.append(day)
+        day += timedelta(days=1)
+    return dates
+
+def describe(subscription):
+    """'Daily', 'Every 3 days' or 'Mon, Wed, Fri'"""
+    if subscription['frequency'] == 'every':
+        return f"Every {subscription['interval_days']} days"
+    if subscription['frequency'] == 'weekdays':
+        return ', '.join(name for i, name in enumerate(WEEKDAY_NAMES) if subscription['weekdays'] & (1 << i))
+    return 'Daily'
+
+def batches(db, size, user_id=None):
+    """Yields (first_id, last_id) ranges of at most size subscriptions, in id order"""
+    user_filter, user_params = '', []
+    if user_id is not None:
+        user_filter, user_params = ' AND user_id = ?', [user_id]
+    last_id = 0
+    while True:
+        ids = [row[0] for row in db.execute(
+            f'SELECT id FROM subscriptions WHERE id > ?{user_filter} ORDER BY id LIMIT ?',
+            [last_id] + user_params + [size]
+        ).fetchall()]
+        if not ids:
+            return
+        yield ids[0], ids[-1]
+        last_id = ids[-1]
+
+def generate(db, through, since, user_id=None, id_range=None):
+    """Inserts the orders of every due (subscription, day) after each watermark, up to through.
+
+    Days before since are never generated, which bounds the backfill after a
+    long outage. id_range, a (first_id, last_id) pair from batches(), limits
+    the run to those subscriptions. The unique (subscription_id,
+    delivery_date) index makes a re-run a no-op. Advances the watermarks and
+    returns the number of orders created; the caller commits.
+    """
+    user_filter, user_params = '', []
+    if user_id is not None:
+        user_filter, user_params = ' AND s.user_id = ?', [user_id]
+    if id_range is not None:
+        user_filter += ' AND s.id BETWEEN ? AND ?'
+        user_params += list(id_range)
+    # Nothing is due before the oldest watermark (or start of a subscription without one)
+    oldest = db.execute(
+        'SELECT MIN(COALESCE(last_generated_date, start_date)) FROM subscriptions AS s WHERE true' + user_filter,
+        user_params
+    ).fetchone()[0]
+    first = max(date.fromisoformat(since), date.fromisoformat(oldest or through))
+    days = [first + timedelta(days=n) for n in range((date.fromisoformat(through) - first).days + 1)]
+    if not days:
+        return 0
+    values = ', '.join('(?, ?, ?)' for _ in days)
+    params = [value for day in days
+              for value in (day.isoformat(), (day - date(1970, 1, 1)).days, 1 << day.weekday())]
+    created = bulk.insert_orders(
+        db,
+        f'''INSERT INTO orders
+            (user_id, bottle_type, quantity, total_price, order_type, status, order_date,
+             address, city, subscription_id, delivery_date)
+            WITH days (day, day_number, weekday) AS (VALUES {values})
+            SELECT s.user_id, s.bottle_type, s.quantity, s.total_price, 'subscription', 'pending', CURRENT_TIMESTAMP,
+                   COALESCE(l.address, 'Unknown'), COALESCE(l.city, 'Unknown'), s.id, days.day
+            FROM subscriptions s
+            JOIN days ON days.day > COALESCE(s.last_generated_date, '') AND days.day >= s.start_date
+                     AND (s.end_date IS NULL OR days.day <= s.end_date)
+            LEFT JOIN locations l ON l.id = s.location_id
+            WHERE (s.frequency = 'daily'
+                   OR (s.frequency = 'every'
+                       AND (days.day_number - {_DAY_NUMBER[db.dialect].format('s.start_date')}) % s.interval_days = 0)
+                   OR (s.frequency = 'weekdays' AND (s.weekdays & days.weekday) <> 0))
+              AND NOT EXISTS (SELECT 1 FROM subscription_pauses p WHERE p.subscription_id = s.id
+                              AND days.day BETWEEN p.start_date AND p.end_date){user_filter}
+            ON CONFLICT DO NOTHING''',
+        params + user_params
+    )
+
+    db.execute(
+        'UPDATE subscriptions AS s SET last_generated_date = ? '
+        'WHERE (s.last_generated_date IS NULL OR s.last_generated_date < ?)' + user_filter,
+        [through, through] + user_params
+    )
+    return created
@@ -0,0 +1,162 @@
+# Admin search over customers, locations and order addresses.
+#
+# On SQLite each searchable table gets an external-content FTS5 index (the
+# index stores no copy of the text) kept in sync by triggers:
+#   users_fts           name, email, phone
+#   locations_fts       address, city
+#   orders_fts          address, city
+#   orders_archive_fts  address, city
+# On PostgreSQL the same columns get a GIN index on their tsvector instead,
+# which the database maintains itself. Its parser would keep an email address
+# or a URL as one token, so the text is first split at punctuation the way
+# FTS5 splits it.
+#
+# Every query word of two or more characters is matched as a prefix ("kar"
+# finds Karachi) and all words must match. FTS5 only answers a prefix query
+# without merging the doclists of every matching term when it has a prefix
+# index of that length, so there is one for each of PREFIX_LENGTHS and longer
+# words are cut to the longest.
+#
+# A common word ("house" is in nearly every address) matches millions of
+# orders, so only the newest CANDIDATES matches of each index are read.
+# Customers and locations are ordered by relevance (bm25 / ts_rank) among
+# those. Orders are listed newest first, since relevance needs each word's
+# document count, which means reading its whole doclist; that order is the
+# index's own, so reading stops at the end of the requested page.
+
+import re
+
+# Matches read per index, newest first; caps the work of a query
+CANDIDATES = 1000
+PREFIX_LENGTHS = range(2, 11)
+
+# name -> (table, indexed columns)
+INDEXES = {
+    'users': ('users', ('name', 'email', 'phone')),
+    'locations': ('locations', ('address', 'city')),
+    'orders': ('orders', ('address', 'city')),
+    'orders_archive': ('orders_archive', ('address', 'city')),
+}
+RANKED = ('users', 'locations')
+
+# kind -> {index: SQL of its result rows}; {ids} is that index's (id, score) subquery
+_ORDER_RESULTS = ('SELECT o.id, o.order_date, o.status, o.order_type, o.bottle_type, o.quantity, o.total_price, '
+                  'o.address, o.city, users.name AS user_name, hits.score '
+                  'FROM ({ids}) AS hits JOIN {table} AS o ON o.id = hits.id JOIN users ON users.id = o.user_id')
+RESULTS = {
+    'customers': {
+        'users': 'SELECT users.id, users.name, users.email, users.phone, users.role, hits.score '
+                 'FROM ({ids}) AS hits JOIN users ON users.id = hits.id',
+    },
+    'locations': {
+        'locations': 'SELECT locations.id, locations.label, locations.address, locations.city, '
+                     'users.name AS user_name, users.email, hits.score '
+                     'FROM ({ids}) AS hits JOIN locations ON locations.id = hits.id '
+                     'JOIN users ON users.id = locations.user_id',
+    },
+    'orders': {
+        'orders': _ORDER_RESULTS.replace('{table}', 'orders'),
+        'orders_archive': _ORDER_RESULTS.replace('{table}', 'orders_archive'),
+    },
+}
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+def _document(columns):
+    return " || ' ' || ".join(f"COALESCE({column}, '')" for column in columns)
+
+def _vector(columns):
+    """The PostgreSQL tsvector of columns, as the search indexes are built on it"""
+    return f"to_tsvector('simple', regexp_replace({_document(columns)}, '\\W+', ' ', 'g'))"
+
+def install(db):
+    """Creates the search indexes and their triggers and fills them from the existing rows"""
+    for name, (table, columns) in INDEXES.items():
+        if db.dialect == 'postgres':
+            db.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_search ON {table} "
+                       f"USING GIN ({_vector(columns)})")
+            continue
+        column_list = ', '.join(columns)
+        new_values = ', '.join(f'new.{column}' for column in columns)
+        old_values = ', '.join(f'old.{column}' for column in columns)
+        db.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {name}_fts USING fts5({column_list}, content='{table}', "
+            f"content_rowid='id', tokenize='unicode61 remove_diacritics 2', "
+            f"prefix='{' '.join(map(str, PREFIX_LENGTHS))}')"
+        )
+        # External content: the index is told the old values to remove them
+        db.execute(f'''CREATE TRIGGER IF NOT EXISTS {name}_fts_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {name}_fts (rowid, {column_list}) VALUES (new.id, {new_values}); END''')
+        db.execute(f'''CREATE TRIGGER IF NOT EXISTS {name}_fts_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO {name}_fts ({name}_fts, rowid, {column_list}) VALUES ('delete', old.id, {old_values}); END''')
+        db.execute(f'''CREATE TRIGGER IF NOT EXISTS {name}_fts_update AFTER UPDATE OF {column_list} ON {table} BEGIN
+                INSERT INTO {name}_fts ({name}_fts, rowid, {column_list}) VALUES ('delete', old.id, {old_values});
+                INSERT INTO {name}_fts (rowid, {column_list}) VALUES (new.id, {new_values}); END''')
+    rebuild(db)
+
+def install_insert_trigger(db, name, when):
+    """Recreates the SQLite insert trigger of one index so that it only fires for rows where when holds"""
+    table, columns = INDEXES[name]
+    new_values = ', '.join(f'new.{column}' for column in columns)
+    db.execute(f'DROP TRIGGER IF EXISTS {name}_fts_insert')
+    db.execute(f'''CREATE TRIGGER {name}_fts_insert AFTER INSERT ON {table} WHEN {when} BEGIN
+            INSERT INTO {name}_fts (rowid, {', '.join(columns)}) VALUES (new.id, {new_values}); END''')
+
+def index_rows(db, name, after_id, upto_id):
+    """Adds the rows with after_id < id <= upto_id to one SQLite index in one statement"""
+    table, columns = INDEXES[name]
+    column_list = ', '.join(columns)
+    db.execute(f'INSERT INTO {name}_fts (rowid, {column_list}) SELECT id, {column_list} FROM {table} '
+               f'WHERE id > ? AND id <= ?', (after_id, upto_id))
+
+def rebuild(db):
+    """Rebuilds every search index from its table, e.g. after restoring a backup"""
+    for name, (table, _) in INDEXES.items():
+        if db.dialect == 'postgres':
+            db.execute(f'REINDEX INDEX idx_{name}_search')
+        else:
+            db.execute(f"INSERT INTO {name}_fts ({name}_fts) VALUES ('rebuild')")
+            db.execute(f"INSERT INTO {name}_fts ({name}_fts) VALUES ('optimize')")
+
+def words(query):
+    """The searchable words of a query, lowercased; punctuation only separates them"""
+    return [word.lower()[:PREFIX_LENGTHS[-1]] for word in _WORD.findall(query)][:8]
+
+def _scored_ids(db, name, terms, limit):
+    """SQL and params for the (id, score) rows of the newest limit matches of one index"""
+    table, columns = INDEXES[name]
+    # A single character is matched as a whole word: "1" is house number 1, not everything starting with 1
+    prefix = [len(term) >= PREFIX_LENGTHS[0] for term in terms]
+    if db.dialect == 'postgres':
+        vector = _vector(columns)
+        query = ' & '.join(term + (':*' if p else '') for term, p in zip(terms, prefix))
+        score = f"ts_rank({vector}, to_tsquery('simple', ?))" if name in RANKED else '0'
+        return (f"SELECT id, {score} AS score FROM {table} "
+                f"WHERE {vector} @@ to_tsquery('simple', ?) ORDER BY id DESC LIMIT ?",
+                ([query] if name in RANKED else []) + [query, limit])
+    # FTS5 walks its doclists in rowid order and stops at the LIMIT.
+    # bm25 is lower for better matches; negated so higher is better.
+    query = ' '.join(f'"{term}"' + ('*' if p else '') for term, p in zip(terms, prefix))
+    score = f'-bm25({name}_fts)' if name in RANKED else '0'
+    return (f'SELECT rowid AS id, {score} AS score FROM {name}_fts WHERE {name}_fts MATCH ? '
+            f'ORDER BY rowid DESC LIMIT ?', [query, limit])
+
+def search(db, kind, query, page=1, per_page=20):
+    """One page of results of kind ('customers', 'locations' or 'orders') for query.
+
+    Returns (rows, has_more). Orders cover the live table and the archive.
+    """
+    terms = words(query)
+    if not terms:
+        return [], False
+    parts, params = [], []
+    for name, sql in RESULTS[kind].items():
+        limit = CANDIDATES if name in RANKED else min(CANDIDATES, page * per_page + 1)
+        ids, ids_params = _scored_ids(db, name, terms, limit)
+        parts.append(sql.format(ids=ids))
+        params += ids_params
+    rows = db.execute(
+        f"SELECT * FROM ({' UNION ALL '.join(parts)}) AS results ORDER BY score DESC, id DESC LIMIT ? OFFSET ?",
+        params + [per_page + 1, (page - 1) * per_page]
+    ).fetchall()
+    return rows[:per_page], len(rows) > per_page
@@ -0,0 +1,43 @@
+/**
+ * Live updates for the delivery and van panels.
+ * Listens to the panel's Server-Sent Events stream and applies deltas:
+ * - claimed / completed: drop those orders from the pending list
+ * - created / generated: offer a refresh for the new orders
+ */
+
+document.addEventListener('DOMContentLoaded', () => {
+    const panel = document.querySelector('[data-stream-url]');
+    if (!panel || !window.EventSource) {
+        return;
+    }
+
+    const source = new EventSource(panel.dataset.streamUrl);
+    let newOrders = 0;
+    let notice = null;
+
+    function removeOrders(event) {
+        const data = JSON.parse(event.data);
+        data.ids.forEach(id => {
+            const row = document.querySelector(`tr[data-order-id="${id}"]`);
+            if (row) {
+                row.remove();
+            }
+        });
+    }
+
+    function announceOrders(count) {
+        newOrders += count;
+        if (!notice) {
+            notice = document.createElement('div');
+            notice.className = 'alert alert-success';
+            panel.prepend(notice);
+        }
+        notice.innerHTML = `${newOrders} new order${newOrders === 1 ? '' : 's'} available. ` +
+            '<a href="">Refresh</a>';
+    }
+
+    source.addEventListener('claimed', removeOrders);
+    source.addEventListener('completed', removeOrders);
+    source.addEventListener('created', event => announceOrders(JSON.parse(event.data).orders || 1));
+    source.addEventListener('generated', event => announceOrders(JSON.parse(event.data).count));
+});
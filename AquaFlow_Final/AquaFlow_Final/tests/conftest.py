@@ -0,0 +1,61 @@
+# Test fixtures. Run from the app directory with `python -m pytest` (pip install pytest).
+#
+# Every test runs twice: on a fresh SQLite database in its own temporary
+# directory, and on PostgreSQL when TEST_DATABASE_URL names a database,
+# e.g. postgresql://aqua@127.0.0.1/aquaflow_test. That database is emptied
+# (its public schema dropped) before each test, so don't point it at one
+# you want to keep. water_supply.db is never opened.
+
+import os
+import sys
+from datetime import date
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as aquaflow  # noqa: E402
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+def config(request, tmp_path):
+    """The create_app() overrides of one test's database"""
+    config = {
+        'TESTING': True,
+        'DB_BACKEND': request.param,
+        'DATABASE': str(tmp_path / 'test.db'),
+        'TEMPLATE_CACHE_DIR': str(tmp_path / 'templates'),
+    }
+    if request.param == 'postgres':
+        url = os.environ.get('TEST_DATABASE_URL')
+        if not url:
+            pytest.skip('set TEST_DATABASE_URL to run against PostgreSQL')
+        psycopg = pytest.importorskip('psycopg')
+        with psycopg.connect(url, autocommit=True) as conn:
+            conn.execute('DROP SCHEMA public CASCADE')
+            conn.execute('CREATE SCHEMA public')
+        config['DATABASE_URL'] = url
+    return config
+
+@pytest.fixture
+def app(config):
+    flask_app = aquaflow.create_app(config)
+    with flask_app.app_context():
+        aquaflow.bootstrap()
+    # Tests that need a subscription run start it themselves
+    flask_app.extensions['aquaflow'].generation_queued_for = date.today().isoformat()
+    yield flask_app
+    flask_app.extensions['aquaflow'].close()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def login(app, client):
+    """login(email) signs client in as that account without checking a password"""
+    def login(email):
+        with app.app_context():
+            user = aquaflow.get_db().execute('SELECT id, name, role FROM users WHERE email = ?', (email,)).fetchone()
+        with client.session_transaction() as session:
+            session.update(user_id=user['id'], user_name=user['name'], user_role=user['role'])
+    return login
@@ -0,0 +1,76 @@
+# The admin panel: keyset pages of customers and orders, and totals that
+# don't recount the tables on every view.
+
+import html
+import re
+
+import pytest
+from flask import g
+
+import app as aquaflow
+
+CUSTOMERS = 120
+ORDERS = 120
+
+@pytest.fixture
+def seeded(app):
+    with app.app_context():
+        db = aquaflow.get_db()
+        for n in range(CUSTOMERS):
+            db.execute('INSERT INTO users (name, email, phone, password, role) VALUES (?, ?, ?, ?, ?)',
+                       (f'Customer {n}', f'c{n}@example.test', '03000000000', 'unused', 'user'))
+        user_id = db.execute("SELECT MIN(id) FROM users WHERE role = 'user'").fetchone()[0]
+        # Two orders a minute apart share each timestamp, so the cursor needs the id to break ties
+        for n in range(ORDERS):
+            db.execute("INSERT INTO orders (user_id, bottle_type, quantity, total_price, order_type, status, "
+                       "order_date, address, city) VALUES (?, '20 Liter', 1, 200, 'single', 'pending', ?, ?, 'Lahore')",
+                       (user_id, f'2026-03-01 {n // 2 // 60:02d}:{n // 2 % 60:02d}:00', f'House {n}'))
+        db.commit()
+
+def _walk(client, pattern, next_label):
+    """Follows the next_label links from the first admin page; returns the matches of pattern on every page"""
+    seen, url = [], '/admin'
+    while url:
+        page = client.get(url).get_data(as_text=True)
+        seen += re.findall(pattern, page)
+        link = re.search(rf'href="([^"]+)"\s+class="[^"]*">{next_label}', page)
+        url = html.unescape(link.group(1)) if link else None
+    return seen
+
+def test_pages_cover_every_row_once(client, login, seeded):
+    login('admin@water.com')
+    customers = _walk(client, r'c(\d+)@example\.test', 'Next users')
+    assert sorted(map(int, customers)) == list(range(CUSTOMERS))
+    orders = _walk(client, r'House (\d+),', 'Older orders')
+    assert sorted(map(int, orders)) == list(range(ORDERS))
+
+def test_customer_count_waits_for_a_change_to_users(app, client, login, seeded, config):
+    if config['DB_BACKEND'] != 'sqlite':
+        pytest.skip('traces SQLite statements')
+    counts = []
+
+    @app.before_request
+    def trace():
+        g.traced = aquaflow.get_db().raw
+        g.traced.set_trace_callback(lambda sql: counts.append(sql) if 'COUNT(*) FROM users' in sql else None)
+
+    login('admin@water.com')
+    assert client.get('/admin').status_code == 200
+    assert len(counts) == 1
+
+    # A new order re-renders the panel, but the count is reused
+    with app.app_context():
+        db = aquaflow.get_db()
+        db.execute("INSERT INTO orders (user_id, bottle_type, quantity, total_price, order_type, status, address, "
+                   "city) VALUES (1, '20 Liter', 1, 200, 'single', 'pending', 'House 1', 'Lahore')")
+        db.commit()
+    assert client.get('/admin').status_code == 200
+    assert len(counts) == 1
+
+    with app.app_context():
+        db = aquaflow.get_db()
+        db.execute('INSERT INTO users (name, email, phone, password, role) VALUES (?, ?, ?, ?, ?)',
+                   ('Late Customer', 'late@example.test', '03000000000', 'unused', 'user'))
+        db.commit()
+    assert str(CUSTOMERS + 1).encode() in client.get('/admin').data
+    assert len(counts) == 2
@@ -0,0 +1,47 @@
+# Static assets: minified without changing their meaning, fingerprinted by
+# content, and served precompressed with a far-future cache lifetime.
+
+import gzip
+import re
+
+import assets
+
+def test_minifiers_keep_strings_and_statements():
+    assert assets.minify_css('a  >  b {\n  color: red ;\n  /* note */ content: "a  ;  b";\n}\n') == \
+        'a>b{color:red;content:"a  ;  b"}'
+    assert assets.minify_css('a :hover { margin: 0 }') == 'a :hover{margin:0}'
+    # Line breaks stay, for automatic semicolon insertion; a regex isn't taken for a comment or a division
+    js = assets.minify_js('let a = 1  // one\nlet b = a / 2\nconst re = /\\/\\//g;\n/* done */ go("  x  ")\n')
+    assert js.splitlines() == ['let a = 1', 'let b = a / 2', 'const re = /\\/\\//g;', 'go("  x  ")']
+    assert assets.minify_svg('<svg>\n  <!-- icon -->\n  <path d="M 0 0" />\n</svg>') == '<svg><path d="M 0 0" /></svg>'
+
+def test_build_names_files_by_content(tmp_path):
+    (tmp_path / 'style.css').write_text('body {  color: red; }\n' * 20)
+    (tmp_path / 'notes.txt').write_text('not an asset')
+    manifest = assets.build(str(tmp_path))
+    built, sizes = manifest['style.css']
+    assert re.fullmatch(r'dist/style\.[0-9a-f]{10}\.css', built)
+    assert set(manifest) == {'style.css'}
+    assert gzip.decompress((tmp_path / (built + '.gz')).read_bytes()) == (tmp_path / built).read_bytes()
+    assert sizes['gzip'] < sizes['identity']
+    assert assets.load_manifest(str(tmp_path)) == manifest
+
+    # Only a change that survives minification gives a new name
+    (tmp_path / 'style.css').write_text('body{color:red}' * 20)
+    assert assets.build(str(tmp_path))['style.css'][0] == built
+    (tmp_path / 'style.css').write_text('body{color:blue}' * 20)
+    assert assets.build(str(tmp_path))['style.css'][0] != built
+
+def test_pages_link_built_assets(app, client):
+    page = client.get('/login').get_data(as_text=True)
+    built = app.extensions['aquaflow'].static_manifest['style.css'][0]
+    assert f'/static/{built}' in page
+
+    response = client.get(f'/static/{built}', headers={'Accept-Encoding': 'gzip, deflate'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert 'Accept-Encoding' in response.headers['Vary']
+    plain = client.get(f'/static/{built}', headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in plain.headers
+    assert gzip.decompress(response.data) == plain.data
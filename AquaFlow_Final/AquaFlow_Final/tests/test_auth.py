@@ -0,0 +1,100 @@
+# Login under load: a full hashing pool answers 503 at once, and only failed
+# logins count against the rate limits.
+
+import threading
+import time
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+import app as aquaflow
+from hashing import HashPool, HashPoolBusy, max_pending_for
+
+EMAIL = 'customer@example.test'
+PASSWORD = 'correct horse'
+
+@pytest.fixture
+def config(config):
+    # One hashing thread and no queue, so a single slow job fills the pool
+    return dict(config, HASH_WORKERS=1, HASH_MAX_PENDING=0, AUTH_EMAIL_BURST=3, AUTH_EMAIL_PER_MINUTE=1)
+
+@pytest.fixture
+def customer(app):
+    with app.app_context():
+        db = aquaflow.get_db()
+        db.execute('INSERT INTO users (name, email, phone, password, role) VALUES (?, ?, ?, ?, ?)',
+                   ('Customer', EMAIL, '03000000000', generate_password_hash(PASSWORD), 'user'))
+        db.commit()
+
+def _occupy(pool):
+    """Fills one slot of pool until the returned event is set"""
+    release, started = threading.Event(), threading.Event()
+
+    def job():
+        started.set()
+        release.wait()
+
+    def run():
+        try:
+            pool._run(job)
+        except HashPoolBusy:  # gave up waiting; the job keeps its slot until released
+            pass
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    started.wait()
+    return release, thread
+
+def _login(client, password):
+    response = client.post('/login', data={'email': EMAIL, 'password': password})
+    return response.status_code, response.headers.get('Location')
+
+def test_pending_jobs_stay_below_request_threads():
+    for threads in (1, 2, 4, 8, 16):
+        for workers in (1, 2, 4):
+            assert max_pending_for(threads, workers) + workers <= max(threads // 2, workers)
+
+def test_full_pool_refuses_at_once():
+    pool = HashPool(workers=1, max_pending=0, timeout=5)
+    pwhash = generate_password_hash(PASSWORD)
+    release, thread = _occupy(pool)
+    try:
+        started = time.monotonic()
+        with pytest.raises(HashPoolBusy):
+            pool.check(pwhash, PASSWORD)
+        assert time.monotonic() - started < 0.1
+    finally:
+        release.set()
+        thread.join()
+    assert pool.check(pwhash, PASSWORD)
+
+def test_queued_job_gives_up_after_timeout():
+    pool = HashPool(workers=1, max_pending=1, timeout=0.2)
+    release, thread = _occupy(pool)
+    try:
+        started = time.monotonic()
+        with pytest.raises(HashPoolBusy):
+            pool._run(time.sleep, 0)
+        assert time.monotonic() - started < 1
+    finally:
+        release.set()
+        thread.join()
+
+def test_login_sheds_when_pool_is_full(app, client, customer):
+    release, thread = _occupy(app.extensions['aquaflow'].hash_pool)
+    try:
+        started = time.monotonic()
+        response = client.post('/login', data={'email': EMAIL, 'password': PASSWORD})
+        assert response.status_code == 503
+        assert time.monotonic() - started < 0.1
+    finally:
+        release.set()
+        thread.join()
+    assert _login(client, PASSWORD) == (302, '/dashboard')
+
+def test_only_failed_logins_are_limited(client, customer):
+    for _ in range(5):
+        assert _login(client, PASSWORD) == (302, '/dashboard')
+    for _ in range(3):
+        assert _login(client, 'wrong') == (302, '/login')
+    assert _login(client, PASSWORD)[0] == 429
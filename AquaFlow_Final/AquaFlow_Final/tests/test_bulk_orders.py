@@ -0,0 +1,61 @@
+# The bulk order API: all lines or none, and a retried Idempotency-Key
+# replays the first response instead of ordering again.
+
+import pytest
+
+import app as aquaflow
+
+EMAIL = 'shop@example.test'
+
+@pytest.fixture
+def location_id(app, login):
+    with app.app_context():
+        db = aquaflow.get_db()
+        user_id = db.insert('INSERT INTO users (name, email, phone, password, role) VALUES (?, ?, ?, ?, ?)',
+                            ('Shop', EMAIL, '03000000000', 'unused', 'user'))
+        location_id = db.insert(
+            "INSERT INTO locations (user_id, label, address, city, is_default) VALUES (?, 'Shop', 'Shop 1', 'Lahore', 1)",
+            (user_id,))
+        db.commit()
+    login(EMAIL)
+    return location_id
+
+def _orders(app):
+    with app.app_context():
+        return aquaflow.get_db().execute('SELECT COUNT(*) FROM orders').fetchone()[0]
+
+def test_retry_with_same_key_replays_first_response(app, client, location_id):
+    body = {'orders': [{'bottle_type': '20 Liter', 'quantity': 2, 'location_id': location_id},
+                       {'bottle_type': '2 Liter', 'quantity': 5, 'location_id': location_id}]}
+    headers = {'Idempotency-Key': 'order-42'}
+
+    first = client.post('/api/orders/bulk', json=body, headers=headers)
+    assert first.status_code == 201
+    assert first.get_json()['created'] == 2
+    assert 'Idempotent-Replayed' not in first.headers
+
+    retry = client.post('/api/orders/bulk', json=body, headers=headers)
+    assert retry.status_code == 201
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert retry.get_json() == first.get_json()
+    assert _orders(app) == 2
+
+    # The same key with other lines is a client bug, not a retry
+    body['orders'][0]['quantity'] = 3
+    assert client.post('/api/orders/bulk', json=body, headers=headers).status_code == 422
+    # Without a key every request orders
+    assert client.post('/api/orders/bulk', json=body).status_code == 201
+    assert _orders(app) == 4
+
+def test_invalid_line_inserts_nothing(app, client, location_id):
+    body = {'orders': [{'bottle_type': '20 Liter', 'quantity': 2, 'location_id': location_id},
+                       {'bottle_type': '20 Liter', 'quantity': 1, 'location_id': location_id + 1},
+                       {'bottle_type': 'Barrel', 'quantity': 1, 'location_id': location_id}]}
+    response = client.post('/api/orders/bulk', json=body, headers={'Idempotency-Key': 'order-43'})
+    assert response.status_code == 400
+    assert [line['line'] for line in response.get_json()['lines']] == [1, 2]
+    assert _orders(app) == 0
+
+    # The failed request didn't use up the key
+    del body['orders'][1:]
+    assert client.post('/api/orders/bulk', json=body, headers={'Idempotency-Key': 'order-43'}).status_code == 201
@@ -0,0 +1,81 @@
+# Order claiming under contention: riders in separate processes race for
+# the same pending orders, one at a time and in batches, and every order
+# must end up claimed exactly once.
+#
+# Each successful claim queues one order_status job listing the orders it
+# changed, so an order claimed twice shows up in two jobs.
+
+import json
+import multiprocessing
+import random
+from datetime import date
+
+import pytest
+
+import app as aquaflow
+
+RIDERS = 6
+ORDERS = 300
+
+def _rider(config, email, order_ids, seed, barrier):
+    flask_app = aquaflow.create_app(config)
+    flask_app.extensions['aquaflow'].generation_queued_for = date.today().isoformat()
+    client = flask_app.test_client()
+    with flask_app.app_context():
+        user = aquaflow.get_db().execute('SELECT id, name, role FROM users WHERE email = ?', (email,)).fetchone()
+    with client.session_transaction() as session:
+        session.update(user_id=user['id'], user_name=user['name'], user_role=user['role'])
+
+    rng = random.Random(seed)
+    order_ids = list(order_ids)
+    rng.shuffle(order_ids)
+    barrier.wait()
+    while order_ids:
+        if rng.random() < 0.5:
+            response = client.post(f'/delivery/accept/{order_ids.pop()}')
+        else:
+            size = rng.randint(2, 20)
+            batch, order_ids = order_ids[:size], order_ids[size:]
+            response = client.post('/delivery/accept_batch', data={'order_ids': batch})
+        assert response.status_code == 302
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason='needs fork')
+def test_concurrent_claims_take_each_order_once(app, config):
+    with app.app_context():
+        db = aquaflow.get_db()
+        emails = [f'rider{n}@example.test' for n in range(RIDERS)]
+        db.executemany('INSERT INTO users (name, email, phone, password, role) VALUES (?, ?, ?, ?, ?)',
+                       [(f'Rider {n}', email, '03000000000', 'unused', ('delivery', 'van')[n % 2])
+                        for n, email in enumerate(emails)])
+        customer_id = db.execute("SELECT id FROM users WHERE role = 'admin'").fetchone()[0]
+        db.executemany(
+            "INSERT INTO orders (user_id, bottle_type, quantity, total_price, order_type, status, address, city) "
+            "VALUES (?, '20 Liter', 1, 200, 'single', 'pending', 'House 1', 'Lahore')",
+            [(customer_id,)] * ORDERS)
+        db.commit()
+        order_ids = [row[0] for row in db.execute('SELECT id FROM orders ORDER BY id')]
+
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(RIDERS)
+    riders = [context.Process(target=_rider, args=(config, email, order_ids, n, barrier))
+              for n, email in enumerate(emails)]
+    for rider in riders:
+        rider.start()
+    for rider in riders:
+        rider.join(timeout=300)
+    assert [rider.exitcode for rider in riders] == [0] * RIDERS
+
+    with app.app_context():
+        db = aquaflow.get_db()
+        claims = {}
+        for (payload,) in db.execute("SELECT payload FROM jobs WHERE kind = 'order_status'"):
+            payload = json.loads(payload)
+            if payload['status'] == 'out_for_delivery':
+                for order_id in payload['order_ids']:
+                    claims[order_id] = claims.get(order_id, 0) + 1
+        assert sorted(claims) == order_ids
+        assert {order_id: count for order_id, count in claims.items() if count > 1} == {}
+
+        holders = dict(db.execute('SELECT id, delivery_boy_id FROM orders'))
+        assert all(holders[order_id] is not None for order_id in order_ids)
+        assert db.execute("SELECT COUNT(*) FROM orders WHERE status <> 'out_for_delivery'").fetchone()[0] == 0
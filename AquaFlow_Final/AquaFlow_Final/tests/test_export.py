@@ -0,0 +1,71 @@
+# The order export streams: its peak memory doesn't grow with the number of
+# rows exported.
+#
+# Each export runs in a forked process that starts from the same memory, so
+# the difference between the peak RSS of a small and a large export is what
+# the extra rows cost. Those processes don't memory-map the database and
+# keep a small page cache, which would otherwise fill with the file as it
+# is read.
+
+import multiprocessing
+import resource
+from datetime import date
+
+import pytest
+
+import app as aquaflow
+import bulk
+
+ORDERS = 100_000
+FIRST_DAY_ORDERS = 2_000
+# A materialized export of ORDERS rows needs well over this
+MAX_GROWTH_KB = 16 * 1024
+
+def _export(config, query, pipe):
+    flask_app = aquaflow.create_app(config)
+    flask_app.extensions['aquaflow'].generation_queued_for = date.today().isoformat()
+    client = flask_app.test_client()
+    with flask_app.app_context():
+        admin = aquaflow.get_db().execute("SELECT id, name FROM users WHERE role = 'admin'").fetchone()
+    with client.session_transaction() as session:
+        session.update(user_id=admin['id'], user_name=admin['name'], user_role='admin')
+
+    response = client.get('/admin/export/orders.csv' + query, buffered=False)
+    lines = sum(chunk.count(b'\n') for chunk in response.response)
+    response.close()
+    pipe.send((response.status_code, lines, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+def _run_export(context, config, query):
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_export, args=(config, query, sender))
+    process.start()
+    result = receiver.recv()
+    process.join()
+    return result
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason='needs fork')
+def test_export_memory_stays_flat(app, config):
+    with app.app_context():
+        db = aquaflow.get_db()
+        user_id = db.execute("SELECT id FROM users WHERE role = 'admin'").fetchone()[0]
+        bulk.insert_orders(
+            db,
+            '''INSERT INTO orders (user_id, bottle_type, quantity, total_price, order_type, status, order_date,
+                                   address, city)
+               WITH RECURSIVE n (i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?)
+               SELECT ?, '20 Liter', 1 + i % 5, 200.0 * (1 + i % 5), 'single', 'delivered',
+                      CASE WHEN i <= ? THEN '2026-01-01 09:00:00' ELSE '2026-01-02 09:00:00' END,
+                      'House ' || i, 'Lahore'
+               FROM n''',
+            (ORDERS, user_id, FIRST_DAY_ORDERS)
+        )
+        db.commit()
+
+    context = multiprocessing.get_context('fork')
+    config = dict(config, DB_MMAP_SIZE=0, DB_CACHE_SIZE_KB=2000)
+    small = _run_export(context, config, '?date_from=2026-01-01&date_to=2026-01-01')
+    large = _run_export(context, config, '')
+    # One header line each
+    assert small[:2] == (200, FIRST_DAY_ORDERS + 1)
+    assert large[:2] == (200, ORDERS + 1)
+    assert large[2] - small[2] < MAX_GROWTH_KB
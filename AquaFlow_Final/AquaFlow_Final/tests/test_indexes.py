@@ -0,0 +1,96 @@
+# The queries behind the customer, rider and admin pages use an index.
+#
+# Rather than copying the SQL out of app.py, the test requests the pages and
+# records what they run with sqlite3's trace callback, which reports each
+# statement with its bound values. Every SELECT is then checked with
+# EXPLAIN QUERY PLAN.
+
+import re
+from datetime import date, timedelta
+
+import pytest
+from flask import g
+
+import app as aquaflow
+
+CUSTOMER = 'customer@example.test'
+
+PAGES = {
+    CUSTOMER: ('/dashboard', '/order_history', '/locations', '/subscription', '/order'),
+    'delivery@water.com': ('/delivery',),
+    'van@water.com': ('/van',),
+    'admin@water.com': (
+        '/admin',
+        '/admin?status=pending',
+        '/admin?order_type=subscription',
+        '/admin?city=Lahore',
+        f'/admin?date_from={date.today() - timedelta(days=7)}&date_to={date.today()}',
+        '/admin?status=delivered&city=Lahore',
+    ),
+}
+
+# Tables that grow with customers and orders. The catalog tables (products,
+# product_prices, ...) and data_versions are small and read whole on purpose.
+GROWING_TABLES = {'users', 'locations', 'subscriptions', 'subscription_pauses', 'orders', 'orders_archive',
+                  'order_rollups', 'geocodes'}
+
+# A plan step that reads a whole table: "SCAN orders", but not "SCAN orders USING INDEX ..."
+FULL_SCAN = re.compile(r'^SCAN (\w+)$')
+
+def _seed(db):
+    rider_id = db.execute("SELECT id FROM users WHERE role = 'delivery'").fetchone()[0]
+    user_id = db.insert('INSERT INTO users (name, email, phone, password, role) VALUES (?, ?, ?, ?, ?)',
+                        ('Customer', CUSTOMER, '03000000000', 'unused', 'user'))
+    location_id = db.insert(
+        "INSERT INTO locations (user_id, label, address, city, is_default) VALUES (?, 'Home', 'House 1', 'Lahore', 1)",
+        (user_id,))
+    db.execute("INSERT INTO subscriptions (user_id, bottle_type, quantity, total_price, location_id, start_date) "
+               "VALUES (?, '20 Liter', 1, 200, ?, ?)", (user_id, location_id, date.today().isoformat()))
+    for n, (order_type, status) in enumerate([('single', 'pending'), ('subscription', 'pending'),
+                                              ('single', 'out_for_delivery'), ('single', 'delivered')] * 5):
+        db.execute(
+            "INSERT INTO orders (user_id, bottle_type, quantity, total_price, order_type, status, order_date, "
+            "address, city, delivery_boy_id) VALUES (?, '20 Liter', 1, 200, ?, ?, ?, 'House 1', 'Lahore', ?)",
+            (user_id, order_type, status, f'{date.today() - timedelta(days=n)} 09:00:00',
+             rider_id if status != 'pending' else None))
+    db.commit()
+
+@pytest.fixture
+def statements(app, config):
+    """The statements run by the requests of the test, with their values bound"""
+    if config['DB_BACKEND'] != 'sqlite':
+        pytest.skip('traces and explains SQLite statements')
+    captured = []
+
+    @app.before_request
+    def trace():
+        g.traced = aquaflow.get_db().raw
+        g.traced.set_trace_callback(captured.append)
+
+    @app.teardown_request
+    def untrace(exception):
+        if 'traced' in g:
+            g.traced.set_trace_callback(None)
+
+    return captured
+
+def test_page_queries_use_indexes(app, client, login, statements):
+    with app.app_context():
+        _seed(aquaflow.get_db())
+
+    for email, pages in PAGES.items():
+        login(email)
+        for page in pages:
+            assert client.get(page).status_code == 200, page
+
+    selects = {sql for sql in statements if re.match(r'\s*(SELECT|WITH)\b', sql, re.I)}
+    assert any('FROM orders' in sql for sql in selects)
+    scans = {}
+    with app.app_context():
+        db = aquaflow.get_db()
+        for sql in selects:
+            for row in db.execute('EXPLAIN QUERY PLAN ' + sql):
+                match = FULL_SCAN.match(row[3])
+                if match and match.group(1) in GROWING_TABLES:
+                    scans[' '.join(sql.split())] = row[3]
+    assert scans == {}
@@ -0,0 +1,114 @@
+# The job queue: jobs commit with the change that queued them, failures are
+# retried and then dead-lettered, and a worker runs what is due.
+
+import threading
+import time
+
+import pytest
+
+import app as aquaflow
+import jobs
+
+SEEN = []
+
+@jobs.handler('test_record')
+def record(db, payload):
+    SEEN.append(payload)
+
+@jobs.handler('test_fail')
+def fail(db, payload):
+    raise RuntimeError('provider down')
+
+@pytest.fixture(autouse=True)
+def seen():
+    SEEN.clear()
+    return SEEN
+
+def _statuses(db):
+    return [tuple(row) for row in db.execute('SELECT kind, status, attempts FROM jobs ORDER BY id')]
+
+def test_job_commits_with_its_change(app):
+    with app.app_context():
+        db = aquaflow.get_db()
+        jobs.enqueue(db, 'test_record', {'n': 1})
+        db.rollback()
+        assert _statuses(db) == []
+
+        jobs.enqueue(db, 'test_record', {'n': 2})
+        db.commit()
+        assert jobs.run_one(db)
+        assert not jobs.run_one(db)
+        assert SEEN == [{'n': 2}]
+        assert _statuses(db) == [('test_record', 'done', 1)]
+
+def test_failing_job_backs_off_then_dies(app):
+    with app.app_context():
+        db = aquaflow.get_db()
+        jobs.enqueue(db, 'test_fail', {}, max_attempts=2)
+        db.commit()
+
+        assert jobs.run_one(db, backoff_base=60)
+        assert _statuses(db) == [('test_fail', 'queued', 1)]
+        run_after, error = db.execute('SELECT run_after, last_error FROM jobs').fetchone()
+        assert run_after > time.time() + 25 and 'provider down' in error
+        # Not due yet
+        assert not jobs.run_one(db)
+
+        db.execute('UPDATE jobs SET run_after = 0')
+        db.commit()
+        assert jobs.run_one(db)
+        assert _statuses(db) == [('test_fail', 'dead', 2)]
+
+        assert jobs.retry_dead(db, kind='test_fail') == 1
+        assert _statuses(db) == [('test_fail', 'queued', 0)]
+
+def test_job_of_a_dead_worker_is_requeued(app):
+    with app.app_context():
+        db = aquaflow.get_db()
+        jobs.enqueue(db, 'test_record', {})
+        db.commit()
+        assert jobs.claim(db) is not None
+        assert jobs.requeue_stale(db, timeout=60) == 0
+
+        db.execute('UPDATE jobs SET started_at = started_at - 120')
+        db.commit()
+        assert jobs.requeue_stale(db, timeout=60) == 1
+        assert _statuses(db) == [('test_record', 'queued', 1)]
+
+def test_worker_runs_due_jobs_until_stopped(app):
+    with app.app_context():
+        db = aquaflow.get_db()
+        for n in range(3):
+            jobs.enqueue(db, 'test_record', {'n': n})
+        db.commit()
+
+        stop = threading.Event()
+        worker = threading.Thread(target=jobs.work, args=(aquaflow.get_pool(), stop), kwargs={'poll': 0.01})
+        worker.start()
+        deadline = time.monotonic() + 10
+        while len(SEEN) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        stop.set()
+        worker.join()
+
+        assert SEEN == [{'n': 0}, {'n': 1}, {'n': 2}]
+        assert jobs.stats(db)['depth']['done'] == 3
+
+def test_placing_an_order_queues_its_notification(app, client, login):
+    with app.app_context():
+        db = aquaflow.get_db()
+        user_id = db.insert('INSERT INTO users (name, email, phone, password, role) VALUES (?, ?, ?, ?, ?)',
+                            ('Customer', 'customer@example.test', '03000000000', 'unused', 'user'))
+        location_id = db.insert(
+            "INSERT INTO locations (user_id, label, address, city, is_default) VALUES (?, 'Home', 'House 1', 'Lahore', 1)",
+            (user_id,))
+        db.commit()
+    login('customer@example.test')
+    response = client.post('/order', data={'bottle_type': '20 Liter', 'quantity': '2', 'location_id': location_id})
+    assert response.status_code == 302
+
+    with app.app_context():
+        db = aquaflow.get_db()
+        assert _statuses(db) == [('order_status', 'queued', 0)]
+        assert jobs.run_one(db)
+        assert _statuses(db) == [('order_status', 'done', 1)]
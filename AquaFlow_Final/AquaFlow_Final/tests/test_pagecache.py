@@ -0,0 +1,98 @@
+# Cached panels: a browser holding the current page gets a 304, and a write
+# to a table the page reads serves it afresh.
+
+import pytest
+
+import app as aquaflow
+
+RIDER = 'delivery@water.com'
+
+def _add_order(app, address, order_type='single'):
+    with app.app_context():
+        db = aquaflow.get_db()
+        user_id = db.execute("SELECT id FROM users WHERE role = 'admin'").fetchone()[0]
+        db.execute("INSERT INTO orders (user_id, bottle_type, quantity, total_price, order_type, status, address, city) "
+                   "VALUES (?, '20 Liter', 1, 200, ?, 'pending', ?, 'Lahore')", (user_id, order_type, address))
+        db.commit()
+
+def test_unchanged_panel_answers_304(app, client, login):
+    _add_order(app, 'House 1')
+    login(RIDER)
+
+    first = client.get('/delivery')
+    assert first.status_code == 200
+    assert b'House 1' in first.data
+    etag = first.headers['ETag']
+    assert first.headers['Cache-Control'] == 'private, no-cache'
+
+    again = client.get('/delivery', headers={'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.data == b''
+    assert again.headers['ETag'] == etag
+
+    # A new order moves the orders version, and with it the ETag
+    _add_order(app, 'House 2')
+    changed = client.get('/delivery', headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert b'House 2' in changed.data
+    assert changed.headers['ETag'] != etag
+
+def test_cached_page_is_per_user(app, client, login):
+    with app.app_context():
+        db = aquaflow.get_db()
+        db.execute('INSERT INTO users (name, email, phone, password, role) VALUES (?, ?, ?, ?, ?)',
+                   ('Second Rider', 'rider2@example.test', '03000000000', 'unused', 'delivery'))
+        db.commit()
+    login(RIDER)
+    first = client.get('/delivery')
+    login('rider2@example.test')
+    second = client.get('/delivery', headers={'If-None-Match': first.headers['ETag']})
+    assert second.status_code == 200
+    assert second.headers['ETag'] != first.headers['ETag']
+
+@pytest.mark.parametrize('panel, rider, order_type', [
+    ('/delivery', RIDER, 'single'),
+    ('/van', 'van@water.com', 'subscription'),
+])
+def test_rider_panels_show_renamed_customer(app, client, login, panel, rider, order_type):
+    _add_order(app, 'House 1', order_type)
+    login(rider)
+    first = client.get(panel)
+    assert b'Admin' in first.data
+
+    # The panels show the customer's name and phone from users
+    with app.app_context():
+        db = aquaflow.get_db()
+        db.execute("UPDATE users SET name = 'Renamed Customer' WHERE role = 'admin'")
+        db.commit()
+    again = client.get(panel, headers={'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 200
+    assert b'Renamed Customer' in again.data
+
+def test_van_routes_are_planned_again_only_for_new_subscription_orders(app, client, login, monkeypatch):
+    plans = []
+    plan_batches = aquaflow.dispatch.plan_batches
+    monkeypatch.setattr(aquaflow.dispatch, 'plan_batches', lambda *args: plans.append(args) or plan_batches(*args))
+    _add_order(app, 'House 1', 'subscription')
+    login('van@water.com')
+    assert b'House 1' in client.get('/van').data
+    assert len(plans) == 1
+
+    # A single order re-renders the panel but leaves the routes as they were
+    _add_order(app, 'House 2')
+    assert client.get('/van').status_code == 200
+    assert len(plans) == 1
+
+    _add_order(app, 'House 3', 'subscription')
+    assert b'House 3' in client.get('/van').data
+    assert len(plans) == 2
+
+def test_van_panel_lists_the_oldest_orders_and_routes_them_all(app, client, login, monkeypatch):
+    monkeypatch.setattr(aquaflow, 'VAN_ORDERS_SHOWN', 2)
+    for n in range(3):
+        _add_order(app, f'House {n + 1}', 'subscription')
+    login('van@water.com')
+    page = client.get('/van').data.decode()
+    assert 'Showing the 2 oldest of 3 orders' in page
+    assert page.count('<tr data-order-id=') == 2
+    assert 'House 3' in page
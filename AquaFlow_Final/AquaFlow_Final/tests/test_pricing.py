@@ -0,0 +1,60 @@
+# Pricing: city prices and quantity discounts, and how a catalog change
+# reaches the engine and the subscriptions.
+
+import pytest
+
+import app as aquaflow
+from pricing import PricingEngine, UnknownProduct, current_version
+
+def test_quote_uses_city_price_and_best_discount(app):
+    runner = app.test_cli_runner()
+    assert runner.invoke(args=['set-price', '20 Liter', '180', '--city', 'Karachi']).exit_code == 0
+    assert runner.invoke(args=['set-discount', '20 Liter', '5', '10']).exit_code == 0
+    assert runner.invoke(args=['set-discount', '20 Liter', '10', '20']).exit_code == 0
+
+    with app.app_context():
+        catalog = PricingEngine(check_interval=0).catalog(aquaflow.get_db)
+    assert catalog.quote('20 Liter', 2).total_price == 400
+    assert catalog.quote('20 Liter', 2, ' karachi ').total_price == 360
+    assert catalog.quote('20 Liter', 5, 'Lahore')[3:] == (10, 900)
+    assert catalog.quote('20 Liter', 12, 'Karachi')[3:] == (20, 1728)
+    with pytest.raises(UnknownProduct):
+        catalog.quote('Barrel', 1)
+
+def test_engine_reloads_after_a_price_change(app):
+    engine = PricingEngine(check_interval=3600)
+    with app.app_context():
+        db = aquaflow.get_db()
+        assert engine.quote(aquaflow.get_db, '2 Liter', 1).total_price == 50
+        version = current_version(db)
+
+        # Stock isn't part of a price, so it leaves the version alone
+        db.execute("UPDATE products SET stock = 10 WHERE bottle_type = '2 Liter'")
+        db.commit()
+        assert current_version(db) == version
+
+        db.execute("UPDATE products SET unit_price = 60 WHERE bottle_type = '2 Liter'")
+        db.commit()
+        assert current_version(db) > version
+        # Within the check interval the cached catalog is still used
+        assert engine.quote(aquaflow.get_db, '2 Liter', 1).total_price == 50
+        engine.check_interval = 0
+        assert engine.quote(aquaflow.get_db, '2 Liter', 1).total_price == 60
+
+def test_price_change_reprices_subscriptions(app):
+    with app.app_context():
+        db = aquaflow.get_db()
+        user_id = db.insert('INSERT INTO users (name, email, phone, password, role) VALUES (?, ?, ?, ?, ?)',
+                            ('Customer', 'customer@example.test', '03000000000', 'unused', 'user'))
+        location_id = db.insert(
+            "INSERT INTO locations (user_id, label, address, city, is_default) VALUES (?, 'Home', 'House 1', 'Lahore', 1)",
+            (user_id,))
+        db.execute("INSERT INTO subscriptions (user_id, bottle_type, quantity, total_price, location_id, start_date) "
+                   "VALUES (?, '20 Liter', 3, 600, ?, '2026-01-01')", (user_id, location_id))
+        db.commit()
+
+    result = app.test_cli_runner().invoke(args=['set-price', '20 Liter', '150', '--city', 'Lahore'])
+    assert result.exit_code == 0
+    assert '1 subscriptions repriced' in result.output
+    with app.app_context():
+        assert aquaflow.get_db().execute('SELECT total_price FROM subscriptions').fetchone()[0] == 450
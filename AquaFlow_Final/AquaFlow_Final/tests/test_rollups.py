@@ -0,0 +1,92 @@
+# order_rollups stays equal to totals recomputed from orders and the archive
+# after bulk inserts, concurrent inserts and archival.
+
+import sqlite3
+
+import pytest
+
+import app as aquaflow
+import archive
+import bulk
+import rollups
+
+INSERT_ORDER = ("INSERT INTO orders (user_id, bottle_type, quantity, total_price, order_type, status, order_date, "
+                "address, city) VALUES (?, '20 Liter', ?, ?, 'single', ?, ?, 'House 1', 'Lahore')")
+
+BULK_INSERT = '''INSERT INTO orders (user_id, bottle_type, quantity, total_price, order_type, status, order_date,
+                                     address, city)
+                 WITH RECURSIVE n (i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?)
+                 SELECT ?, '2 Liter', i, 50.0 * i, 'subscription', 'pending', '2026-03-01 09:00:00',
+                        'House ' || i, 'Karachi'
+                 FROM n'''
+
+def _admin_id(db):
+    return db.execute("SELECT id FROM users WHERE role = 'admin'").fetchone()[0]
+
+def test_bulk_insert_matches_recomputed_totals(app):
+    with app.app_context():
+        db = aquaflow.get_db()
+        user_id = _admin_id(db)
+        db.execute(INSERT_ORDER, (user_id, 1, 200.0, 'pending', '2026-03-01 08:00:00'))
+        db.commit()
+
+        assert bulk.insert_orders(db, BULK_INSERT, (40, user_id)) == 40
+        db.commit()
+
+        assert rollups.reconcile(db, repair=False) == []
+        assert rollups.get(db, 'total') == (41, 1 + sum(range(1, 41)), 200.0 + 50.0 * sum(range(1, 41)))
+        assert rollups.get(db, 'city', 'Karachi')[0] == 40
+
+def test_order_committed_during_bulk_insert_is_counted_once(app, config):
+    if config['DB_BACKEND'] != 'sqlite':
+        pytest.skip('interleaves statements with sqlite3 trace callbacks')
+    with app.app_context():
+        db = aquaflow.get_db()
+        user_id = _admin_id(db)
+        db.commit()
+        other = sqlite3.connect(config['DATABASE'], timeout=0)
+        inserted = []
+
+        # Before each statement of the bulk insert another connection tries to
+        # commit an order, so one lands in whatever gap the insert leaves open
+        def interleave(sql):
+            try:
+                other.execute(INSERT_ORDER, (user_id, 2, 150.0, 'pending', '2026-03-01 10:00:00'))
+                other.commit()
+                inserted.append(sql)
+            except sqlite3.OperationalError:  # locked: the bulk insert holds the write lock
+                other.rollback()
+
+        db.raw.set_trace_callback(interleave)
+        try:
+            bulk.insert_orders(db, BULK_INSERT, (3, user_id))
+        finally:
+            db.raw.set_trace_callback(None)
+        db.commit()
+        other.close()
+
+        assert inserted
+        assert rollups.reconcile(db, repair=False) == []
+        assert rollups.get(db, 'total')[0] == 3 + len(inserted)
+
+def test_archive_keeps_totals(app):
+    with app.app_context():
+        db = aquaflow.get_db()
+        user_id = _admin_id(db)
+        for n in range(7):
+            db.execute(INSERT_ORDER, (user_id, n + 1, 100.0 * (n + 1), 'delivered', f'2025-01-0{n + 1} 09:00:00'))
+        db.execute(INSERT_ORDER, (user_id, 1, 100.0, 'pending', '2025-01-01 09:00:00'))
+        db.commit()
+        before = rollups.get(db, 'total')
+
+        assert archive.archive_orders(db, '2025-01-06', batch_size=2, pause=0) == 5
+        assert db.execute('SELECT COUNT(*) FROM orders_archive').fetchone()[0] == 5
+        assert db.execute('SELECT COUNT(*) FROM orders').fetchone()[0] == 3
+        assert rollups.get(db, 'total') == before
+        assert rollups.reconcile(db, repair=False) == []
+
+        # Deleting an archived order still comes off the totals
+        db.execute('DELETE FROM orders_archive WHERE order_date < ?', ('2025-01-02',))
+        db.commit()
+        assert rollups.get(db, 'total')[0] == before[0] - 1
+        assert rollups.reconcile(db, repair=False) == []
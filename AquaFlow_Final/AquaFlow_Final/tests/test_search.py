@@ -0,0 +1,82 @@
+# Admin search: prefix matches of every word, indexes that follow inserts,
+# updates, deletes, bulk inserts and archival, and paging.
+
+import app as aquaflow
+import archive
+import bulk
+import search
+
+def _add_customer(db, name, email, city):
+    user_id = db.insert('INSERT INTO users (name, email, phone, password, role) VALUES (?, ?, ?, ?, ?)',
+                        (name, email, '03001234567', 'unused', 'user'))
+    db.execute("INSERT INTO locations (user_id, label, address, city) VALUES (?, 'Home', ?, ?)",
+               (user_id, f'House 7, {name} Street', city))
+    return user_id
+
+def _names(rows, column='name'):
+    return [row[column] for row in rows]
+
+def test_every_word_matches_as_a_prefix(app):
+    with app.app_context():
+        db = aquaflow.get_db()
+        _add_customer(db, 'Ayesha Khan', 'ayesha@example.test', 'Karachi')
+        _add_customer(db, 'Bilal Khan', 'bilal@example.test', 'Lahore')
+        db.commit()
+
+        assert _names(search.search(db, 'customers', 'khan')[0]) == ['Bilal Khan', 'Ayesha Khan']
+        assert _names(search.search(db, 'customers', 'AYE kha')[0]) == ['Ayesha Khan']
+        assert _names(search.search(db, 'customers', 'bilal@example')[0]) == ['Bilal Khan']
+        assert _names(search.search(db, 'locations', 'kar')[0], 'user_name') == ['Ayesha Khan']
+        assert search.search(db, 'customers', 'khan zzz') == ([], False)
+        assert search.search(db, 'customers', ' !! ') == ([], False)
+
+def test_index_follows_writes(app):
+    with app.app_context():
+        db = aquaflow.get_db()
+        user_id = _add_customer(db, 'Ayesha Khan', 'ayesha@example.test', 'Karachi')
+        db.commit()
+        db.execute("UPDATE users SET name = 'Ayesha Malik' WHERE id = ?", (user_id,))
+        db.commit()
+        assert search.search(db, 'customers', 'khan')[0] == []
+        assert _names(search.search(db, 'customers', 'malik')[0]) == ['Ayesha Malik']
+
+        db.execute('DELETE FROM locations WHERE user_id = ?', (user_id,))
+        db.commit()
+        assert search.search(db, 'locations', 'karachi')[0] == []
+
+def test_orders_include_bulk_inserts_and_archive_newest_first(app):
+    with app.app_context():
+        db = aquaflow.get_db()
+        user_id = db.execute("SELECT id FROM users WHERE role = 'admin'").fetchone()[0]
+        bulk.insert_orders(
+            db,
+            '''INSERT INTO orders (user_id, bottle_type, quantity, total_price, order_type, status, order_date,
+                                   address, city)
+               WITH RECURSIVE n (i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 5)
+               SELECT ?, '20 Liter', 1, 200, 'single', 'delivered', '2025-01-0' || i || ' 09:00:00',
+                      'Shop ' || i || ', Mall Road', 'Lahore'
+               FROM n''',
+            (user_id,)
+        )
+        db.commit()
+        assert archive.archive_orders(db, '2025-01-03', batch_size=10, pause=0) == 2
+
+        rows, has_more = search.search(db, 'orders', 'mall lah', per_page=3)
+        assert [row['address'] for row in rows] == ['Shop 5, Mall Road', 'Shop 4, Mall Road', 'Shop 3, Mall Road']
+        assert has_more
+        rows, has_more = search.search(db, 'orders', 'mall lah', page=2, per_page=3)
+        assert [row['address'] for row in rows] == ['Shop 2, Mall Road', 'Shop 1, Mall Road']
+        assert not has_more
+
+def test_search_route(app, client, login):
+    with app.app_context():
+        db = aquaflow.get_db()
+        _add_customer(db, 'Ayesha Khan', 'ayesha@example.test', 'Karachi')
+        db.commit()
+    login('admin@water.com')
+    body = client.get('/admin/search?q=ayesha&kind=customers&format=json').get_json()
+    assert _names(body['results']) == ['Ayesha Khan']
+    assert body['has_more'] is False
+    page = client.get('/admin/search?q=ayesha&kind=locations')
+    assert page.status_code == 200
+    assert b'Ayesha Khan' in page.data
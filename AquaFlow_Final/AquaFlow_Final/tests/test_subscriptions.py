@@ -0,0 +1,166 @@
+# Subscription order generation: upgrades, schedules, pauses and backfill.
+
+import os
+import shutil
+from datetime import date, timedelta
+
+import pytest
+
+import app as aquaflow
+import jobs
+import schedule
+
+SHIPPED_DATABASE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'water_supply.db')
+
+def _days_ago(days):
+    return (date.today() - timedelta(days=days)).isoformat()
+
+def _subscribe(db, start_date, frequency='daily', interval_days=1, weekdays=schedule.ALL_WEEKDAYS):
+    """A customer with a subscription from start_date; returns the subscription id"""
+    user_id = db.insert('INSERT INTO users (name, email, phone, password, role) VALUES (?, ?, ?, ?, ?)',
+                        ('Customer', 'customer@example.test', '03000000000', 'unused', 'user'))
+    location_id = db.insert(
+        "INSERT INTO locations (user_id, label, address, city, is_default) VALUES (?, 'Home', 'House 1', 'Lahore', 1)",
+        (user_id,))
+    subscription_id = db.insert(
+        'INSERT INTO subscriptions (user_id, bottle_type, quantity, total_price, location_id, frequency, '
+        "interval_days, weekdays, start_date) VALUES (?, '20 Liter', 1, 200, ?, ?, ?, ?, ?)",
+        (user_id, location_id, frequency, interval_days, weekdays, start_date))
+    db.commit()
+    return subscription_id
+
+def _delivery_dates(db, subscription_id):
+    return [row[0] for row in db.execute(
+        'SELECT delivery_date FROM orders WHERE subscription_id = ? ORDER BY delivery_date', (subscription_id,))]
+
+def test_upgraded_database_generates_orders(config):
+    if config['DB_BACKEND'] != 'sqlite':
+        pytest.skip('upgrades the SQLite database shipped with the repo')
+    # The database from before versioned migrations, with one subscription
+    shutil.copy(SHIPPED_DATABASE, config['DATABASE'])
+    flask_app = aquaflow.create_app(config)
+    with flask_app.app_context():
+        aquaflow.bootstrap()
+        db = aquaflow.get_db()
+        assert db.execute('SELECT MAX(version) FROM schema_version').fetchone()[0] == aquaflow.LATEST_VERSION
+        today = date.today().isoformat()
+        assert aquaflow.claim_daily_run(db, today)
+        assert aquaflow.generate_subscription_orders(db) > 0
+        assert not aquaflow.claim_daily_run(db, today)
+        assert db.execute('SELECT COUNT(*) FROM orders WHERE subscription_id IS NOT NULL AND delivery_date = ?',
+                          (today,)).fetchone()[0] == 1
+    flask_app.extensions['aquaflow'].close()
+
+def test_stale_generation_job_is_reported(app, client, login):
+    with app.app_context():
+        db = aquaflow.get_db()
+        assert aquaflow.queue_daily_generation(db)
+        assert client.get('/readyz').get_json()['stale_jobs'] == {}
+
+        # No `flask run-jobs`: the job is still queued long after it was due
+        db.execute('UPDATE jobs SET run_after = run_after - ?', (app.config['JOB_STALE_SECONDS'] + 1,))
+        db.commit()
+        response = client.get('/readyz')
+        assert response.status_code == 200
+        assert response.get_json()['stale_jobs'] == {'generate_subscriptions': 1}
+        login('admin@water.com')
+        assert client.get('/admin/job_stats').get_json()['stale'] == {'generate_subscriptions': 1}
+
+        assert jobs.run_one(db)
+        assert client.get('/readyz').get_json()['stale_jobs'] == {}
+
+def test_changed_subscription_updates_pending_orders_from_today(app, client, login):
+    today = date.today()
+    with app.app_context():
+        db = aquaflow.get_db()
+        user_id = db.insert('INSERT INTO users (name, email, phone, password, role) VALUES (?, ?, ?, ?, ?)',
+                            ('Customer', 'customer@example.test', '03000000000', 'unused', 'user'))
+        home, office = (db.insert("INSERT INTO locations (user_id, label, address, city) VALUES (?, ?, ?, 'Lahore')",
+                                  (user_id, label, label + ' address')) for label in ('Home', 'Office'))
+        subscription_id = db.insert(
+            "INSERT INTO subscriptions (user_id, bottle_type, quantity, total_price, location_id, start_date) "
+            "VALUES (?, '20 Liter', 1, 200, ?, ?)", (user_id, home, (today - timedelta(days=1)).isoformat()))
+        # Yesterday's order is still pending, tomorrow's was generated ahead
+        for day, status in ((-1, 'pending'), (0, 'pending'), (0, 'delivered'), (1, 'pending')):
+            delivery_date = (today + timedelta(days=day)).isoformat()
+            db.execute(
+                "INSERT INTO orders (user_id, bottle_type, quantity, total_price, order_type, status, order_date, "
+                "address, city, subscription_id, delivery_date) "
+                "VALUES (?, '20 Liter', 1, 200, 'subscription', ?, ?, 'Home address', 'Lahore', ?, ?)",
+                (user_id, status, (today - timedelta(days=2)).isoformat() + ' 09:00:00',
+                 subscription_id if status == 'pending' else None, delivery_date))
+        db.commit()
+
+    login('customer@example.test')
+    response = client.post('/subscription', data={
+        'bottle_type': '20 Liter', 'quantity': '3', 'location_id': str(office),
+        'start_date': (today - timedelta(days=1)).isoformat(),
+    })
+    assert response.status_code == 302
+
+    with app.app_context():
+        rows = aquaflow.get_db().execute(
+            'SELECT delivery_date, status, quantity, address FROM orders ORDER BY delivery_date, status').fetchall()
+    assert [tuple(row) for row in rows] == [
+        ((today - timedelta(days=1)).isoformat(), 'pending', 1, 'Home address'),
+        (today.isoformat(), 'delivered', 1, 'Home address'),
+        (today.isoformat(), 'pending', 3, 'Office address'),
+        ((today + timedelta(days=1)).isoformat(), 'pending', 3, 'Office address'),
+    ]
+
+def test_missed_days_are_backfilled_except_paused_ones(app):
+    with app.app_context():
+        db = aquaflow.get_db()
+        subscription_id = _subscribe(db, _days_ago(6))
+        db.execute('INSERT INTO subscription_pauses (subscription_id, start_date, end_date) VALUES (?, ?, ?)',
+                   (subscription_id, _days_ago(4), _days_ago(3)))
+        db.commit()
+
+        # Nothing ran for six days
+        assert aquaflow.generate_subscription_orders(db) == 5
+        assert _delivery_dates(db, subscription_id) == [_days_ago(n) for n in (6, 5, 2, 1, 0)]
+        assert db.execute('SELECT last_generated_date FROM subscriptions').fetchone()[0] == _days_ago(0)
+        # A second run, or one racing it, finds nothing left to do
+        assert aquaflow.generate_subscription_orders(db) == 0
+
+def test_backfill_stops_at_the_limit(app):
+    app.config['SUBSCRIPTION_BACKFILL_DAYS'] = 2
+    with app.app_context():
+        db = aquaflow.get_db()
+        subscription_id = _subscribe(db, _days_ago(10))
+        assert aquaflow.generate_subscription_orders(db) == 3
+        assert _delivery_dates(db, subscription_id) == [_days_ago(n) for n in (2, 1, 0)]
+
+@pytest.mark.parametrize('frequency, interval_days, weekdays', [
+    ('every', 3, schedule.ALL_WEEKDAYS),
+    ('weekdays', 1, 0b0010101),  # Mon, Wed, Fri
+])
+def test_generated_days_follow_the_schedule(app, frequency, interval_days, weekdays):
+    with app.app_context():
+        db = aquaflow.get_db()
+        subscription_id = _subscribe(db, _days_ago(20), frequency, interval_days, weekdays)
+        subscription = dict(db.execute('SELECT * FROM subscriptions WHERE id = ?', (subscription_id,)).fetchone())
+        expected = [_days_ago(n) for n in range(20, -1, -1)
+                    if schedule.is_due(subscription, date.today() - timedelta(days=n))]
+        assert aquaflow.generate_subscription_orders(db) == len(expected)
+        assert _delivery_dates(db, subscription_id) == expected
+
+def test_pause_routes(app, client, login):
+    with app.app_context():
+        subscription_id = _subscribe(aquaflow.get_db(), _days_ago(0))
+    login('customer@example.test')
+    tomorrow, later = (date.today() + timedelta(days=1)).isoformat(), (date.today() + timedelta(days=3)).isoformat()
+
+    # Today's order exists already, so a pause can't start today
+    client.post('/subscription/pause', data={'start_date': _days_ago(0), 'end_date': later})
+    client.post('/subscription/pause', data={'start_date': tomorrow, 'end_date': later})
+    with app.app_context():
+        db = aquaflow.get_db()
+        pauses = db.execute('SELECT id, start_date, end_date FROM subscription_pauses WHERE subscription_id = ?',
+                            (subscription_id,)).fetchall()
+    assert [tuple(pause)[1:] for pause in pauses] == [(tomorrow, later)]
+    assert client.get('/subscription').status_code == 200
+
+    client.post(f'/subscription/pause/{pauses[0][0]}/delete')
+    with app.app_context():
+        assert aquaflow.get_db().execute('SELECT COUNT(*) FROM subscription_pauses').fetchone()[0] == 0
@@ -0,0 +1,83 @@
+# Rider tracking: pings are validated, buffered and written in group
+# commits, a retried batch is written once, and a full buffer answers 503.
+
+import time
+
+import pytest
+
+import app as aquaflow
+import tracking
+
+RIDER = 'delivery@water.com'
+
+def _trail(app):
+    with app.app_context():
+        return [tuple(row) for row in aquaflow.get_db().execute(
+            'SELECT recorded_at, lat, lng FROM rider_pings ORDER BY recorded_at')]
+
+def test_malformed_pings_are_dropped():
+    now = time.time()
+    rows, rejected = tracking.parse_pings(7, [
+        {'lat': 31.5, 'lng': 74.3, 'at': now - 5, 'speed': 8.5},
+        {'lat': 31.6, 'lng': 74.4},
+        {'lat': 91, 'lng': 74.3},
+        {'lat': '31.5', 'lng': 74.3},
+        {'lat': 31.5, 'lng': 74.3, 'at': now + 3600},
+        {'lat': 31.5, 'lng': 74.3, 'at': now - 2 * tracking.MAX_PING_AGE},
+        {'lat': True, 'lng': 74.3},
+        'not a ping',
+    ], now)
+    assert rows == [(7, now - 5, 31.5, 74.3, 8.5, None), (7, now, 31.6, 74.4, None, None)]
+    assert rejected == 6
+
+def test_pings_are_written_once(app, client, login):
+    login(RIDER)
+    now = round(time.time(), 3)
+    body = {'pings': [{'lat': 31.5, 'lng': 74.3, 'at': now - 2}, {'lat': 31.51, 'lng': 74.31, 'at': now - 1},
+                      {'lat': 'x', 'lng': 74.3}]}
+    response = client.post('/api/tracking/pings', json=body)
+    assert response.status_code == 202
+    assert response.get_json() == {'accepted': 2, 'rejected': 1}
+    # The phone didn't get the answer and sends the batch again
+    assert client.post('/api/tracking/pings', json=body).status_code == 202
+
+    writer = app.extensions['aquaflow'].tracker.writer
+    writer.flush()
+    assert _trail(app) == [(now - 2, 31.5, 74.3), (now - 1, 31.51, 74.31)]
+    assert writer.buffered() == 0
+
+def test_full_buffer_answers_503(app, client, login):
+    # No flush between the two requests
+    app.config.update(TRACKING_MAX_BUFFERED=2, TRACKING_FLUSH_SECONDS=60)
+    login(RIDER)
+    ping = {'lat': 31.5, 'lng': 74.3}
+    assert client.post('/api/tracking/pings', json={'pings': [ping, ping]}).status_code == 202
+    response = client.post('/api/tracking/pings', json={'pings': [ping]})
+    assert response.status_code == 503
+    assert int(response.headers['Retry-After']) >= 1
+
+def test_only_riders_send_pings(client, login):
+    login('admin@water.com')
+    assert client.post('/api/tracking/pings', json={'pings': []}).status_code == 403
+
+def test_latest_position_comes_from_the_trail_when_this_worker_is_behind(app):
+    with app.app_context():
+        db = aquaflow.get_db()
+        tracker = aquaflow.get_tracker()
+        rider_id = db.execute('SELECT id FROM users WHERE email = ?', (RIDER,)).fetchone()[0]
+        now = time.time()
+        tracker.record([(rider_id, now - 60, 31.5, 74.3, None, None)])
+        # Another worker took a newer ping and has written it
+        db.execute('INSERT INTO rider_pings (rider_id, recorded_at, lat, lng) VALUES (?, ?, ?, ?)',
+                   (rider_id, now - 10, 31.6, 74.4))
+        db.commit()
+        assert tracker.latest(db, rider_id, now) == (31.6, 74.4, now - 10)
+        # A ping of this worker within the flush interval is used without a query
+        tracker.record([(rider_id, now, 31.7, 74.5, None, None)])
+        assert tracker.latest(db, rider_id, now) == (31.7, 74.5, now)
+
+def test_eta_scales_with_distance():
+    here = tracking.Position(31.5, 74.3, 0)
+    assert tracking.eta_minutes(here, (31.5, 74.3), 20, 1.3) == 1
+    # 0.1 degree of latitude is about 11 km; 11 km x 1.3 at 20 km/h is about 43 minutes
+    assert tracking.eta_minutes(here, (31.6, 74.3), 20, 1.3) == pytest.approx(43, abs=1)
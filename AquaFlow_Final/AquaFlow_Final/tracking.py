@@ -0,0 +1,259 @@
+# Live rider tracking: GPS pings from delivery boys and vans.
+#
+# Riders' phones post batches of pings. Each worker keeps:
+#   LatestPositions  the newest ping of every rider, in parallel arrays
+#                    indexed through a rider -> slot dict
+#   TrailWriter      a buffer of pings that a background thread appends to
+#                    rider_pings, one transaction per flush (every
+#                    flush_seconds or flush_pings pings) instead of one per
+#                    ping
+# A flush can lose at most the pings of its last interval if the worker
+# dies, which is acceptable for a trail. rider_pings is keyed by (rider,
+# time), so a batch the phone retries is written once.
+#
+# A worker only sees the pings posted to it, so a position older than the
+# flush interval is looked up in rider_pings, which every worker writes.
+#
+# The ETA is the straight-line distance from the rider to the order's
+# geocoded address times a detour factor, at an average city speed.
+
+import logging
+import math
+import os
+import threading
+import time
+from array import array
+from collections import namedtuple
+
+from dispatch import KM_PER_DEGREE
+
+logger = logging.getLogger(__name__)
+
+Position = namedtuple('Position', 'lat lng recorded_at')
+
+# Pings more than this far in the past (queued on a phone that was offline) are too old to be useful
+MAX_PING_AGE = 24 * 3600
+# ... or in the future, beyond clock skew
+MAX_CLOCK_SKEW = 60
+
+def install(db):
+    """Creates the rider_pings table"""
+    db.execute(
+        '''CREATE TABLE IF NOT EXISTS rider_pings (
+               rider_id INTEGER NOT NULL,
+               recorded_at REAL NOT NULL,
+               lat REAL NOT NULL,
+               lng REAL NOT NULL,
+               speed REAL,
+               accuracy REAL,
+               PRIMARY KEY (rider_id, recorded_at)
+           ) WITHOUT ROWID'''
+    )
+    # Pruning deletes by age across riders
+    db.execute('CREATE INDEX IF NOT EXISTS idx_rider_pings_recorded ON rider_pings (recorded_at)')
+
+def _number(value, low, high):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not low <= value <= high:
+        raise ValueError
+    return float(value)
+
+def parse_pings(rider_id, pings, now):
+    """Rows for rider_pings from a posted list of {"lat", "lng", "at", "speed", "accuracy"}.
+
+    at is epoch seconds (the time of the fix, default now), speed m/s and
+    accuracy metres are optional. Returns (rows, rejected) where rejected is
+    the number of malformed or out-of-range pings that were dropped.
+    """
+    rows = []
+    for ping in pings:
+        try:
+            if not isinstance(ping, dict):
+                raise ValueError
+            at = ping.get('at')
+            rows.append((
+                rider_id,
+                now if at is None else _number(at, now - MAX_PING_AGE, now + MAX_CLOCK_SKEW),
+                _number(ping.get('lat'), -90, 90),
+                _number(ping.get('lng'), -180, 180),
+                None if ping.get('speed') is None else _number(ping['speed'], 0, 100),
+                None if ping.get('accuracy') is None else _number(ping['accuracy'], 0, 100000),
+            ))
+        except ValueError:
+            pass
+    return rows, len(pings) - len(rows)
+
+class LatestPositions:
+    """The newest position of each rider: 24 bytes a rider plus its dict entry"""
+
+    def __init__(self):
+        self._slots = {}
+        self._lat = array('d')
+        self._lng = array('d')
+        self._at = array('d')
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._slots)
+
+    def update(self, rider_id, lat, lng, recorded_at):
+        """Stores the position unless the rider already has a newer one"""
+        with self._lock:
+            slot = self._slots.get(rider_id)
+            if slot is None:
+                self._slots[rider_id] = len(self._at)
+                self._lat.append(lat)
+                self._lng.append(lng)
+                self._at.append(recorded_at)
+            elif recorded_at > self._at[slot]:
+                self._lat[slot] = lat
+                self._lng[slot] = lng
+                self._at[slot] = recorded_at
+
+    def get(self, rider_id):
+        with self._lock:
+            slot = self._slots.get(rider_id)
+            if slot is None:
+                return None
+            return Position(self._lat[slot], self._lng[slot], self._at[slot])
+
+class TrailWriter:
+    """Appends pings to rider_pings from a background thread in group commits"""
+
+    def __init__(self, pool, flush_seconds=1.0, flush_pings=5000, max_buffered=100000,
+                 retention_seconds=7 * 24 * 3600):
+        self.pool = pool
+        self.flush_seconds = flush_seconds
+        self.flush_pings = flush_pings
+        self.max_buffered = max_buffered
+        self.retention_seconds = retention_seconds
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._buffer = []
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+        self.written = 0
+
+    def add(self, rows):
+        """Queues rows for the next flush. False if the buffer is full (the database can't keep up)."""
+        if self._pid != os.getpid():
+            # Forked: the parent's thread and buffer stay with the parent
+            self._reset()
+        with self._cond:
+            if len(self._buffer) + len(rows) > self.max_buffered:
+                return False
+            self._buffer.extend(rows)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='trail-writer', daemon=True)
+                self._thread.start()
+            if len(self._buffer) >= self.flush_pings:
+                self._cond.notify()
+        return True
+
+    def buffered(self):
+        return len(self._buffer)
+
+    def _run(self):
+        prune_at = 0.0
+        while True:
+            with self._cond:
+                if not self._stopping and len(self._buffer) < self.flush_pings:
+                    self._cond.wait(self.flush_seconds)
+                stopping = self._stopping
+            self.flush()
+            if time.monotonic() >= prune_at:
+                self.prune()
+                prune_at = time.monotonic() + 600
+            if stopping:
+                return
+
+    def flush(self):
+        """Writes the buffered pings in one transaction. Returns how many."""
+        with self._cond:
+            rows, self._buffer = self._buffer, []
+        if not rows:
+            return 0
+        db = self.pool.acquire()
+        try:
+            db.executemany(
+                'INSERT INTO rider_pings (rider_id, recorded_at, lat, lng, speed, accuracy) '
+                'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT DO NOTHING',
+                rows
+            )
+            db.commit()
+        except Exception:
+            # e.g. database busy: put them back for the next flush, dropping the oldest past the limit
+            logger.exception('Could not write %d rider pings', len(rows))
+            db.rollback()
+            with self._cond:
+                self._buffer[:0] = rows[max(0, len(rows) + len(self._buffer) - self.max_buffered):]
+            return 0
+        finally:
+            self.pool.release(db)
+        self.written += len(rows)
+        return len(rows)
+
+    def prune(self):
+        """Deletes the trail older than the retention period"""
+        db = self.pool.acquire()
+        try:
+            db.execute('DELETE FROM rider_pings WHERE recorded_at < ?', (time.time() - self.retention_seconds,))
+            db.commit()
+        except Exception:
+            logger.exception('Could not prune rider pings')
+            db.rollback()
+        finally:
+            self.pool.release(db)
+
+    def close(self):
+        """Stops the thread after a last flush"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None and self._pid == os.getpid():
+            thread.join()
+
+class Tracker:
+    def __init__(self, writer):
+        self.writer = writer
+        self.positions = LatestPositions()
+
+    def record(self, rows):
+        """Takes parsed ping rows of one rider. False if they couldn't be buffered."""
+        if not rows:
+            return True
+        if not self.writer.add(rows):
+            return False
+        newest = max(rows, key=lambda row: row[1])
+        self.positions.update(newest[0], newest[2], newest[3], newest[1])
+        return True
+
+    def latest(self, db, rider_id, now=None):
+        """The rider's newest known position, from this worker or from the trail"""
+        now = time.time() if now is None else now
+        position = self.positions.get(rider_id)
+        # Another worker's newer pings can't have reached rider_pings yet
+        if position is not None and now - position.recorded_at <= self.writer.flush_seconds:
+            return position
+        row = db.execute(
+            'SELECT lat, lng, recorded_at FROM rider_pings WHERE rider_id = ? ORDER BY recorded_at DESC LIMIT 1',
+            (rider_id,)
+        ).fetchone()
+        if row is not None and (position is None or row[2] > position.recorded_at):
+            position = Position(row[0], row[1], row[2])
+            self.positions.update(rider_id, *position)
+        return position
+
+def distance_km(lat1, lng1, lat2, lng2):
+    """Distance on a plane projected at the mean latitude, as dispatch does; fine within a city"""
+    x = (lng2 - lng1) * KM_PER_DEGREE * math.cos(math.radians((lat1 + lat2) / 2))
+    y = (lat2 - lat1) * KM_PER_DEGREE
+    return math.hypot(x, y)
+
+def eta_minutes(position, destination, speed_kmh, detour_factor):
+    """Minutes for a rider at position to reach destination (lat, lng), at least 1"""
+    km = distance_km(position.lat, position.lng, destination[0], destination[1]) * detour_factor
+    return max(1, round(km / speed_kmh * 60))
@@ -0,0 +1,8 @@
+# WSGI entry point: gunicorn wsgi:app
+#
+# Builds this process's app. Run `flask --app app bootstrap` once per deploy
+# before starting the workers; see the deploy steps in README.md.
+
+from app import create_app
+
+app = create_app()